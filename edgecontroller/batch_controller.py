@@ -4,24 +4,24 @@ import os
 import sys
 sys.path.insert(0, '../messaging')
 from message_bus import MessageBus
-from datetime import datetime
-from util import process_result, load_images, resize_image, cv_image2tensor, transform_result
-import base64
+from batch_detector import BatchDetector
+from inference_backend import load_backend, BACKENDS
+from weight_cache import load_model, StartupTimer
+from model_server import ModelClient
+from frame_queue import FrameRecord, FrameQueue
+from datetime import datetime, timedelta
 import random
 import cv2
 import numpy as np
 import signal
 import imutils
 import psutil
-import queue
 import threading
 import time
 import torch
-from torch.autograd import Variable
 from darknet import Darknet
 import pickle as pkl
 import math
-import ntplib
 import trackableobject
 import centroidtracker
 import dlib
@@ -34,8 +34,9 @@ def threaded(fn):
     return wrapper
 
 class Controller(object):
-    def __init__(self, name, port):
-        self.msg_bus = MessageBus(name, port, 'controller')
+    def __init__(self, name, port, decode_procs=0):
+        self.msg_bus = MessageBus(name, port, 'controller', decode_procs=decode_procs)
+        self.msg_bus.start_broadcaster() # device_list and control_op fan-out
         self.msg_bus.register_callback('join', self.handle_message)
         self.msg_bus.register_callback('img', self.handle_message)
         self.msg_bus.register_callback('img_metadata', self.handle_message)
@@ -57,17 +58,20 @@ class Controller(object):
         self.input_size = None
         self.confidence = None
         self.nms_thresh = None
+        self.detector = None # BatchDetector, set up with the model
+        self.model_server = None # address of a model_server.py to detect through instead of a local model
+        self.keep_classes = None # class indices kept by nms (set up with the classes)
+        self.backend = 'torch' # detector runtime, see inference_backend.py
+        self.threads = 0 # intra-op threads of the runtime (0: its default)
+        self.max_batch = 8 # frames per forward pass
+        self.max_wait = 0.005 # seconds to wait for more frames to fill a batch
         self.net = None # load caffe model
         self.framecnt = 0
         self.gettimegap()
         self.tr = None
         self.encode_param = None
 
-        self.imgq = queue.Queue(2000) # q for image.
-        self.timerq = queue.Queue(2000) # q for image wait time
-        self.framecntq = queue.Queue(2000) # q for frame cnt
-        self.dev_nameq = queue.Queue(2000) # q for devnames
-        self.typeq= queue.Queue(2000) # q for type of msg
+        self.frameq = FrameQueue(2000, 2.0) # FrameRecords of all devices, dropped after 2s (-qa)
         #self.image_dequeue_proc()
 
         self.ct = centroidtracker.CentroidTracker(50, maxDistance =50, queuesize = 10)
@@ -84,11 +88,13 @@ class Controller(object):
         self.frame_skip = 10
 
 
+    #
+    # The controller is the time reference: cameras follow its clock
+    # through the clock server instead of asking an NTP host once.
+    #
     def gettimegap(self):
-        starttime = datetime.now()
-        ntp_response = ntplib.NTPClient().request('2.kr.pool.ntp.org', version=3)
-        returntime = datetime.now()
-        self.timegap = datetime.fromtimestamp(ntp_response.tx_time) - starttime - (returntime - starttime) / 2
+        self.timegap = timedelta()
+        self.msg_bus.start_clock_server()
 
     def cpuusage(self):
         self.cpu = psutil.cpu_percent()
@@ -99,6 +105,9 @@ class Controller(object):
         return self.ram
 
     def signal_handler(self, sig, frame):
+        if self.msg_bus.decoder is not None:
+            print('[Controller] decode workers: ', self.msg_bus.decode_stats())
+            self.msg_bus.decoder.close()
         self.msg_bus.ctx.destroy()
         self.logfile.close()
         self.logfile2.close()
@@ -137,33 +146,21 @@ class Controller(object):
             pass
 
     def handle_join(self, msg_dict):
-        node_table = self.msg_bus.node_table
-        node_table.add_entry(msg_dict['device_name'], msg_dict['ip'], int(msg_dict['port']), msg_dict['location'], msg_dict['capability'])
+        # full device_list back to the new node, a delta to everybody else
+        self.msg_bus.add_joined_node(msg_dict)
         print('@@Table: ', self.msg_bus.node_table.table)
 
-        # Send node_table
-        device_list_json = {"type": "device_list", "devices": self.msg_bus.node_table.get_list_str()}
-        for node_name in node_table.table.keys():
-            node_info = node_table.table[node_name]
-            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), device_list_json)
-
 #    @threaded
     def process_raw_tracking(self, msg_dict):
 #        print(' - tracking image')
-        decstr = base64.b64decode(msg_dict['img_string'])
-        imgarray = np.fromstring(decstr, dtype=np.uint8)
-        decimg = cv2.imdecode(imgarray, cv2.IMREAD_COLOR)
+        decimg = self.msg_bus.decode(msg_dict)
         localNow = datetime.utcnow()+self.timegap
 
         curTime = datetime.utcnow().strftime('%H:%M:%S.%f') # string forma
         curdatetime = datetime.strptime(curTime, '%H:%M:%S.%f')
         sentdatetime = datetime.strptime(msg_dict['time'], '%H:%M:%S.%f')
 
-        self.typeq.put(str(msg_dict['type'])) # type
-        self.imgq.put(decimg) # keep chugging
-        self.timerq.put(curdatetime)
-        self.framecntq.put(str(msg_dict['framecnt']))
-        self.dev_nameq.put(str(msg_dict['device_name']))
+        self.frameq.put(FrameRecord(str(msg_dict['device_name']), msg_dict['framecnt'], str(msg_dict['type']), decimg, curdatetime))
 
     def checkboundary(self, centroid, objectID):
         #print(centroid)
@@ -257,9 +254,7 @@ class Controller(object):
 
     def process_raw_image(self, msg_dict):
 #       print(' - raw image')
-        decstr = base64.b64decode(msg_dict['img_string'])
-        imgarray = np.fromstring(decstr, dtype=np.uint8)
-        decimg = cv2.imdecode(imgarray, cv2.IMREAD_COLOR)
+        decimg = self.msg_bus.decode(msg_dict)
 #        cv2.imwrite(msg_dict['time']+'.jpg', decimg)
 #        print(' - saved img.')
         localNow = datetime.utcnow()+self.timegap
@@ -268,20 +263,38 @@ class Controller(object):
         sentdatetime = datetime.strptime(msg_dict['time'], '%H:%M:%S.%f')
         self.logfile.write(str(msg_dict['framecnt'])+"\t"+str((curdatetime - sentdatetime).total_seconds())+"\t"+str(sys.getsizeof(decimg))+'\t'+str(self.cpuusage())+'\n')
 
-        self.typeq.put(str(msg_dict['type'])) # type
-        self.imgq.put(decimg) # keep chugging
-        self.timerq.put(curdatetime)
-        self.framecntq.put(str(msg_dict['framecnt']))
+        self.frameq.put(FrameRecord(str(msg_dict['device_name']), msg_dict['framecnt'], str(msg_dict['type']), decimg, curdatetime))
         self.framecnt = str(msg_dict['framecnt'])
     
+    #
+    # Takes up to max_batch queued frames (waiting at most max_wait for
+    # more) and detects the tracking frames that are due for detection in
+    # one forward pass. The frames are then tracked in order, as before.
+    # Returns [(device_name, counter, frame, type, detections or None, timer)].
+    #
+    def dequeue_batch(self):
+        batch = []
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            record = self.frameq.get(timeout=max(deadline - time.time(), 0))
+            if record is None:
+                break
+            batch.append([record.device_name, record.framecnt, record.frame, record.type, None, record.timer])
+        due = [b for b in batch if b[3] == 'img_tracking' and b[1] % self.frame_skip == 0]
+        if due and self.cuda:
+            for b, detections in zip(due, self.detector.detect([b[2] for b in due])):
+                b[4] = detections
+        return [tuple(b) for b in batch]
+
     @threaded
     def image_dequeue_proc(self):
         framecnt = 0
         endcnt =0 # if idle for 2 minutes, save and quit.
         frame_start_time = time.time()
         self.encode_param = [int(cv2.IMWRITE_JPEG_QUALITY),99]
+        pending = [] # dequeued frames, detected ahead in one batch
         while (True):
-             if (self.imgq.empty()):
+             if (self.frameq.empty() and not pending):
                 if(endcnt >= 120):
                     self.logfile.close()
                     self.logfile2.close()
@@ -289,14 +302,15 @@ class Controller(object):
                     sys.exit(0)
                 else:
                     print('nothing in q, sleeping..')
-                    time.sleep(1)
+                    self.frameq.wait(1) # returns as soon as a frame arrives
                     endcnt += 1
 
-             else: # lets get 10 to speed up the process. not now though...
-                device_name = self.dev_nameq.get()
-                counter = int(self.framecntq.get())
-                frame = self.imgq.get()
-                ty = self.typeq.get()
+             else:
+                if not pending:
+                    pending = self.dequeue_batch()
+                    if not pending: # everything queued was too old
+                        continue
+                device_name, counter, frame, ty, detections, timer = pending.pop(0)
                 if self.cuda:
                     if ty  == 'img': # just detection, nothing else
                         self.detection_gpu(self.model, frame, cnt)
@@ -308,17 +322,7 @@ class Controller(object):
                         positions = []
                         if int(counter) % self.frame_skip == 0:
                             self.trackers = []
-                            frame_tensor = cv_image2tensor(frame, self.input_size).unsqueeze(0)
-                            frame_tensor = Variable(frame_tensor)
-
-                            if self.cuda:
-                                frame_tensor = frame_tensor.cuda()
-
-                            detections = self.model(frame_tensor, self.cuda).cpu()
-                            detections = process_result(detections, self.confidence, self.nms_thresh)
-        
                             if len(detections) != 0:
-                                detections = transform_result(detections, [frame], self.input_size)
                             #for detection in detections:
                                 for idx, detection in enumerate(detections):
                                     if (self.classes[int(detection[-1])]=="person"):
@@ -463,12 +467,12 @@ class Controller(object):
                         self.detection(frame)
                     elif ty == 'img_tracking':
                         print ("NOT IMP YET")
-                        # self.detection_tracking (self.model, self.imgq.get(), cnt)
+                        # self.detection_tracking (self.model, frame, cnt)
                     elif ty  == 'img_tracking_check':
                         print ("NOT IMP YET")
-                        # thing = self.detection_gpu_return(self.model, self.imgq.get(), cnt)
+                        # thing = self.detection_gpu_return(self.model, frame, cnt)
                 curT = datetime.utcnow().strftime('%H:%M:%S.%f') # string format
-                decay = datetime.strptime(curT, '%H:%M:%S.%f') - self.timerq.get()
+                decay = datetime.strptime(curT, '%H:%M:%S.%f') - timer
 
                 frame_end_time = time.time()
                 cumlative_fps = int(counter) / (frame_end_time - frame_start_time)
@@ -478,27 +482,28 @@ class Controller(object):
 
 
     def setup_before_detection_gpu(self):
-        self.input_size = [int(self.model.net_info['height']), int(self.model.net_info['width'])]
         self.colors = pkl.load(open("pallete", "rb"))
         self.classes = self.load_classes ("data/coco.names")
         self.colors = [self.colors[1]]
+        self.keep_classes = [self.classes.index("person")] # the only class any mode tracks
+        if self.model_server is not None:
+            self.detector = ModelClient(self.model_server, self.msg_bus.device_name, self.keep_classes)
+            self.input_size = self.detector.input_size
+            return
+        self.input_size = [int(self.model.net_info['height']), int(self.model.net_info['width'])]
+        use_cuda = torch.cuda.is_available()
+        backend = load_backend(self.backend, self.model, self.input_size, use_cuda, self.threads)
+        self.detector = BatchDetector(self.model, self.input_size, use_cuda, self.confidence, self.nms_thresh,
+                                      self.max_batch, self.max_wait, self.keep_classes, backend)
 
 
     def detection_gpu_return(self, model, frame, cnt):
 #        print('Detecting...')
         personcnt =0
         start_time = time.time()
-        frame_tensor = cv_image2tensor(frame, self.input_size).unsqueeze(0)
-        frame_tensor = Variable(frame_tensor)
-
-        if self.cuda:
-            frame_tensor = frame_tensor.cuda()
-
-        detections = self.model(frame_tensor, self.cuda).cpu()
-        detections = process_result(detections, self.confidence, self.nms_thresh)
+        detections = self.detector.detect([frame])[0]
         
         if len(detections) != 0:
-            detections = transform_result(detections, [frame], self.input_size)
 #            for detection in detections:
             for idx, detection in enumerate(detections):
                 if(self.classes[int(detection[-1])]=="person"):
@@ -509,18 +514,10 @@ class Controller(object):
     def detection_gpu(self, model, frame, cnt):
 #        print('Detecting...')
         start_time = time.time()
-        frame_tensor = cv_image2tensor(frame, self.input_size).unsqueeze(0)
-        frame_tensor = Variable(frame_tensor)
-
-        if self.cuda:
-            frame_tensor = frame_tensor.cuda()
-
-        detections = self.model(frame_tensor, self.cuda).cpu()
-        detections = process_result(detections, self.confidence, self.nms_thresh)
+        detections = self.detector.detect([frame], all_classes=True)[0]
         print("number of detected objects: ", len(detections))
         a = [[] for _ in range(len(detections))]
         if len(detections) != 0:
-            detections = transform_result(detections, [frame], self.input_size)
 #            for detection in detections:
             for idx, detection in enumerate(detections):
                 a[idx].append(float(detection[6])) # prediction score
@@ -580,6 +577,8 @@ class Controller(object):
 
 
 if __name__ == '__main__':
+    startup = StartupTimer(psutil.Process().create_time())
+    startup.mark('imports')
     parser = argparse.ArgumentParser(description="IoT controller of Chameleon.")
     parser.add_argument('-ln1', '--logfilename1', type=str, default='logfilecpu.txt', help="logfile name for cpu usage")
     parser.add_argument('-ln2', '--logfilename2', type=str, default='logfileframe.txt', help="logfile name for frame related things.")
@@ -588,6 +587,15 @@ if __name__ == '__main__':
     parser.add_argument("--nms_thresh", dest = "nms_thresh", help = "NMS Threshhold", default = 0.5)
     parser.add_argument('-dis', '--display', type=str, default = 'off', help = "enable display")
     parser.add_argument('-tr', '--tr_op', type=str, default = 'dr', help = "dead reckoning, boundary check")
+    parser.add_argument('-mb', '--maxbatch', type=int, default = 8, help = "max frames per detection batch")
+    parser.add_argument('-mw', '--maxwait', type=float, default = 0.005, help = "max seconds to wait for a fuller batch")
+    parser.add_argument('-be', '--backend', type=str, default = 'torch', choices = BACKENDS, help = "detector runtime")
+    parser.add_argument('-th', '--threads', type=int, default = 0, help = "detector intra-op threads (0: runtime default)")
+    parser.add_argument('-dp', '--decodeprocs', type=int, default = 2, help = "JPEG decode worker processes (0: decode in the receiving thread)")
+    parser.add_argument('-qa', '--queueage', type=float, default = 2.0, help = "drop queued frames older than N seconds (0: keep all)")
+    parser.add_argument('-lt', '--livenesstimeout', type=float, default = 0, help = "evict cameras silent for N seconds (0: off)")
+    parser.add_argument('-wc', '--weightcache', type=str, default = 'cache', help = "directory of the converted YOLO weights ('' to parse yolov3.weights every start)")
+    parser.add_argument('-ms', '--modelserver', type=str, default = None, help = "detect through model_server.py at this address (e.g. tcp://127.0.0.1:9600) instead of loading the models")
     ARGS = parser.parse_args()
     # Read 'master.ini'
     config = configparser.ConfigParser()
@@ -597,27 +605,52 @@ if __name__ == '__main__':
     label_path = config['detection_label']['yolo']
     prototxtpath =  config['mSSD']['prototxt']
     modelpath = config['mSSD']['model']
-    ctrl = Controller(controller_name, listen_port)
+    ctrl = Controller(controller_name, listen_port, ARGS.decodeprocs)
+    startup.mark('message bus')
     print("[INFO] Loading model...")
     print("[INFO] Please wait until setup is done...")
-    ctrl.net = cv2.dnn.readNetFromCaffe(prototxtpath, modelpath)
+    if ARGS.modelserver is None:
+        ctrl.net = cv2.dnn.readNetFromCaffe(prototxtpath, modelpath)
+        startup.mark('caffe model')
 
     ctrl.confidence = ARGS.confidence
     ctrl.nms_thresh = ARGS.nms_thresh
+    ctrl.max_batch = ARGS.maxbatch
+    ctrl.max_wait = ARGS.maxwait
+    ctrl.backend = ARGS.backend
+    ctrl.threads = ARGS.threads
+    ctrl.frameq.max_age = ARGS.queueage
     ctrl.display = ARGS.display
-    ctrl.model = Darknet("cfg/yolov3.cfg")
-    ctrl.model.load_weights('yolov3.weights')
+    ctrl.model_server = ARGS.modelserver
+    if ARGS.modelserver is not None:
+        pass # both models live in the model server
+    elif ARGS.weightcache:
+        ctrl.model, cached = load_model("cfg/yolov3.cfg", 'yolov3.weights', ARGS.weightcache)
+        startup.mark('yolo weights (cached)' if cached else 'yolo weights (cache miss)')
+    else:
+        ctrl.model = Darknet("cfg/yolov3.cfg")
+        ctrl.model.load_weights('yolov3.weights')
+        startup.mark('yolo weights')
     ctrl.cuda = torch.cuda.is_available()
-    if torch.cuda.is_available():
-        ctrl.model.cuda()
-    ctrl.model.eval()
+    if ctrl.model is not None:
+        if torch.cuda.is_available():
+            ctrl.model.cuda()
+        ctrl.model.eval()
     ctrl.setup_before_detection_gpu()
+    if ARGS.modelserver is not None:
+        ctrl.net = ctrl.detector.caffe_net()
+        ctrl.cuda = ctrl.detector.cuda # YOLO if the server has a GPU, else MobileNet-SSD as before
+    startup.mark('detector backend')
 
     ctrl.logfile = open(ARGS.logfilename1, 'w')
     ctrl.logfile2 = open(ARGS.logfilename2, 'w')
     ctrl.logfile3 = open(ARGS.logfilename3, 'w')
     ctrl.label_path = label_path
     ctrl.tr = ARGS.tr_op
+    if ARGS.livenesstimeout > 0:
+        ctrl.msg_bus.run_liveness_check(ARGS.livenesstimeout)
+    startup.mark('logs and messaging')
+    print(startup.report())
     print("[INFO] Finished setup!")
     if ARGS.tr_op == "dr" or ARGS.tr_op == "bc":
         ctrl.image_dequeue_proc()
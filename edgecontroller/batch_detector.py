@@ -0,0 +1,65 @@
+import threading
+import time
+from util import process_result, transform_result
+from preprocess import Letterboxer
+from inference_backend import TorchBackend
+
+#
+# Runs the detector on several frames (normally one per camera) in one
+# forward pass. Darknet, process_result and transform_result all work on
+# a batch; the detections are split back per frame, in input order.
+# Frames beyond max_batch go to further passes.
+#
+class BatchDetector(object):
+    def __init__(self, model, input_size, cuda, confidence, nms_thresh, max_batch=8, max_wait=0.005, keep_classes=None, backend=None):
+        self.model = model
+        self.input_size = input_size
+        self.cuda = cuda
+        self.confidence = confidence
+        self.nms_thresh = nms_thresh
+        self.max_batch = max_batch
+        self.max_wait = max_wait # how long to wait for more frames to fill a batch (s)
+        self.keep_classes = keep_classes # e.g. only person; None keeps all
+        self.letterboxer = Letterboxer(input_size, pin_memory=bool(cuda))
+        self.forward = backend if backend is not None else TorchBackend(model, cuda) # tensor -> detections on the CPU
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.frames = 0
+        self.forward_time = 0.0
+
+    def to_tensor(self, frames):
+        return self.letterboxer.to_tensor(frames)
+
+    #
+    # Returns one detections tensor per frame (rows: batch index, x1, y1,
+    # x2, y2, objectness, class score, class index), empty if nothing was
+    # found. all_classes ignores keep_classes. originals gives, per frame,
+    # the (height, width) the sender letterboxed it from (None: not
+    # letterboxed); its boxes are then in that frame's coordinates.
+    #
+    def detect(self, frames, all_classes=False, originals=None):
+        results = []
+        for start in range(0, len(frames), self.max_batch):
+            chunk = frames[start:start + self.max_batch]
+            s = time.time()
+            detections = self.forward(self.to_tensor(chunk))
+            detections = process_result(detections, self.confidence, self.nms_thresh, None if all_classes else self.keep_classes)
+            with self.lock:
+                self.batches += 1
+                self.frames += len(chunk)
+                self.forward_time += time.time() - s
+            if len(detections) == 0:
+                results.extend(detections for _ in chunk)
+                continue
+            if originals is not None:
+                chunk = [frame if original is None else tuple(original) for frame, original in zip(chunk, originals[start:start + self.max_batch])]
+            detections = transform_result(detections, chunk, self.input_size)
+            for b in range(len(chunk)):
+                results.append(detections[detections[:, 0] == b])
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {'batches': self.batches, 'frames': self.frames,
+                    'mean_batch': self.frames / float(max(self.batches, 1)),
+                    'frames_per_sec': self.frames / max(self.forward_time, 1e-6)}
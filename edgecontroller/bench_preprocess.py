@@ -0,0 +1,41 @@
+import argparse
+import time
+import cv2
+import numpy as np
+import torch
+from util import cv_image2tensor
+from preprocess import Letterboxer
+
+#
+# Microbenchmark: util.cv_image2tensor (one frame at a time, as the
+# controllers used to call it) against Letterboxer, for a few camera
+# resolutions and batch sizes.
+#
+def bench(fn, repeat):
+    fn() # warm up (allocates the canvases)
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="letterbox preprocessing benchmark")
+    parser.add_argument('-s', '--size', type=int, default=416, help="detector input size")
+    parser.add_argument('-r', '--repeat', type=int, default=50, help="runs per measurement")
+    parser.add_argument('-b', '--batches', type=str, default='1,4,8', help="batch sizes")
+    ARGS = parser.parse_args()
+
+    torch.set_num_threads(1)
+    input_size = (ARGS.size, ARGS.size)
+    for h, w in [(480, 640), (720, 1280), (1080, 1920)]:
+        for n in [int(b) for b in ARGS.batches.split(',')]:
+            frames = [(np.random.rand(h, w, 3) * 255).astype(np.uint8) for _ in range(n)]
+            old = bench(lambda: torch.stack([cv_image2tensor(f, input_size) for f in frames]), ARGS.repeat)
+            cubic = Letterboxer(input_size, cv2.INTER_CUBIC)
+            linear = Letterboxer(input_size)
+            same = torch.equal(cubic.to_tensor(frames), torch.stack([cv_image2tensor(f, input_size) for f in frames]))
+            t_cubic = bench(lambda: cubic.to_tensor(frames), ARGS.repeat)
+            t_linear = bench(lambda: linear.to_tensor(frames), ARGS.repeat)
+            print('{}x{} batch {}: cv_image2tensor {:.2f} ms, Letterboxer cubic {:.2f} ms ({:.1f}x, identical: {}), linear {:.2f} ms ({:.1f}x)'.format(
+                w, h, n, old * 1000, t_cubic * 1000, old / t_cubic, same, t_linear * 1000, old / t_linear))
@@ -4,7 +4,6 @@ import sys
 sys.path.insert(0, '../messaging')
 from message_bus import MessageBus
 from datetime import datetime
-import base64
 import cv2
 import numpy as np
 import signal
@@ -95,9 +94,7 @@ class Controller(object):
 
     def process_raw_image(self, msg_dict):
         print(' - raw image')
-        decstr = base64.b64decode(msg_dict['img_string'])
-        imgarray = np.fromstring(decstr, dtype=np.uint8)
-        decimg = cv2.imdecode(imgarray, cv2.IMREAD_COLOR)
+        decimg = MessageBus.decode_image(msg_dict)
 #        cv2.imwrite(msg_dict['time']+'.jpg', decimg)
 #        print(' - saved img.')
         localNow = datetime.utcnow()+self.timegap
@@ -55,10 +55,10 @@ class DetectionLayer(nn.Module):
         self.num_anchors = len(anchors)
         self.input_dim = input_dim
 
-    def forward(self, x, cuda):
+    def forward(self, x, cuda, input_dim=None):
         batch_size = x.size(0)
         grid_size = x.size(2)
-        stride = self.input_dim // grid_size
+        stride = (input_dim or self.input_dim) // grid_size # the cfg size unless told the actual one
 
         detection = x.view(batch_size, self.num_anchors, self.num_classes + 5, grid_size, grid_size)
         # box centers
@@ -179,6 +179,7 @@ class Darknet(nn.Module):
 
     def forward(self, x, cuda):
         blocks = self.blocks[1:]
+        input_dim = x.size(3) # any multiple of 32, not only the cfg width
         outputs = []
         detections = torch.tensor([], dtype=torch.float)
         detections = Variable(detections)
@@ -193,7 +194,7 @@ class Darknet(nn.Module):
             elif block_type == 'route':
                 x = module(outputs)
             elif block_type == 'yolo':
-                x = module(x, cuda)
+                x = module(x, cuda, input_dim)
                 detections = torch.cat((x, detections), dim=1)
 
             outputs.append(x)
@@ -0,0 +1,90 @@
+import collections
+import threading
+import time
+
+#
+# One received frame and everything the dequeue loops need about it, so
+# that a frame is queued and taken in one operation (the fields used to
+# live in parallel queues that had to be kept in lockstep).
+#
+class FrameRecord(object):
+    __slots__ = ('device_name', 'framecnt', 'type', 'frame', 'timer', 'coordinates', 'arrival', 'original')
+
+    def __init__(self, device_name, framecnt, type, frame, timer, coordinates=None, original=None):
+        self.device_name = device_name
+        self.framecnt = int(framecnt)
+        self.type = type
+        self.frame = frame
+        self.timer = timer # receive time, in whatever form the controller logs it
+        self.coordinates = coordinates
+        self.arrival = time.time()
+        self.original = original # (height, width) the camera letterboxed 'frame' from, or None
+
+
+#
+# Bounded FIFO of FrameRecords for one device.
+# - when full, put() drops the oldest record instead of blocking the
+#   receiving thread
+# - get() skips records that waited longer than max_age seconds (0: keep
+#   all), since a stale frame is of no use to the tracker
+# get() never blocks unless a timeout is given; it returns None when
+# there is no fresh record.
+#
+class FrameQueue(object):
+    def __init__(self, maxsize=2000, max_age=0):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.records = collections.deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.dropped_full = 0
+        self.dropped_stale = 0
+
+    def put(self, record):
+        with self.cond:
+            if len(self.records) >= self.maxsize:
+                self.records.popleft()
+                self.dropped_full += 1
+            self.records.append(record)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+                while not self.records:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            if self.max_age > 0:
+                oldest = time.time() - self.max_age
+                while self.records and self.records[0].arrival < oldest:
+                    self.records.popleft()
+                    self.dropped_stale += 1
+            if not self.records:
+                return None
+            return self.records.popleft()
+
+    #
+    # Blocks until a record is queued or 'timeout' seconds passed, without
+    # taking it. Returns whether one is there.
+    #
+    def wait(self, timeout):
+        with self.cond:
+            if not self.records:
+                self.cond.wait(timeout)
+            return bool(self.records)
+
+    def peek(self):
+        with self.cond:
+            return self.records[0] if self.records else None
+
+    def qsize(self):
+        return len(self.records)
+
+    def empty(self):
+        return not self.records
+
+    def stats(self):
+        with self.cond:
+            return {'depth': len(self.records), 'dropped_full': self.dropped_full, 'dropped_stale': self.dropped_stale}
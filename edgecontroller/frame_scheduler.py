@@ -0,0 +1,91 @@
+import threading
+import time
+
+#
+# Decides which device queue the controller loops serve next, and lets
+# them sleep until a frame arrives instead of polling.
+#
+# 'queues' is the controller's device name -> FrameQueue dict (shared,
+# new devices show up in it as they join); every put() must be followed
+# by notify(). A policy orders the devices for one scan:
+# - round_robin: every device in turn, starting after the one served first
+#   in the previous scan
+# - target_first: the device that has the target, then the others
+# - oldest_first: by the age of the frame at the head of each queue
+#
+class FrameScheduler(object):
+    def __init__(self, queues, policy='target_first'):
+        if policy not in POLICIES:
+            raise ValueError('unknown scheduling policy {}'.format(policy))
+        self.queues = queues
+        self.policy = policy
+        self.cond = threading.Condition(threading.Lock())
+        self.next_rr = 0
+        self.wakeups = 0
+        self.idle_time = 0.0
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def ready(self, devices=None):
+        for device in (list(self.queues) if devices is None else devices):
+            q = self.queues.get(device)
+            if q is not None and not q.empty():
+                return True
+        return False
+
+    #
+    # Blocks until one of 'devices' (default: any) has a frame queued, or
+    # 'timeout' seconds passed. Returns whether a frame is there.
+    #
+    def wait(self, timeout, devices=None):
+        with self.cond:
+            if self.ready(devices):
+                return True
+            s = time.time()
+            deadline = s + timeout
+            while not self.ready(devices):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            self.wakeups += 1
+            self.idle_time += time.time() - s
+            return self.ready(devices)
+
+    def order(self, target=None):
+        return POLICIES[self.policy](self, list(self.queues.keys()), target)
+
+    def stats(self):
+        return {'policy': self.policy, 'wakeups': self.wakeups, 'idle_time': self.idle_time}
+
+
+def round_robin(scheduler, devices, target):
+    if not devices:
+        return devices
+    start = scheduler.next_rr % len(devices)
+    scheduler.next_rr = start + 1
+    return devices[start:] + devices[:start]
+
+
+def target_first(scheduler, devices, target):
+    if target in devices:
+        devices.remove(target)
+        devices.insert(0, target)
+    return devices
+
+
+def oldest_first(scheduler, devices, target):
+    def head_arrival(device):
+        q = scheduler.queues.get(device)
+        head = q.peek() if q is not None else None
+        return head.arrival if head is not None else float('inf')
+    return sorted(devices, key=head_arrival)
+
+
+POLICIES = {
+    'round_robin': round_robin,
+    'target_first': target_first,
+    'oldest_first': oldest_first,
+}
@@ -4,29 +4,35 @@ import os
 import sys
 sys.path.insert(0, '../messaging')
 from message_bus import MessageBus
-from datetime import datetime
-from util import process_result, load_images, resize_image, cv_image2tensor, transform_result
-import base64
+from flow_control import CreditManager
+from batch_detector import BatchDetector
+from inference_backend import load_backend, BACKENDS
+from weight_cache import load_model, StartupTimer
+from model_server import ModelClient
+from frame_queue import FrameRecord, FrameQueue
+from frame_scheduler import FrameScheduler, POLICIES
+from letterbox import restore_image, config_message
+from roi_detector import RoiDetector
+from detection_interval import DetectionInterval, centroid_speeds, near_boundary
+from tracker_stage import TrackerStage, BACKENDS as TRACKER_BACKENDS
+from target_table import TargetTable
+from datetime import timedelta
 import random
 import cv2
 import numpy as np
 import signal
 import imutils
 import psutil
-import queue
 import threading
 import time
 import torch
 import requests
 import json
-from torch.autograd import Variable
 from darknet import Darknet
 import pickle as pkl
 import math
-import ntplib
 import trackableobject
 import centroidtracker
-import dlib
 
 def threaded(fn):
     def wrapper(*args, **kwargs):
@@ -36,14 +42,17 @@ def threaded(fn):
     return wrapper
 
 class Controller(object):
-    def __init__(self, name, port):
-        self.msg_bus = MessageBus(name, port, 'controller')
+    def __init__(self, name, port, decode_procs=0):
+        self.msg_bus = MessageBus(name, port, 'controller', decode_procs=decode_procs)
+        self.msg_bus.start_broadcaster() # device_list and control_op fan-out
         self.msg_bus.register_callback('join', self.handle_message)
         self.msg_bus.register_callback('img_e1-1', self.handle_message)
         self.msg_bus.register_callback('img_e1-2', self.handle_message)
         self.msg_bus.register_callback('img_e2', self.handle_message)
         self.msg_bus.register_callback('img_p', self.handle_message)
         self.msg_bus.register_callback('control_op', self.handle_message)
+        self.credits = CreditManager() # send credits granted to each camera
+        self.msg_bus.set_credit_provider(self.grant_credit)
         self.model = None
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -65,6 +74,16 @@ class Controller(object):
         self.input_size = None
         self.confidence = None
         self.nms_thresh = None
+        self.detector = None # BatchDetector, set up with the model
+        self.model_server = None # address of a model_server.py to detect through instead of a local model
+        self.keep_classes = None # class indices kept by nms (set up with the classes)
+        self.backend = 'torch' # detector runtime, see inference_backend.py
+        self.threads = 0 # intra-op threads of the runtime (0: its default)
+        self.max_batch = 8 # frames per forward pass
+        self.max_wait = 0.005 # seconds to wait for other cameras to fill a batch
+        self.roi = None # RoiDetector for the re-detections while tracking
+        self.roi_size = 0 # detector input size of the re-detection region (0: full frame every time)
+        self.roi_margin = 0.5 # region margin around the tracked boxes, fraction of their size
         self.net = None # load caffe model
         self.framecnt = 0
         self.gettimegap()
@@ -73,25 +92,28 @@ class Controller(object):
         self.trackingscheme = None
         self.encode_param = None
         self.q_list = {} # this tracks which devices are sending frames.
-        self.d_cam = {} # xxxxx copy version of dd_cam
-        self.dd_cam = {} # this tells if a camera queue is empty or not
         self.exist = {} # this tells which device the tracking object is in
         self.d_list =[] # this tracks the name of sent devices. 
         self.numberofcameras = 0
         self.totalrecbytes = 0
+        self.letterbox_types = set() # frame message types the cameras letterbox to the detector input while searching
+        self.advertised = {} # device name -> letterbox policy last sent to it
         self.cur_tar_dev = None # tells which device has the target currently.
+        self.targets = TargetTable() # the targets of the multi-target mode (-tr mt)
+        self.camera_on = {} # device name -> whether it was last told to send (mt)
 
-        self.imgq ={}
-        self.timerq = {}
-        self.framecntq ={}
-        self.dev_nameq ={}
-        self.typeq = {}
-        self.coorq = {} 
+        self.frameq = {} # device name -> FrameQueue of its FrameRecords
+        self.frameq_lock = threading.Lock() # creating a device's queue
+        self.scheduler = FrameScheduler(self.frameq) # wakes the dequeue loops, picks the next queue
+        self.max_age = 2.0 # frames older than this (s) are dropped at dequeue (0: keep all)
 
         # tracking related 
         self.ct = centroidtracker.CentroidTracker(20, maxDistance =50, queuesize = 10)
         self.frame_skips = None # how many frames should be skipped before detection 
+        self.interval_bounds = None # (min, max) frames between re-detections while tracking (None: every frame_skips)
+        self.intervals = {} # device name -> DetectionInterval
         self.trackers = []
+        self.tracker_stage = TrackerStage() # starts and updates the trackers, see tracker_stage.py
         self.trobs = {}
         self.boundary ={}
         self.objstatus ={}
@@ -103,15 +125,31 @@ class Controller(object):
         self.frame_skip = 10
         self.sumofframebytes = 0
 
+    #
+    # The controller is the time reference: cameras follow its clock
+    # through the clock server instead of asking an NTP host once.
+    #
     def gettimegap(self): # this is for self.timegap
-        starttime = datetime.now()
-        #ntp_response = ntplib.NTPClient().request('2.kr.pool.ntp.org', version=3)
-        ntp_response = ntplib.NTPClient().request('143.248.55.71', version=3)
-        returntime = datetime.now()
-        self.timegap = datetime.fromtimestamp(ntp_response.tx_time) - starttime - (returntime - starttime) / 2
+        self.timegap = timedelta()
+        self.msg_bus.start_clock_server()
 
 
     def signal_handler(self, sig, frame):
+        self.msg_bus.stop_recording()
+        if self.detector is not None:
+            print('[Controller] detection batches: ', self.detector.stats())
+        if self.roi is not None:
+            print('[Controller] re-detections: ', self.roi.stats())
+        if len(self.targets) or self.targets.created:
+            print('[Controller] targets: ', self.targets.stats())
+        for device_name, interval in list(self.intervals.items()):
+            print('[Controller] detection interval', device_name, interval.stats())
+        print('[Controller] scheduler: ', self.scheduler.stats())
+        for device_name, q in list(self.frameq.items()):
+            print('[Controller] frame queue', device_name, q.stats())
+        if self.msg_bus.decoder is not None:
+            print('[Controller] decode workers: ', self.msg_bus.decode_stats())
+            self.msg_bus.decoder.close()
         self.msg_bus.ctx.destroy()
         self.logfile1.close()
         self.logfile2.close()
@@ -155,107 +193,197 @@ class Controller(object):
             pass
 
     def handle_join(self, msg_dict):
-        node_table = self.msg_bus.node_table
-        node_table.add_entry(msg_dict['device_name'], msg_dict['ip'], int(msg_dict['port']), msg_dict['location'], msg_dict['capability'])
+        # full device_list back to the new node, a delta to everybody else
+        self.msg_bus.add_joined_node(msg_dict)
         print('@@Table: ', self.msg_bus.node_table.table)
+        self.send_detector_config(msg_dict['device_name'])
+
+    #
+    # The device that has the target (every device with a target in the
+    # multi-target mode) sends full frames, since its trackers need them;
+    # the others letterbox the types in letterbox_types to the
+    # detector input size (see letterbox.py), which is all the search
+    # phase needs. The loops also set cur_tar_dev to None or 'wow'.
+    #
+    @property
+    def cur_tar_dev(self):
+        return self.target_device
+
+    @cur_tar_dev.setter
+    def cur_tar_dev(self, device_name):
+        previous = getattr(self, 'target_device', None)
+        self.target_device = device_name
+        if device_name != previous and self.letterbox_types:
+            self.send_detector_config(previous)
+            self.send_detector_config(device_name)
+
+    def send_detector_config(self, device_name):
+        if not self.letterbox_types or self.input_size is None or device_name not in self.msg_bus.node_table.get_names():
+            return
+        mode = 'full' if device_name == self.target_device or device_name in self.targets.tracked_devices() else 'letterbox'
+        policy = {msg_type: mode for msg_type in sorted(self.letterbox_types)}
+        if self.advertised.get(device_name) != policy:
+            self.advertised[device_name] = policy
+            self.msg_bus.broadcast_detector_config(device_name, config_message(self.input_size, policy))
+
+    def advertise_detector(self):
+        for device_name in self.msg_bus.node_table.get_names():
+            self.send_detector_config(device_name)
+
+    #
+    # A frame letterboxed by the camera for another input size (e.g. sent
+    # before the detector changed) is restored to the camera's size.
+    #
+    def received_frame(self, msg_dict):
+        decimg = self.msg_bus.decode(msg_dict)
+        original = msg_dict.get('original')
+        if original is not None and decimg is not None and (self.input_size is None or list(decimg.shape[0:2]) != list(self.input_size)):
+            return restore_image(decimg, original), None
+        return decimg, original
+
+    #
+    # The frame of a record in the camera's coordinates, restored from the
+    # letterboxed canvas if the camera sent one.
+    #
+    def full_frame(self, record):
+        if record.original is None:
+            return record.frame
+        return restore_image(record.frame, record.original)
+
+    #
+    # Boxes (x1, y1, x2, y2) of the tracked targets for a re-detection:
+    # where the trackers last saw them, and the same boxes moved by the
+    # displacement CentroidTracker.predict expects for the next frame
+    # (from the nearest tracked centroid).
+    #
+    def tracked_boxes(self):
+        boxes = []
+        centroids = [(objectID, centroid) for objectID, centroid in list(self.ct.objects.items())
+                     if objectID in self.ct.lqx and not self.ct.lqx[objectID].is_empty()]
+        for tracker in self.trackers:
+            box = tracker.position()
+            boxes.append(box)
+            if len(centroids) == 0:
+                continue
+            cx, cy = (box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0
+            objectID, centroid = min(centroids, key=lambda c: (c[1][0] - cx) ** 2 + (c[1][1] - cy) ** 2)
+            prex, prey = self.ct.predict(objectID, 1)
+            dx, dy = prex - centroid[0], prey - centroid[1]
+            boxes.append((box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy))
+        return boxes
+
+    #
+    # Per device: when the next re-detection is due while tracking (see
+    # detection_interval.py). Without interval bounds, every frame_skips
+    # frames as before.
+    #
+    def detection_interval(self, device_name):
+        if device_name not in self.intervals:
+            bounds = self.interval_bounds or (self.frame_skips, self.frame_skips)
+            self.intervals[device_name] = DetectionInterval(bounds[0], bounds[1], self.frame_skips)
+        return self.intervals[device_name]
+
+    def observe_tracking(self, device_name, psrs, shape):
+        near = dict((objectID, near_boundary(centroid, shape, self.framethr)) for objectID, centroid in list(self.ct.objects.items()))
+        self.detection_interval(device_name).observe(psrs, centroid_speeds(self.ct), near)
+
+    #
+    # The periodic re-detection while tracking: in the region of the
+    # tracked boxes when it can be (see roi_detector.py), the full frame
+    # otherwise. The cost against a full-frame pass goes to logfile3.
+    #
+    def redetect(self, device_name, counter, frame, boxes):
+        self.detection_interval(device_name).detected(counter)
+        s = time.time()
+        detections, mode, cost = self.roi.detect(frame, boxes)
+        elapsed = time.time() - s
+        print("[Controller] re-detection on {} ({}): {:.2f} of a full frame, saved {:.2f}".format(device_name, mode, cost, 1.0 - cost))
+        self.logfile3.write("redetect\t"+str(counter)+"\t"+device_name+"\t"+mode+"\t"+str(cost)+"\t"+str(1.0 - cost)+"\t"+str(elapsed)+"\n")
+        return detections
+
+    def handle_evict(self, device_names):
+        print('[Controller] lost devices: ', device_names)
+        if self.cur_tar_dev in device_names:
+            self.cur_tar_dev = None
+
+    #
+    # Handoff helpers on top of the node table (neighbours are declared by
+    # the cameras when they join), instead of hard-coded camera names.
+    #
+    def stop_other_devices(self, device_name):
+        op_json = {"type": "control_op", "onoff": "False"}
+        for other in self.msg_bus.node_table.get_names():
+            if other != device_name:
+                print("[FOUND!] telling {} to STOP sending".format(other))
+                self.msg_bus.broadcast_control_op(other, op_json)
+
+    def start_neighbor(self, device_name, direction):
+        neighbor = self.msg_bus.node_table.get_neighbor(device_name, direction)
+        if neighbor is None:
+            print("[--tracking phase: no {} neighbor of {}".format(direction, device_name))
+            return
+        op_json = {"type": "control_op", "onoff": "True"}
+        print("[--tracking phase: telling {} to start sending".format(neighbor.device_name))
+        self.msg_bus.broadcast_control_op(neighbor.device_name, op_json)
+
+
+    #
+    # Called by the message bus for every frame it acks: how many more
+    # frames the camera may send, given the backlog of its image queue
+    # and the frames not decoded yet.
+    #
+    def grant_credit(self, device_name, backlog):
+        depth = self.frameq[device_name].qsize() if device_name in self.frameq else 0
+        return self.credits.grant(device_name, depth, backlog)
+
+    #
+    # Returns the best person score of a detection pass to the camera that
+    # sent the frame, so its adaptive encoder keeps the quality up while
+    # the detector is unsure.
+    #
+    def report_confidence(self, device_name, detections):
+        best = 0.0
+        for detection in detections:
+            if self.classes[int(detection[-1])] == "person":
+                best = max(best, float(detection[6]))
+        if best > 0.0:
+            self.msg_bus.set_feedback(device_name, best)
+
+    #
+    # Queues a received frame on its device's FrameQueue, creating the
+    # queue on the first frame of a device. process_raw_tracking runs in
+    # many threads at once, so the queue is created under a lock.
+    #
+    def enqueue_frame(self, record):
+        device_name = record.device_name
+        if device_name not in self.frameq:
+            with self.frameq_lock:
+                if device_name not in self.frameq:
+                    self.frameq[device_name] = FrameQueue(2000, self.max_age)
+                    self.d_list.append(device_name)
+                    self.numberofcameras+=1
+        self.frameq[device_name].put(record)
+        self.scheduler.notify()
+        self.credits.on_enqueue(device_name)
 
-        # Send node_table
-        device_list_json = {"type": "device_list", "devices": self.msg_bus.node_table.get_list_str()}
-        for node_name in node_table.table.keys():
-            node_info = node_table.table[node_name]
-            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), device_list_json)
-
-
-    @threaded
     def process_e2(self, msg_dict): # this goes with e2
 #        print(' - tracking image')
-        decstr = base64.b64decode(msg_dict['img_string'])
-        imgarray = np.fromstring(decstr, dtype=np.uint8)
-        decimg = cv2.imdecode(imgarray, cv2.IMREAD_COLOR)
-        localNow = datetime.utcnow()+self.timegap
-
-        # use this for transmission time btw device n edge server
-        curTime = datetime.utcnow().strftime('%H:%M:%S.%f') # string forma
-        curdatetime = datetime.strptime(curTime, '%H:%M:%S.%f')
-        sentdatetime = datetime.strptime(msg_dict['time'], '%H:%M:%S.%f')
-        print("senttime:", sentdatetime)
-        print("curtime:", time.time())
-        print("fly time:", time.time() - time.mktime(sentdatetime.timetuple()))
+        decimg, original = self.received_frame(msg_dict)
+        # transmission time btw device n edge server is in self.msg_bus.get_message_stats()
         simplecurtime = time.time()
 
-        if(msg_dict['device_name'] in self.dd_cam.keys()): # depending on the sent device, add them to the corresonding queue.
-            self.typeq[msg_dict['device_name']].put(str(msg_dict['type']))
-            self.imgq[msg_dict['device_name']].put(decimg)
-            self.timerq[msg_dict['device_name']].put(simplecurtime)
-            self.framecntq[msg_dict['device_name']].put(str(msg_dict['framecnt']))
-            self.dev_nameq[msg_dict['device_name']].put(str(msg_dict['device_name']))
-            self.coorq[msg_dict['device_name']].put(msg_dict['coordinates'])
-            self.dd_cam[msg_dict['device_name']] = 'notempty'
-        else:
-            self.typeq[msg_dict['device_name']] = queue.Queue(2000)
-            self.imgq[msg_dict['device_name']] = queue.Queue(2000)
-            self.timerq[msg_dict['device_name']] = queue.Queue(2000)
-            self.framecntq[msg_dict['device_name']] = queue.Queue(2000)
-            self.dev_nameq[msg_dict['device_name']] = queue.Queue(2000)
-            self.coorq[msg_dict['device_name']] = queue.Queue(2000)
-
-            self.typeq[msg_dict['device_name']].put(str(msg_dict['type']))
-            self.imgq[msg_dict['device_name']].put(decimg)
-            self.timerq[msg_dict['device_name']].put(simplecurtime)
-            self.framecntq[msg_dict['device_name']].put(str(msg_dict['framecnt']))
-            self.dev_nameq[msg_dict['device_name']].put(str(msg_dict['device_name']))
-            self.coorq[msg_dict['device_name']].put(msg_dict['coordinates'])
-
-            self.d_list.append(msg_dict['device_name'])
-            self.dd_cam[msg_dict['device_name']] = 'notempty'
-            self.numberofcameras+=1
-        self.d_cam = {k : v for k, v in self.dd_cam.items()}
+        self.enqueue_frame(FrameRecord(msg_dict['device_name'], msg_dict['framecnt'], str(msg_dict['type']), decimg, simplecurtime, msg_dict['coordinates'], original))
         self.totalrecbytes += sys.getsizeof(decimg)
         self.logfile4.write(str(self.totalrecbytes / 1000000) + "\n")
 
 
-    @threaded
     def process_raw_tracking(self, msg_dict): # this goes with e1-1, e1-2
 #        print(' - tracking image')
-        decstr = base64.b64decode(msg_dict['img_string'])
-        imgarray = np.fromstring(decstr, dtype=np.uint8)
-        decimg = cv2.imdecode(imgarray, cv2.IMREAD_COLOR)
-        localNow = datetime.utcnow()+self.timegap
-
-        # use this for transmission time btw device n edge server
-        curTime = datetime.utcnow().strftime('%H:%M:%S.%f') # string forma
-        curdatetime = datetime.strptime(curTime, '%H:%M:%S.%f')
-        sentdatetime = datetime.strptime(msg_dict['time'], '%H:%M:%S.%f')
-        print("senttime:", sentdatetime)
-        print("curtime:", curdatetime)
-        print("fly time:", curdatetime - sentdatetime)
-
+        decimg, original = self.received_frame(msg_dict)
+        # transmission time btw device n edge server is in self.msg_bus.get_message_stats()
         simplecurtime = time.time()
 
-        if(msg_dict['device_name'] in self.dd_cam.keys()): # depending on the sent device, add them to the corresonding queue.
-            self.typeq[msg_dict['device_name']].put(str(msg_dict['type']))
-            self.imgq[msg_dict['device_name']].put(decimg)
-            self.timerq[msg_dict['device_name']].put(simplecurtime)
-            self.framecntq[msg_dict['device_name']].put(str(msg_dict['framecnt']))
-            self.dev_nameq[msg_dict['device_name']].put(str(msg_dict['device_name']))
-            self.dd_cam[msg_dict['device_name']] = 'notempty'
-        else:
-            self.typeq[msg_dict['device_name']] = queue.Queue(2000)
-            self.imgq[msg_dict['device_name']] = queue.Queue(2000)
-            self.timerq[msg_dict['device_name']] = queue.Queue(2000)
-            self.framecntq[msg_dict['device_name']] = queue.Queue(2000)
-            self.dev_nameq[msg_dict['device_name']] = queue.Queue(2000)
-
-            self.typeq[msg_dict['device_name']].put(str(msg_dict['type']))
-            self.imgq[msg_dict['device_name']].put(decimg)
-            self.timerq[msg_dict['device_name']].put(simplecurtime)
-            self.framecntq[msg_dict['device_name']].put(str(msg_dict['framecnt']))
-            self.dev_nameq[msg_dict['device_name']].put(str(msg_dict['device_name']))
-
-            self.d_list.append(msg_dict['device_name'])
-            self.dd_cam[msg_dict['device_name']] = 'notempty'
-            self.numberofcameras+=1
-        self.d_cam = {k : v for k, v in self.dd_cam.items()}
+        self.enqueue_frame(FrameRecord(msg_dict['device_name'], msg_dict['framecnt'], str(msg_dict['type']), decimg, simplecurtime, original=original))
         self.totalrecbytes += sys.getsizeof(decimg)
         self.logfile4.write(str(self.totalrecbytes / 1000000) + "\n")
 
@@ -348,15 +476,53 @@ class Controller(object):
             return "CALM"
 
     def isitempty(self):
-        full = 0
-        for key, value in self.d_cam.items():
-#            print(key, value)
-            if (value == 'empty'):
-                full +=1
-        if full == self.numberofcameras: # if this matches, it means its not empty
-            return True 
+        return not self.scheduler.ready()
+
+    #
+    # The next frame of every camera that has one (up to max_batch),
+    # waiting at most max_wait for the other cameras.
+    #
+    def take_batch(self):
+        batch = []
+        taken = set()
+        deadline = time.time() + self.max_wait
+        while True:
+            for i in self.scheduler.order(self.cur_tar_dev):
+                if i in taken or len(batch) >= self.max_batch:
+                    continue
+                record = self.frameq[i].get()
+                if record is None:
+                    continue
+                batch.append(record)
+                taken.add(i)
+            others = [i for i in list(self.frameq) if i not in taken]
+            if len(batch) >= self.max_batch or not others or not self.scheduler.wait(deadline - time.time(), others):
+                break
+        return batch
+
+    #
+    # Search phase: detects a take_batch in one forward pass. Boxes are in
+    # the cameras' coordinates; a letterboxed frame is restored to the
+    # camera's size only if it has a person a tracker may be started on.
+    # Returns [(device_name, framecnt, frame, timer, detections, start)].
+    #
+    def search_batch(self):
+        s = time.time()
+        batch = self.take_batch()
+        if len(batch) == 0:
+            return []
+        print("[finding..] detecting a batch of", len(batch), [r.device_name for r in batch])
+        if self.cuda:
+            results = self.detector.detect([r.frame for r in batch], originals=[r.original for r in batch])
         else:
-            return False
+            results = [[] for r in batch]
+        found = []
+        for r, detections in zip(batch, results):
+            frame = r.frame
+            if r.original is not None and any(float(d[6]) > self.confidence for d in detections):
+                frame = restore_image(r.frame, r.original)
+            found.append((r.device_name, r.framecnt, frame, r.timer, detections, s))
+        return found
 
 # e1 - GROUNDTRUTH
 
@@ -368,63 +534,36 @@ class Controller(object):
         while (True):
             if(self.isitempty()): # yes its empty...
                 print("[q all empty] waiting...")
-                time.sleep(0.5)
-
-            else: # not all q are empty... loop all queues until the target is found. 
-                for i in self.d_cam.keys():
-                    if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                        self.d_cam[i]='empty'
-                        print("[finding..] "+ i +" q is empty, moving on to next q") 
-                        time.sleep(0.001) 
-                        continue
-#                        pass
-                    else: 
-                        print("[ verifying...] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-                        s = time.time()
-                        self.d_cam[i] = 'notempty'
-                        cdevice_name = self.dev_nameq[i].get()
-                        ccounter = int(self.framecntq[i].get())
-                        cframe = self.imgq[i].get()
-                        ctype = self.typeq[i].get()
-                        ctimer = self.timerq[i].get()
-
-                        crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
-
-                        if self.cuda:
-                            width = cframe.shape[0]
-                            height = cframe.shape[1]
+                self.scheduler.wait(0.5)
 
-                            frame_tensor = cv_image2tensor(cframe, self.input_size).unsqueeze(0)
-                            frame_tensor = Variable(frame_tensor)
-                    
-                            frame_tensor = frame_tensor.cuda()
+            else: # not all q are empty... detect the next frame of every queue in one batch.
+                for cdevice_name, ccounter, cframe, ctimer, detections, s in self.search_batch():
+                    crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
 
-                            detections = self.model(frame_tensor, self.cuda).cpu()
-                            detections = process_result(detections, self.confidence, self.nms_thresh)
-                            if len(detections) != 0:
-                                detections = transform_result(detections, [cframe], self.input_size)
-                                #for detection in detections:
-                                for idx, detection in enumerate(detections):
-                                    if (self.classes[int(detection[-1])]=="person"):
-                                        if float(detection[6]) > self.confidence:
-                                            print("-- [target found ] person on device: ", cdevice_name, ccounter) # 
-                                            found = 1
+                    if self.cuda:
+                        if len(detections) != 0:
+                            #for detection in detections:
+                            for idx, detection in enumerate(detections):
+                                if (self.classes[int(detection[-1])]=="person"):
+                                    if float(detection[6]) > self.confidence:
+                                        print("-- [target found ] person on device: ", cdevice_name, ccounter) # 
+                                        found = 1
 
-                                        else:
-                                            found = 0
                                     else:
                                         found = 0
-                            else:
-                                found=0
-                        # log here.
-                        time_now = time.time()
-                        inf_time = time_now - s
-                        if cdevice_name == "camera01": # if its from cam1
-                            self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + str(found) + "\t" + str(inf_time)+"\n")
-                        elif cdevice_name == "camera02": # if its from cam2
-                            self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + str(found) + "\t" + str(inf_time)+"\n")
-#                        else : # other (say cam 3)
-#                            self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + str(found) + "\t" + str(inf_time)+"\n")
+                                else:
+                                    found = 0
+                        else:
+                            found=0
+                    # log here.
+                    time_now = time.time()
+                    inf_time = time_now - s
+                    if cdevice_name == "camera01": # if its from cam1
+                        self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + str(found) + "\t" + str(inf_time)+"\n")
+                    elif cdevice_name == "camera02": # if its from cam2
+                        self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + str(found) + "\t" + str(inf_time)+"\n")
+#                    else : # other (say cam 3)
+#                        self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + str(found) + "\t" + str(inf_time)+"\n")
                                              
 
 
@@ -442,126 +581,89 @@ class Controller(object):
                 print('nothing in all q, sleeping..')
                 if self.cur_tar_dev == "wow":
                     self.cur_tar_dev = None
-                time.sleep(0.5)
+                self.scheduler.wait(0.5)
                 endcnt += 1
 
             else: # not all q are empty... loop all queues until the target is found. 
                 while(self.cur_tar_dev==None):
-                    for i in self.d_cam.keys():
-                        if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                            self.d_cam[i]='empty'
-                            print("[finding..] "+ i +" q is empty, moving on to next q") 
-                            time.sleep(0.001) 
-#                            continue
-                            pass
-                        else:
-                            print("[finding..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-                            # it does not skip, u just didn't catch if its not human or low threshold... dumb f... 
-                            self.d_cam[i] = 'notempty'
-                            cdevice_name = self.dev_nameq[i].get()
-                            ccounter = int(self.framecntq[i].get())
-                            cframe = self.imgq[i].get()
-                            ctype = self.typeq[i].get()
-                            ctimer = self.timerq[i].get()
-                            s = time.time()
-                            if self.cuda:
-                                width = cframe.shape[0]
-                                height = cframe.shape[1]
-                                crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
-    
-                                frame_tensor = cv_image2tensor(cframe, self.input_size).unsqueeze(0)
-                                frame_tensor = Variable(frame_tensor)
-
-                                frame_tensor = frame_tensor.cuda()
-
-                                detections = self.model(frame_tensor, self.cuda).cpu()
-                                detections = process_result(detections, self.confidence, self.nms_thresh)
-                            
-                                if len(detections) != 0:
-                                    detections = transform_result(detections, [cframe], self.input_size)
-                                    #for detection in detections:
-                                    for idx, detection in enumerate(detections):
-                                        if (self.classes[int(detection[-1])]=="person"):
-                                            if float(detection[6]) > self.confidence:
-                                                print("-[searching phase] FOUND person on device: ",ccounter, cdevice_name) # well u r supposed to match the person detect with the template, but for the time being we assume its a person. # sangwoo is on it thou
-                                                pre_score = (float(detection[6])) # prediction score
-                                                pre_class = (self.classes[int(detection[-1])]) # prediction class
-                                                pre_x1 = (int(detection[1])) # x1
-                                                pre_y1 = (int(detection[2])) # y1
-                                                pre_x2 = (int(detection[3])) # x2 
-                                                pre_y2 = (int(detection[4])) # y2
+                    for cdevice_name, ccounter, cframe, ctimer, detections, s in self.search_batch():
+                        # it does not skip, u just didn't catch if its not human or low threshold... dumb f... 
+                        if self.cuda:
+                            crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
 
-                                                #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                                tracker = dlib.correlation_tracker()
-                                                rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                                tracker.start_track(crgb, rect)
-                                                self.trackers.append(tracker)
-                                                self.cur_tar_dev = cdevice_name
-                                                break
-                                            else:
-                                                print("[finding..] low confidence person", ccounter, cdevice_name)
-                                        else: 
-                                            print("[finding..] not a person", ccounter, cdevice_name)
+                            if len(detections) != 0:
+                                self.report_confidence(cdevice_name, detections)
+                                #for detection in detections:
+                                for idx, detection in enumerate(detections):
+                                    if (self.classes[int(detection[-1])]=="person"):
+                                        if float(detection[6]) > self.confidence:
+                                            print("-[searching phase] FOUND person on device: ",ccounter, cdevice_name) # well u r supposed to match the person detect with the template, but for the time being we assume its a person. # sangwoo is on it thou
+                                            pre_score = (float(detection[6])) # prediction score
+                                            pre_class = (self.classes[int(detection[-1])]) # prediction class
+                                            pre_x1 = (int(detection[1])) # x1
+                                            pre_y1 = (int(detection[2])) # y1
+                                            pre_x2 = (int(detection[3])) # x2 
+                                            pre_y2 = (int(detection[4])) # y2
 
-                                else:
-                                    print("[finding..] nothing detected: ", ccounter, cdevice_name)
-                            time_now = time.time()
-                            inf_time = time_now - s
-                            if cdevice_name == "camera01":
-                                if self.cur_tar_dev == "camera01": # if this device found the target
-                                    self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
-                                else:
-                                    self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
-                            elif cdevice_name == "camera02":
-                                if self.cur_tar_dev == "camera02":
-                                    self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
-                                else:
-                                    self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+                                            #self.draw_bbox([frame], detection, self.colors, self.classes)
+                                            self.trackers.append(self.tracker_stage.start(crgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
+                                            self.detection_interval(cdevice_name).detected(ccounter)
+                                            self.cur_tar_dev = cdevice_name
+                                            break
+                                        else:
+                                            print("[finding..] low confidence person", ccounter, cdevice_name)
+                                    else: 
+                                        print("[finding..] not a person", ccounter, cdevice_name)
 
-                        if self.isitempty(): # won't fall into unless there is a pass code above...
-                            print('[finding..] still at search phase, all q empty, go back to waiting phase')
-                            self.cur_tar_dev = 'wow' # a random txt to escape this loop
-                        
-                            break
+                            else:
+                                print("[finding..] nothing detected: ", ccounter, cdevice_name)
+                        time_now = time.time()
+                        inf_time = time_now - s
+                        if cdevice_name == "camera01":
+                            if self.cur_tar_dev == "camera01": # if this device found the target
+                                self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
+                            else:
+                                self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+                        elif cdevice_name == "camera02":
+                            if self.cur_tar_dev == "camera02":
+                                self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
+                            else:
+                                self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+
+                    if self.isitempty(): # won't fall into unless there is a pass code above...
+                        print('[finding..] still at search phase, all q empty, go back to waiting phase')
+                        self.cur_tar_dev = 'wow' # a random txt to escape this loop
+                    
 
-                for i in self.d_cam.keys(): # target found phase.
+                for i in self.scheduler.order(self.cur_tar_dev): # target found phase.
 
                     if self.isitempty(): # to check if both are empty.
                         print('[target found phase..] break from searching phase, all q empty, go back to waiting phase')
-                        self.d_cam[i] = 'empty' 
                         break
-                    if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                        self.d_cam[i]='empty'
+                    record = self.frameq[i].get()
+                    if record is None: # if i'th queue is empty, skip this queue stak. check other camera queue stack.
                         print("[target found phase....] "+ i +" q is empty, moving on to next q") 
                         continue
                     else: # there is smth here 
-                        print("[target_found_phase..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-                        self.d_cam[i] = 'notempty' 
-                        ftype = self.typeq[i].get()
-                        fdevice_name = self.dev_nameq[i].get()
-                        fcounter = self.framecntq[i].get()
-                        ftimer = self.timerq[i].get()
-                        fframe = self.imgq[i].get()
+                        print("[target_found_phase..] ", i, self.frameq[i].qsize())
+                        ftype = record.type
+                        fdevice_name = record.device_name
+                        fcounter = record.framecnt
+                        ftimer = record.timer
+                        fframe = self.full_frame(record)
                         rgb = cv2.cvtColor(fframe, cv2.COLOR_BGR2RGB)
                         fpositions=[]
                         fs = time.time()
                         if fdevice_name == self.cur_tar_dev:
-                            if(int(fcounter) % self.frame_skips == 0):
+                            if self.detection_interval(fdevice_name).due(fcounter):
+                                boxes = self.tracked_boxes()
                                 self.trackers=[]
                                 if self.cuda:
                                     width = fframe.shape[0]
                                     height = fframe.shape[1]
 
-                                    frame_tensor = cv_image2tensor(fframe, self.input_size).unsqueeze(0)
-                                    frame_tensor = Variable(frame_tensor)
-
-                                    if self.cuda:
-                                        frame_tensor = frame_tensor.cuda()
-
-                                    detections = self.model(frame_tensor, self.cuda).cpu()
-                                    detections = process_result(detections, self.confidence, self.nms_thresh)
+                                    detections = self.redetect(fdevice_name, fcounter, fframe, boxes)
                                     if len(detections) != 0:
-                                        detections = transform_result(detections, [fframe], self.input_size)
                                     #for detection in detections:
                                         for idx, detection in enumerate(detections):
                                             if (self.classes[int(detection[-1])]=="person"):
@@ -575,20 +677,11 @@ class Controller(object):
                                                     pre_y2 = (int(detection[4])) # y2
 
                                                 #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                                    tracker = dlib.correlation_tracker()
-                                                    rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                                    tracker.start_track(rgb, rect)
-                                                    self.trackers.append(tracker)
+                                                    self.trackers.append(self.tracker_stage.start(rgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                                                     self.cur_tar_dev = fdevice_name
                             else:
-                                for tracker in self.trackers: 
-                                    tracker.update(rgb)
-                                    fpos = tracker.get_position()
-                                    startX = int(fpos.left())
-                                    startY = int(fpos.top())
-                                    endX = int(fpos.right())
-                                    endY = int(fpos.bottom())
-                                    fpositions.append((startX, startY, endX, endY))
+                                psrs, fpositions = self.tracker_stage.update(self.trackers, rgb)
+                                self.observe_tracking(fdevice_name, psrs, fframe.shape)
 
                             objects = self.ct.update(fpositions)
                             # track well and if u miss out, go back to search phase
@@ -643,139 +736,93 @@ class Controller(object):
                 if self.cur_tar_dev == "wow": # to get out of finding phase.
                     self.cur_tar_dev = None
                 # print('nothing in all q, sleeping..')
-                time.sleep(0.5)
+                self.scheduler.wait(0.5)
 
             else: # not all q are empty... loop all queues until the target is found. 
                 while(self.cur_tar_dev==None):
-                    for i in self.d_cam.keys():
-                        if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                            self.d_cam[i]='empty'
-                            print("[finding..] "+ i +" q is empty, moving on to next q") 
-                            time.sleep(0.001) 
-#                            continue
-                            pass
-                        else:
-                            print("[finding..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-
-                            self.d_cam[i] = 'notempty'
-                            cdevice_name = self.dev_nameq[i].get()
-                            ccounter = int(self.framecntq[i].get())
-                            cframe = self.imgq[i].get()
-                            ctype = self.typeq[i].get()
-                            ctimer = self.timerq[i].get()
-                            s = time.time()
-                            if self.cuda:
-                                self.width = cframe.shape[0]
-                                self.height = cframe.shape[1]
-                                crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
-    
-                                frame_tensor = cv_image2tensor(cframe, self.input_size).unsqueeze(0)
-                                frame_tensor = Variable(frame_tensor)
-
-                                frame_tensor = frame_tensor.cuda()
-
-                                detections = self.model(frame_tensor, self.cuda).cpu()
-                                detections = process_result(detections, self.confidence, self.nms_thresh)
-                            
-                                if len(detections) != 0:
-                                    detections = transform_result(detections, [cframe], self.input_size)
-                                    #for detection in detections:
-                                    for idx, detection in enumerate(detections):
-                                        if (self.classes[int(detection[-1])]=="person"):
-                                            if float(detection[6]) > self.confidence:
-                                                print("-[searching phase] FOUND person on device: ",ccounter, cdevice_name) # well u r supposed to match the person detect with the template, but for the time being we assume its a person. # sangwoo is on it thou
-                                                pre_score = (float(detection[6])) # prediction score
-                                                pre_class = (self.classes[int(detection[-1])]) # prediction class
-                                                pre_x1 = (int(detection[1])) # x1
-                                                pre_y1 = (int(detection[2])) # y1
-                                                pre_x2 = (int(detection[3])) # x2 
-                                                pre_y2 = (int(detection[4])) # y2
+                    for cdevice_name, ccounter, cframe, ctimer, detections, s in self.search_batch():
+                        if self.cuda:
+                            self.width = cframe.shape[0]
+                            self.height = cframe.shape[1]
+                            crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
 
-                                                #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                                tracker = dlib.correlation_tracker()
-                                                rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                                tracker.start_track(crgb, rect)
-                                                self.trackers.append(tracker)
-                                                self.cur_tar_dev = cdevice_name
-                                                # need to be telling other devices to stop sending. 
-                                                # should we clear other queue?
-                                                # exactly cam1, cam2
-                                                for node_name in node_table.table.keys(): 
-                                                    if cdevice_name == "camera01": #
-                                                        node_info = node_table.table["camera02"]
-                                                        op_json = {"type": "control_op", "onoff": "False"}
-                                                        print("[FOUND!] telling "+node_info.device_name+" to STOP sending")
-                                                        self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
-                                                    elif cdevice_name == "camera02": #
-                                                        node_info = node_table.table["camera01"]
-                                                        op_json = {"type": "control_op", "onoff": "False"}
-                                                        print("[FOUND!] telling "+node_info.device_name+" to STOP sending")
-                                                        self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
-                                                break
-                                            else:
-                                                print("[finding..] low confidence person", ccounter, cdevice_name)
-                                        else: 
-                                            print("[finding..] not a person", ccounter, cdevice_name)
+                            if len(detections) != 0:
+                                self.report_confidence(cdevice_name, detections)
+                                #for detection in detections:
+                                for idx, detection in enumerate(detections):
+                                    if (self.classes[int(detection[-1])]=="person"):
+                                        if float(detection[6]) > self.confidence:
+                                            print("-[searching phase] FOUND person on device: ",ccounter, cdevice_name) # well u r supposed to match the person detect with the template, but for the time being we assume its a person. # sangwoo is on it thou
+                                            pre_score = (float(detection[6])) # prediction score
+                                            pre_class = (self.classes[int(detection[-1])]) # prediction class
+                                            pre_x1 = (int(detection[1])) # x1
+                                            pre_y1 = (int(detection[2])) # y1
+                                            pre_x2 = (int(detection[3])) # x2 
+                                            pre_y2 = (int(detection[4])) # y2
 
-                                else:
-                                    print("[finding..] nothing detected: ", ccounter, cdevice_name)
-                            time_now = time.time()
-                            inf_time = time_now - s
-                            if cdevice_name == "camera01":
-                                if self.cur_tar_dev == "camera01": # if this device found the target
-                                    self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
-                                else:
-                                    self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
-                            elif cdevice_name == "camera02":
-                                if self.cur_tar_dev == "camera02":
-                                    self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
-                                else:
-                                    self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+                                            #self.draw_bbox([frame], detection, self.colors, self.classes)
+                                            self.trackers.append(self.tracker_stage.start(crgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
+                                            self.detection_interval(cdevice_name).detected(ccounter)
+                                            self.cur_tar_dev = cdevice_name
+                                            # need to be telling other devices to stop sending. 
+                                            # should we clear other queue?
+                                            # exactly cam1, cam2
+                                            self.stop_other_devices(cdevice_name)
+                                            break
+                                        else:
+                                            print("[finding..] low confidence person", ccounter, cdevice_name)
+                                    else: 
+                                        print("[finding..] not a person", ccounter, cdevice_name)
 
-                        if self.isitempty(): # won't fall into unless there is a pass code above...
-                            print('[finding..] still at search phase, all q empty, go back to waiting phase')
-                            self.cur_tar_dev = 'wow' # a random txt to escape this loop
-                        
-                            break
+                            else:
+                                print("[finding..] nothing detected: ", ccounter, cdevice_name)
+                        time_now = time.time()
+                        inf_time = time_now - s
+                        if cdevice_name == "camera01":
+                            if self.cur_tar_dev == "camera01": # if this device found the target
+                                self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
+                            else:
+                                self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+                        elif cdevice_name == "camera02":
+                            if self.cur_tar_dev == "camera02":
+                                self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
+                            else:
+                                self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+
+                    if self.isitempty(): # won't fall into unless there is a pass code above...
+                        print('[finding..] still at search phase, all q empty, go back to waiting phase')
+                        self.cur_tar_dev = 'wow' # a random txt to escape this loop
+                    
 
-                for i in self.d_cam.keys(): # target found phase.
+                for i in self.scheduler.order(self.cur_tar_dev): # target found phase.
 
                     if self.isitempty(): # to check if both are empty.
                         print('[target found phase..] break from searching phase, all q empty, go back to waiting phase')
-                        self.d_cam[i] = 'empty' 
                         break
-                    if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                        self.d_cam[i]='empty'
+                    record = self.frameq[i].get()
+                    if record is None: # if i'th queue is empty, skip this queue stak. check other camera queue stack.
                         print("[target found phase....] "+ i +" q is empty, moving on to next q") 
                         continue
                     else: # there is smth here 
-                        print("[target_found_phase..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-                        self.d_cam[i] = 'notempty' 
-                        ftype = self.typeq[i].get()
-                        fdevice_name = self.dev_nameq[i].get()
-                        fcounter = self.framecntq[i].get()
-                        ftimer = self.timerq[i].get()
-                        fframe = self.imgq[i].get()
+                        print("[target_found_phase..] ", i, self.frameq[i].qsize())
+                        ftype = record.type
+                        fdevice_name = record.device_name
+                        fcounter = record.framecnt
+                        ftimer = record.timer
+                        fframe = self.full_frame(record)
                         rgb = cv2.cvtColor(fframe, cv2.COLOR_BGR2RGB)
                         fpositions=[]
                         fs = time.time()
                         if fdevice_name == self.cur_tar_dev:
-                            if(int(fcounter) % self.frame_skips == 0):
+                            if self.detection_interval(fdevice_name).due(fcounter):
+                                boxes = self.tracked_boxes()
                                 self.trackers=[]
                                 if self.cuda:
                                     self.width = fframe.shape[0]
                                     self.height = fframe.shape[1]
 
-                                    frame_tensor = cv_image2tensor(fframe, self.input_size).unsqueeze(0)
-                                    frame_tensor = Variable(frame_tensor)
-
-                                    if self.cuda:
-                                        frame_tensor = frame_tensor.cuda()
-
-                                    detections = self.model(frame_tensor, self.cuda).cpu()
-                                    detections = process_result(detections, self.confidence, self.nms_thresh)
+                                    detections = self.redetect(fdevice_name, fcounter, fframe, boxes)
                                     if len(detections) != 0:
-                                        detections = transform_result(detections, [cframe], self.input_size)
                                     #for detection in detections:
                                         for idx, detection in enumerate(detections):
                                             if (self.classes[int(detection[-1])]=="person"):
@@ -789,34 +836,15 @@ class Controller(object):
                                                     pre_y2 = (int(detection[4])) # y2
 
                                                 #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                                    tracker = dlib.correlation_tracker()
-                                                    rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                                    tracker.start_track(rgb, rect)
-                                                    self.trackers.append(tracker)
+                                                    self.trackers.append(self.tracker_stage.start(rgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                                                     self.cur_tar_dev = fdevice_name
                                                     # for only cam1, cam2
-                                                    for node_name in node_table.table.keys(): 
-                                                        if fdevice_name == "camera01": #
-                                                            node_info = node_table.table["camera02"]
-                                                            op_json = {"type": "control_op", "onoff": "False"}
-                                                            print("[--tracking phase: FOUND!] telling "+node_info.device_name+" to STOP sending")
-                                                            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
-                                                        elif cdevice_name == "camera02": #
-                                                            node_info = node_table.table["camera01"]
-                                                            op_json = {"type": "control_op", "onoff": "False"}
-                                                            print("[--tracking phase: FOUND!] telling "+node_info.device_name+" to STOP sending")
-                                                            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
+                                                    self.stop_other_devices(fdevice_name)
 
 
                             else:
-                                for tracker in self.trackers: 
-                                    tracker.update(rgb)
-                                    fpos = tracker.get_position()
-                                    startX = int(fpos.left())
-                                    startY = int(fpos.top())
-                                    endX = int(fpos.right())
-                                    endY = int(fpos.bottom())
-                                    fpositions.append((startX, startY, endX, endY))
+                                psrs, fpositions = self.tracker_stage.update(self.trackers, rgb)
+                                self.observe_tracking(fdevice_name, psrs, fframe.shape)
 
                             objects = self.ct.update(fpositions)
                             # track well and if u miss out, go back to search phase
@@ -850,12 +878,7 @@ class Controller(object):
                                                 if (p[0]<=0 or p[1] <= 0 or p[2] <= 0 or p[3] <=0):
                                                     pass
                                                 else:
-                                                    for node_name in node_table.table.keys(): 
-                                                        if fdevice_name == "camera01": #
-                                                            node_info = node_table.table["camera02"]
-                                                            op_json = {"type": "control_op", "onoff": "True"}
-                                                            print("[--tracking phase: telling "+node_info.device_name+" to start sending")
-                                                            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
+                                                    self.start_neighbor(fdevice_name, 'RIGHT')
                                             
                                             elif(self.checkboundary_dir(prex, prey)=="L"):
                                                 print("we need to send msg to left")
@@ -863,12 +886,7 @@ class Controller(object):
                                                 if (p[0]<=0 or p[1] <= 0 or p[2] <= 0 or p[3] <=0):
                                                     pass
                                                 else:
-                                                    for node_name in node_table.table.keys(): 
-                                                        if fdevice_name == "camera02": #
-                                                            node_info = node_table.table["camera01"]
-                                                            op_json = {"type": "control_op", "onoff": "True"}
-                                                            print("[--tracking phase: telling "+node_info.device_name+" to start sending")
-                                                            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
+                                                    self.start_neighbor(fdevice_name, 'LEFT')
 
                                             elif(self.checkboundary_dir(prex, prey)=="D"):
                                                 print("we need to send msg to down")
@@ -884,22 +902,12 @@ class Controller(object):
                                             # send hand off msg here
                                             if(self.where[objectID] == "RIGHT"):
                                                 print("we need to send msg to right")
-                                                for node_name in node_table.table.keys(): 
-                                                    if fdevice_name == "camera01": #
-                                                        node_info = node_table.table["camera02"]
-                                                        op_json = {"type": "control_op", "onoff": "True"}
-                                                        print("[--tracking phase: telling "+node_info.device_name+" to start sending")
-                                                        self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
+                                                self.start_neighbor(fdevice_name, 'RIGHT')
 
                             
                                             elif (self.where[objectID]== "LEFT"):
                                                 print("we need to send msg to left")
-                                                for node_name in node_table.table.keys(): 
-                                                    if fdevice_name == "camera02": #
-                                                        node_info = node_table.table["camera01"]
-                                                        op_json = {"type": "control_op", "onoff": "True"}
-                                                        print("[--tracking phase: telling "+node_info.device_name+" to start sending")
-                                                        self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
+                                                self.start_neighbor(fdevice_name, 'LEFT')
                                             elif (self.where[objectID]== "TOP"):
                                                 print("we need to send msg to top")
                                             elif (self.where[objectID]== "BOTTOM"):
@@ -928,11 +936,9 @@ class Controller(object):
                                 else:
                                     self.logfile2.write(str(fcounter) + "\t" + str(time_now - ftimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
                                 self.cur_tar_dev = None
-                                for node_name in node_table.table.keys(): #sending start code
-                                    node_info = node_table.table[node_name]
-                                    op_json = {"type": "control_op", "onoff": "True"}
-                                    print("[TARGET LOST!] telling "+node_info.device_name+" to start sending")
-                                    self.msg_bus.send_message_json(node_info.ip, int(node_info.port), op_json) 
+                                op_json = {"type": "control_op", "onoff": "True"} #sending start code
+                                print("[TARGET LOST!] telling all devices to start sending")
+                                self.msg_bus.broadcast_control_op("all", op_json)
                                 break
                             
                         else: # not cur_tar_dev, drop frames but log
@@ -948,6 +954,97 @@ class Controller(object):
                             print("dropping frames from: ", fdevice_name)
                             pass
 
+### mt: several targets at once
+
+    #
+    # Only the cameras the targets need send frames: the ones a target is
+    # on and the handoff neighbours. With no target at all, every camera
+    # sends (search phase).
+    #
+    def switch_cameras(self):
+        needed = self.targets.devices()
+        for device_name in self.msg_bus.node_table.get_names():
+            on = not needed or device_name in needed
+            if self.camera_on.get(device_name, True) != on:
+                self.camera_on[device_name] = on
+                print("[Targets] telling {} to {} sending".format(device_name, "start" if on else "STOP"))
+                self.msg_bus.broadcast_control_op(device_name, {"type": "control_op", "onoff": str(on)})
+        self.advertise_detector()
+
+    def person_boxes(self, detections):
+        boxes = []
+        for detection in detections:
+            if self.classes[int(detection[-1])] == "person" and float(detection[6]) > self.confidence:
+                boxes.append((int(detection[1]), int(detection[2]), int(detection[3]), int(detection[4])))
+        return boxes
+
+    #
+    # Follows up to max_targets people over the cameras (see
+    # target_table.py). Per round, the next frame of every camera that
+    # sends: the cameras without a target (search, handoff neighbours)
+    # are detected in one batched pass, a camera with targets gets one
+    # re-detection around all of them when its interval is due, and its
+    # trackers are updated otherwise.
+    #
+    @threaded
+    def mt_proc_dequeue(self):
+        node_table = self.msg_bus.node_table
+        while (True):
+            if(self.isitempty()):
+                self.scheduler.wait(0.5)
+                continue
+            s = time.time()
+            batch = []
+            for record in self.take_batch():
+                if self.camera_on.get(record.device_name, True):
+                    batch.append(record)
+                else:
+                    print("dropping frames from: ", record.device_name)
+            own = dict((r.device_name, self.targets.on_device(r.device_name)) for r in batch)
+            due = [r for r in batch if not own[r.device_name] or self.detection_interval(r.device_name).due(r.framecnt)]
+            search = [r for r in due if not own[r.device_name]]
+            results = [[] for r in search]
+            if search and self.cuda:
+                results = self.detector.detect([r.frame for r in search], originals=[r.original for r in search])
+            searched = dict((r.device_name, detections) for r, detections in zip(search, results))
+            for r in search:
+                self.detection_interval(r.device_name).detected(r.framecnt)
+
+            for r in batch:
+                fs = time.time()
+                targets = own[r.device_name]
+                if r.device_name in searched:
+                    boxes = self.person_boxes(searched[r.device_name])
+                    if boxes:
+                        self.report_confidence(r.device_name, searched[r.device_name])
+                        rgb = cv2.cvtColor(self.full_frame(r), cv2.COLOR_BGR2RGB)
+                        self.targets.assign(r.device_name, r.framecnt, boxes, lambda box: self.tracker_stage.start(rgb, box))
+                elif r in due:
+                    frame = self.full_frame(r)
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    detections = self.redetect(r.device_name, r.framecnt, frame, self.targets.boxes(r.device_name)) if self.cuda else []
+                    self.report_confidence(r.device_name, detections)
+                    self.targets.assign(r.device_name, r.framecnt, self.person_boxes(detections), lambda box: self.tracker_stage.start(rgb, box))
+                else:
+                    frame = self.full_frame(r)
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    psrs, positions = self.tracker_stage.update([t.tracker for t in targets], rgb)
+                    for t, box in zip(targets, positions):
+                        t.observe(box, r.framecnt)
+                        direction = t.exit_direction(frame.shape)
+                        neighbor = node_table.get_neighbor(r.device_name, direction) if direction else None
+                        self.targets.handoff(t, direction, neighbor.device_name if neighbor is not None else None)
+                    near = dict((t.target_id, near_boundary(t.centroids[-1], frame.shape, self.framethr)) for t in targets)
+                    self.detection_interval(r.device_name).observe(psrs, dict((t.target_id, t.speed()) for t in targets), near)
+                time_now = time.time()
+                self.logfile1.write(r.device_name + "\t" + str(r.framecnt) + "\t" + str(time_now - r.timer) + "\t" + str(len(self.targets.on_device(r.device_name))) + "\t" + str(time_now - fs) + "\n")
+
+            for t in self.targets.expire():
+                print("[Targets] target {} lost on {}".format(t.target_id, t.device_name))
+            self.switch_cameras()
+            print("[Targets] round of {} frames, {} detected in one pass, {} targets, {:.3f}s".format(
+                len(batch), len(search), len(self.targets), time.time() - s))
+
 ### e2: 
 
     @threaded
@@ -959,41 +1056,32 @@ class Controller(object):
         while (True):
             if(self.isitempty()): # yes its empty...
                 print("[q all empty] waiting...")
-                time.sleep(0.5)
+                self.scheduler.wait(0.5)
 
             else: # not all q are empty... loop all queues until the target is found. 
-                for i in self.d_cam.keys():
-                    if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                        self.d_cam[i]='empty'
+                for i in self.scheduler.order():
+                    record = self.frameq[i].get()
+                    if record is None: # if i'th queue is empty, skip this queue stak. check other camera queue stack.
                         print("[finding..] "+ i +" q is empty, moving on to next q") 
-                        time.sleep(0.001) 
                         continue
 #                        pass
                     else: 
-                        print("[ verifying...] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
+                        print("[ verifying...] ", i, self.frameq[i].qsize())
                         s = time.time()
-                        self.d_cam[i] = 'notempty'
-                        cdevice_name = self.dev_nameq[i].get()
-                        ccounter = int(self.framecntq[i].get())
-                        cframe = self.imgq[i].get()
-                        ctype = self.typeq[i].get()
-                        ctimer = self.timerq[i].get()
-                        ccoord = self.coorq[i].get()
+                        cdevice_name = record.device_name
+                        ccounter = record.framecnt
+                        cframe = self.full_frame(record)
+                        ctype = record.type
+                        ctimer = record.timer
+                        ccoord = record.coordinates
                         crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
 
                         if self.cuda:
                             width = cframe.shape[0]
                             height = cframe.shape[1]
 
-                            frame_tensor = cv_image2tensor(cframe, self.input_size).unsqueeze(0)
-                            frame_tensor = Variable(frame_tensor)
-                    
-                            frame_tensor = frame_tensor.cuda()
-
-                            detections = self.model(frame_tensor, self.cuda).cpu()
-                            detections = process_result(detections, self.confidence, self.nms_thresh)
+                            detections = self.detector.detect([cframe])[0]
                             if len(detections) != 0:
-                                detections = transform_result(detections, [cframe], self.input_size)
                                 #for detection in detections:
                                 for idx, detection in enumerate(detections):
                                     if (self.classes[int(detection[-1])]=="person"):
@@ -1035,27 +1123,25 @@ class Controller(object):
                 if(initpacket):
                     time.sleep(2)
                     initpacket = False
-                time.sleep(0.5)
+                self.scheduler.wait(0.5)
 
             else: # not all q are empty... loop all queues until the target is found. 
                 while(self.cur_tar_dev==None):
-                    for i in self.d_cam.keys():
-                        if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                            self.d_cam[i]='empty'
+                    for i in self.scheduler.order():
+                        record = self.frameq[i].get()
+                        if record is None: # if i'th queue is empty, skip this queue stak. check other camera queue stack.
                             print("[finding..] "+ i +" q is empty, moving on to next q") 
-                            time.sleep(0.001) 
 #                            continue
                             pass
                         else:# just check if its the target or not
-                            print("[not empty] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
+                            print("[not empty] ", i, self.frameq[i].qsize())
                             s = time.time()
-                            self.d_cam[i] = 'notempty'
-                            cdevice_name = self.dev_nameq[i].get()
-                            ccounter = int(self.framecntq[i].get())
-                            cframe = self.imgq[i].get()
-                            ctype = self.typeq[i].get()
-                            ctimer = self.timerq[i].get()
-                            ccoord = self.coorq[i].get()
+                            cdevice_name = record.device_name
+                            ccounter = int(record.framecnt)
+                            cframe = self.full_frame(record)
+                            ctype = record.type
+                            ctimer = record.timer
+                            ccoord = record.coordinates
                             crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
                             pre_x1 = ccoord[0]
                             pre_y1 = ccoord[1]
@@ -1063,10 +1149,7 @@ class Controller(object):
                             pre_y2 = ccoord[3]
                             print(pre_x1, pre_y1, pre_x2, pre_y2)
 
-                            tracker = dlib.correlation_tracker()
-                            rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                            tracker.start_track(crgb, rect)
-                            self.trackers.append(tracker)
+                            self.trackers.append(self.tracker_stage.start(crgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                             self.cur_tar_dev = cdevice_name
                          
                             time_now = time.time()
@@ -1089,25 +1172,23 @@ class Controller(object):
                         
                             break
 
-                for i in self.d_cam.keys(): # target found phase.
+                for i in self.scheduler.order(self.cur_tar_dev): # target found phase.
 
                     if self.isitempty(): # to check if both are empty.
                         print('[target found phase..] break from searching phase, all q empty, go back to waiting phase')
-                        self.d_cam[i] = 'empty' 
                         break
-                    if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                        self.d_cam[i]='empty'
+                    record = self.frameq[i].get()
+                    if record is None: # if i'th queue is empty, skip this queue stak. check other camera queue stack.
                         print("[target found phase....] "+ i +" q is empty, moving on to next q") 
                         continue
                     else: # there is smth here 
-                        print("[target_found_phase..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-                        self.d_cam[i] = 'notempty' 
-                        ftype = self.typeq[i].get()
-                        fdevice_name = self.dev_nameq[i].get()
-                        fcounter = self.framecntq[i].get()
-                        ftimer = self.timerq[i].get()
-                        fframe = self.imgq[i].get()
-                        fcoord= self.coorq[i].get()
+                        print("[target_found_phase..] ", i, self.frameq[i].qsize())
+                        ftype = record.type
+                        fdevice_name = record.device_name
+                        fcounter = record.framecnt
+                        ftimer = record.timer
+                        fframe = self.full_frame(record)
+                        fcoord = record.coordinates
                         rgb = cv2.cvtColor(fframe, cv2.COLOR_BGR2RGB)
                         fpositions=[]
                         fs = time.time()
@@ -1119,21 +1200,11 @@ class Controller(object):
                                 pre_x2 = fcoord[2]
                                 pre_y2 = fcoord[3]
 #                                pre_x1, pre_y1, pre_x2, pre_y2 = fcoord
-                                tracker = dlib.correlation_tracker()
-                                rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                tracker.start_track(rgb, rect)
-                                self.trackers.append(tracker)
+                                self.trackers.append(self.tracker_stage.start(rgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                                 self.cur_tar_dev = fdevice_name
 
                             else:
-                                for tracker in self.trackers: 
-                                    tracker.update(rgb)
-                                    fpos = tracker.get_position()
-                                    startX = int(fpos.left())
-                                    startY = int(fpos.top())
-                                    endX = int(fpos.right())
-                                    endY = int(fpos.bottom())
-                                    fpositions.append((startX, startY, endX, endY))
+                                psrs, fpositions = self.tracker_stage.update(self.trackers, rgb)
 
                             objects = self.ct.update(fpositions)
                             # track well and if u miss out, go back to search phase
@@ -1167,21 +1238,11 @@ class Controller(object):
                                 pre_x2 = fcoord[2]
                                 pre_y2 = fcoord[3]
 #                                pre_x1, pre_y1, pre_x2, pre_y2 = fcoord
-                                tracker = dlib.correlation_tracker()
-                                rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                tracker.start_track(rgb, rect)
-                                self.trackers.append(tracker)
+                                self.trackers.append(self.tracker_stage.start(rgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                                 self.cur_tar_dev = fdevice_name
 
                             else:
-                                for tracker in self.trackers: 
-                                    tracker.update(rgb)
-                                    fpos = tracker.get_position()
-                                    startX = int(fpos.left())
-                                    startY = int(fpos.top())
-                                    endX = int(fpos.right())
-                                    endY = int(fpos.bottom())
-                                    fpositions.append((startX, startY, endX, endY))
+                                psrs, fpositions = self.tracker_stage.update(self.trackers, rgb)
 
                             objects = self.ct.update(fpositions)
                             # track well and if u miss out, go back to search phase
@@ -1216,7 +1277,7 @@ class Controller(object):
         frame_start_time = time.time()
         self.encode_param = [int(cv2.IMWRITE_JPEG_QUALITY),99]
         while (True):
-             if (self.imgq.empty()):
+             if (self.isitempty()):
                 if(endcnt >= 120):
                     self.logfile1.close()
                     self.logfile2.close()
@@ -1224,35 +1285,34 @@ class Controller(object):
                     sys.exit(0)
                 else:
                     print('nothing in q, sleeping..')
-                    time.sleep(1)
+                    self.scheduler.wait(1)
                     endcnt += 1
 
              else:
-                device_name = self.dev_nameq.get()
-                counter = int(self.framecntq.get())
-                frame = self.imgq.get()
+                record = None
+                for i in self.scheduler.order():
+                    record = self.frameq[i].get()
+                    if record is not None:
+                        break
+                if record is None:
+                    continue
+                device_name = record.device_name
+                counter = int(record.framecnt)
+                frame = self.full_frame(record)
                 if self.cuda:
-                    if self.typeq.get() == 'img': # just detection, nothing else
-                        self.detection_gpu(self.model, frame, cnt)
+                    if record.type == 'img': # just detection, nothing else
+                        self.detection_gpu(self.model, frame, counter)
 
-                    elif self.typeq.get() == 'img_tracking':# for tracking
+                    elif record.type == 'img_tracking':# for tracking
                         self.width = frame.shape[0]
                         self.height = frame.shape[1]
                         rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
                         positions = []
-                        if int(counter) % self.frame_skip == 0:
+                        if int(counter) % self.frame_skips == 0:
                             self.trackers = []
-                            frame_tensor = cv_image2tensor(frame, self.input_size).unsqueeze(0)
-                            frame_tensor = Variable(frame_tensor)
-
-                            if self.cuda:
-                                frame_tensor = frame_tensor.cuda()
-
-                            detections = self.model(frame_tensor, self.cuda).cpu()
-                            detections = process_result(detections, self.confidence, self.nms_thresh)
+                            detections = self.detector.detect([frame])[0]
         
                             if len(detections) != 0:
-                                detections = transform_result(detections, [frame], self.input_size)
                             #for detection in detections:
                                 for idx, detection in enumerate(detections):
                                     if (self.classes[int(detection[-1])]=="person"):
@@ -1266,19 +1326,9 @@ class Controller(object):
                                             pre_y2 = (int(detection[4])) # y2
 
                                             #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                            tracker = dlib.correlation_tracker()
-                                            rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                            tracker.start_track(rgb, rect)
-                                            self.trackers.append(tracker)
+                                            self.trackers.append(self.tracker_stage.start(rgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                         else: 
-                            for tracker in self.trackers: 
-                                tracker.update(rgb)
-                                pos = tracker.get_position()
-                                startX = int(pos.left())
-                                startY = int(pos.top())
-                                endX = int(pos.right())
-                                endY = int(pos.bottom())
-                                positions.append((startX, startY, endX, endY))
+                            psrs, positions = self.tracker_stage.update(self.trackers, rgb)
 
                         objects = self.ct.update(positions)
 
@@ -1389,19 +1439,18 @@ class Controller(object):
                         if(cv2.waitKey(3) & 0xFF == ord('q')):
                             break
 
-                    elif self.typeq.get() == 'img_tracking_check':# dummy here
-                        thing = self.detection_gpu_return(self.model, frame, cnt)
+                    elif record.type == 'img_tracking_check':# dummy here
+                        thing = self.detection_gpu_return(self.model, frame, counter)
                 else: # no GPU enabled
-                    if self.typeq.get() == 'img':
+                    if record.type == 'img':
                         self.detection(frame)
-                    elif self.typeq.get() == 'img_tracking':
+                    elif record.type == 'img_tracking':
                         print ("NOT IMP YET")
                         # self.detection_tracking (self.model, self.imgq.get(), cnt)
-                    elif self.typeq.get() == 'img_tracking_check':
+                    elif record.type == 'img_tracking_check':
                         print ("NOT IMP YET")
                         # thing = self.detection_gpu_return(self.model, self.imgq.get(), cnt)
-                curT = datetime.utcnow().strftime('%H:%M:%S.%f') # string format
-                decay = datetime.strptime(curT, '%H:%M:%S.%f') - self.timerq.get()
+                decay = timedelta(seconds=time.time() - record.timer)
 
                 frame_end_time = time.time()
                 cumlative_fps = int(counter) / (frame_end_time - frame_start_time)
@@ -1410,6 +1459,8 @@ class Controller(object):
                 #self.logfile2.write(str(cnt)+"\t"+str(dev)+"\t"+str(thing)+"\t"+str(decay.total_seconds())+"\n")
 
 
+
+
 ### proposed
     def p_proc_dequeue(self):
         framecnt = 0
@@ -1423,126 +1474,90 @@ class Controller(object):
                 print("[q all empty] waiting...")
                 if self.cur_tar_dev == "wow" or self.cur_tar_dev != None: # to get out of finding phase.
                     self.cur_tar_dev = None
-                time.sleep(0.5)
+                self.scheduler.wait(0.5)
 
             else: # not all q are empty... loop all queues until the target is found. 
                 while(self.cur_tar_dev==None):
-                    for i in self.d_cam.keys():
-                        if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                            self.d_cam[i]='empty'
-                            print("[finding..] "+ i +" q is empty, moving on to next q") 
-                            time.sleep(0.001) 
-#                            continue
-                            pass
-                        else:
-                            print("[finding..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-
-                            self.d_cam[i] = 'notempty'
-                            cdevice_name = self.dev_nameq[i].get()
-                            ccounter = int(self.framecntq[i].get())
-                            cframe = self.imgq[i].get()
-                            ctype = self.typeq[i].get()
-                            ctimer = self.timerq[i].get()
-                            s = time.time()
-                            if self.cuda:
-                                self.width = cframe.shape[0]
-                                self.height = cframe.shape[1]
-                                crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
-    
-                                frame_tensor = cv_image2tensor(cframe, self.input_size).unsqueeze(0)
-                                frame_tensor = Variable(frame_tensor)
-
-                                frame_tensor = frame_tensor.cuda()
-
-                                detections = self.model(frame_tensor, self.cuda).cpu()
-                                detections = process_result(detections, self.confidence, self.nms_thresh)
-                            
-                                if len(detections) != 0:
-                                    detections = transform_result(detections, [cframe], self.input_size)
-                                    #for detection in detections:
-                                    for idx, detection in enumerate(detections):
-                                        if (self.classes[int(detection[-1])]=="person"):
-                                            if float(detection[6]) > self.confidence:
-                                                print("-[searching phase] FOUND person on device: ",ccounter, cdevice_name) # well u r supposed to match the person detect with the template, but for the time being we assume its a person. # sangwoo is on it thou
-                                                pre_score = (float(detection[6])) # prediction score
-                                                pre_class = (self.classes[int(detection[-1])]) # prediction class
-                                                pre_x1 = (int(detection[1])) # x1
-                                                pre_y1 = (int(detection[2])) # y1
-                                                pre_x2 = (int(detection[3])) # x2 
-                                                pre_y2 = (int(detection[4])) # y2
+                    for cdevice_name, ccounter, cframe, ctimer, detections, s in self.search_batch():
+                        if self.cuda:
+                            self.width = cframe.shape[0]
+                            self.height = cframe.shape[1]
+                            crgb = cv2.cvtColor(cframe, cv2.COLOR_BGR2RGB)
 
-                                                #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                                tracker = dlib.correlation_tracker()
-                                                rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                                tracker.start_track(crgb, rect)
-                                                self.trackers.append(tracker)
-                                                self.cur_tar_dev = cdevice_name
+                            if len(detections) != 0:
+                                self.report_confidence(cdevice_name, detections)
+                                #for detection in detections:
+                                for idx, detection in enumerate(detections):
+                                    if (self.classes[int(detection[-1])]=="person"):
+                                        if float(detection[6]) > self.confidence:
+                                            print("-[searching phase] FOUND person on device: ",ccounter, cdevice_name) # well u r supposed to match the person detect with the template, but for the time being we assume its a person. # sangwoo is on it thou
+                                            pre_score = (float(detection[6])) # prediction score
+                                            pre_class = (self.classes[int(detection[-1])]) # prediction class
+                                            pre_x1 = (int(detection[1])) # x1
+                                            pre_y1 = (int(detection[2])) # y1
+                                            pre_x2 = (int(detection[3])) # x2 
+                                            pre_y2 = (int(detection[4])) # y2
 
-                                                break
-                                            else:
-                                                print("[finding..] low confidence person", ccounter, cdevice_name)
-                                        else: 
-                                            print("[finding..] not a person", ccounter, cdevice_name)
+                                            #self.draw_bbox([frame], detection, self.colors, self.classes)
+                                            self.trackers.append(self.tracker_stage.start(crgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
+                                            self.detection_interval(cdevice_name).detected(ccounter)
+                                            self.cur_tar_dev = cdevice_name
 
-                                else:
-                                    print("[finding..] nothing detected: ", ccounter, cdevice_name)
-                            time_now = time.time()
-                            inf_time = time_now - s
-                            if cdevice_name == "camera01":
-                                if self.cur_tar_dev == "camera01": # if this device found the target
-                                    self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
-                                else:
-                                    self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
-                            elif cdevice_name == "camera02":
-                                if self.cur_tar_dev == "camera02":
-                                    self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
-                                else:
-                                    self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+                                            break
+                                        else:
+                                            print("[finding..] low confidence person", ccounter, cdevice_name)
+                                    else: 
+                                        print("[finding..] not a person", ccounter, cdevice_name)
 
-                        if self.isitempty(): # won't fall into unless there is a pass code above...
-                            print('[finding..] still at search phase, all q empty, go back to waiting phase')
-                            self.cur_tar_dev = 'wow' # a random txt to escape this loop
-                        
-                            break
+                            else:
+                                print("[finding..] nothing detected: ", ccounter, cdevice_name)
+                        time_now = time.time()
+                        inf_time = time_now - s
+                        if cdevice_name == "camera01":
+                            if self.cur_tar_dev == "camera01": # if this device found the target
+                                self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
+                            else:
+                                self.logfile1.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+                        elif cdevice_name == "camera02":
+                            if self.cur_tar_dev == "camera02":
+                                self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "1" + "\t" + str(inf_time)+"\n")
+                            else:
+                                self.logfile2.write(str(ccounter) + "\t" + str(time_now - ctimer) + "\t" + "0" + "\t" + str(inf_time)+"\n")
+
+                    if self.isitempty(): # won't fall into unless there is a pass code above...
+                        print('[finding..] still at search phase, all q empty, go back to waiting phase')
+                        self.cur_tar_dev = 'wow' # a random txt to escape this loop
+                    
 
-                for i in self.d_cam.keys(): # target found phase.
+                for i in self.scheduler.order(self.cur_tar_dev): # target found phase.
 
                     if self.isitempty(): # to check if both are empty.
                         print('[target found phase..] break from searching phase, all q empty, go back to waiting phase')
-                        self.d_cam[i] = 'empty' 
                         break
-                    if(self.imgq[i].empty()): # if i'th queue is empty, skip this queue stak. check other camera queue stack.
-                        self.d_cam[i]='empty'
+                    record = self.frameq[i].get()
+                    if record is None: # if i'th queue is empty, skip this queue stak. check other camera queue stack.
                         print("[target found phase....] "+ i +" q is empty, moving on to next q") 
                         continue
                     else: # there is smth here 
-                        print("[target_found_phase..] ", i, self.dev_nameq[i].qsize(), self.framecntq[i].qsize(), self.imgq[i].qsize(), self.typeq[i].qsize(), self.timerq[i].qsize())
-                        self.d_cam[i] = 'notempty' 
-                        ftype = self.typeq[i].get()
-                        fdevice_name = self.dev_nameq[i].get()
-                        fcounter = self.framecntq[i].get()
-                        ftimer = self.timerq[i].get()
-                        fframe = self.imgq[i].get()
+                        print("[target_found_phase..] ", i, self.frameq[i].qsize())
+                        ftype = record.type
+                        fdevice_name = record.device_name
+                        fcounter = record.framecnt
+                        ftimer = record.timer
+                        fframe = self.full_frame(record)
                         rgb = cv2.cvtColor(fframe, cv2.COLOR_BGR2RGB)
                         fpositions=[]
                         fs = time.time()
                         if fdevice_name == self.cur_tar_dev:
-                            if(int(fcounter) % self.frame_skips == 0):
+                            if self.detection_interval(fdevice_name).due(fcounter):
+                                boxes = self.tracked_boxes()
                                 self.trackers=[]
                                 if self.cuda:
                                     self.width = fframe.shape[0]
                                     self.height = fframe.shape[1]
 
-                                    frame_tensor = cv_image2tensor(fframe, self.input_size).unsqueeze(0)
-                                    frame_tensor = Variable(frame_tensor)
-
-                                    if self.cuda:
-                                        frame_tensor = frame_tensor.cuda()
-
-                                    detections = self.model(frame_tensor, self.cuda).cpu()
-                                    detections = process_result(detections, self.confidence, self.nms_thresh)
+                                    detections = self.redetect(fdevice_name, fcounter, fframe, boxes)
                                     if len(detections) != 0:
-                                        detections = transform_result(detections, [fframe], self.input_size)
                                     #for detection in detections:
                                         for idx, detection in enumerate(detections):
                                             if (self.classes[int(detection[-1])]=="person"):
@@ -1556,23 +1571,14 @@ class Controller(object):
                                                     pre_y2 = (int(detection[4])) # y2
 
                                                 #self.draw_bbox([frame], detection, self.colors, self.classes)
-                                                    tracker = dlib.correlation_tracker()
-                                                    rect = dlib.rectangle(pre_x1, pre_y1, pre_x2, pre_y2)
-                                                    tracker.start_track(rgb, rect)
-                                                    self.trackers.append(tracker)
+                                                    self.trackers.append(self.tracker_stage.start(rgb, (pre_x1, pre_y1, pre_x2, pre_y2)))
                                                     self.cur_tar_dev = fdevice_name
                                                     # for only cam1, cam2
 
 
                             else:
-                                for tracker in self.trackers: 
-                                    tracker.update(rgb)
-                                    fpos = tracker.get_position()
-                                    startX = int(fpos.left())
-                                    startY = int(fpos.top())
-                                    endX = int(fpos.right())
-                                    endY = int(fpos.bottom())
-                                    fpositions.append((startX, startY, endX, endY))
+                                psrs, fpositions = self.tracker_stage.update(self.trackers, rgb)
+                                self.observe_tracking(fdevice_name, psrs, fframe.shape)
 
                             objects = self.ct.update(fpositions)
                             # track well and if u miss out, go back to search phase
@@ -1612,27 +1618,35 @@ class Controller(object):
                             pass
 
     def setup_before_detection_gpu(self):
-        self.input_size = [int(self.model.net_info['height']), int(self.model.net_info['width'])]
         self.colors = pkl.load(open("pallete", "rb"))
         self.classes = self.load_classes ("data/coco.names")
         self.colors = [self.colors[1]]
+        self.keep_classes = [self.classes.index("person")] # the only class any mode tracks
+        if self.model_server is not None:
+            self.detector = ModelClient(self.model_server, self.msg_bus.device_name, self.keep_classes)
+            self.input_size = self.detector.input_size
+            self.roi = RoiDetector(self.detector, None, self.confidence)
+            return
+        self.input_size = [int(self.model.net_info['height']), int(self.model.net_info['width'])]
+        use_cuda = torch.cuda.is_available()
+        backend = load_backend(self.backend, self.model, self.input_size, use_cuda, self.threads)
+        self.detector = BatchDetector(self.model, self.input_size, use_cuda, self.confidence, self.nms_thresh,
+                                      self.max_batch, self.max_wait, self.keep_classes, backend)
+        roi_detector = None
+        if self.roi_size > 0:
+            roi_input = [self.roi_size, self.roi_size]
+            roi_detector = BatchDetector(self.model, roi_input, use_cuda, self.confidence, self.nms_thresh, 1, 0.0,
+                                         self.keep_classes, load_backend(self.backend, self.model, roi_input, use_cuda, self.threads))
+        self.roi = RoiDetector(self.detector, roi_detector, self.confidence, self.roi_margin)
 
 
     def detection_gpu_return(self, model, frame, cnt):
 #        print('Detecting...')
         personcnt =0
         start_time = time.time()
-        frame_tensor = cv_image2tensor(frame, self.input_size).unsqueeze(0)
-        frame_tensor = Variable(frame_tensor)
-
-        if self.cuda:
-            frame_tensor = frame_tensor.cuda()
-
-        detections = self.model(frame_tensor, self.cuda).cpu()
-        detections = process_result(detections, self.confidence, self.nms_thresh)
+        detections = self.detector.detect([frame])[0]
         
         if len(detections) != 0:
-            detections = transform_result(detections, [frame], self.input_size)
 #            for detection in detections:
             for idx, detection in enumerate(detections):
                 if(self.classes[int(detection[-1])]=="person"):
@@ -1643,18 +1657,10 @@ class Controller(object):
     def detection_gpu(self, model, frame, cnt):
 #        print('Detecting...')
         start_time = time.time()
-        frame_tensor = cv_image2tensor(frame, self.input_size).unsqueeze(0)
-        frame_tensor = Variable(frame_tensor)
-
-        if self.cuda:
-            frame_tensor = frame_tensor.cuda()
-
-        detections = self.model(frame_tensor, self.cuda).cpu()
-        detections = process_result(detections, self.confidence, self.nms_thresh)
+        detections = self.detector.detect([frame], all_classes=True)[0]
         print("number of detected objects: ", len(detections))
         a = [[] for _ in range(len(detections))]
         if len(detections) != 0:
-            detections = transform_result(detections, [frame], self.input_size)
 #            for detection in detections:
             for idx, detection in enumerate(detections):
                 a[idx].append(float(detection[6])) # prediction score
@@ -1719,6 +1725,8 @@ class Controller(object):
         requests.post(webhook_url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
 
 if __name__ == '__main__':
+    startup = StartupTimer(psutil.Process().create_time())
+    startup.mark('imports')
     parser = argparse.ArgumentParser(description="IoT controller of Chameleon.")
     parser.add_argument('-ln1', '--logfilename1', type=str, default='logfiledev1.txt', help="logfile name for dev1")
     parser.add_argument('-ln2', '--logfilename2', type=str, default='logfiledev2.txt', help="logfile name for dev2.")
@@ -1727,9 +1735,29 @@ if __name__ == '__main__':
     parser.add_argument("--confidence", dest = "confidence", help = "Object Confidence to filter predictions", default = 0.6)
     parser.add_argument("--nms_thresh", dest = "nms_thresh", help = "NMS Threshhold", default = 0.5)
     parser.add_argument('-dis', '--display', type=str, default = 'off', help = "enable display")
-    parser.add_argument('-tr', '--transmission', type=str, default = 'dr', help = "e1-1, e1-2, e2, p")
+    parser.add_argument('-tr', '--transmission', type=str, default = 'dr', help = "e1-1, e1-2, e2, p, mt (several targets at once)")
     parser.add_argument('-ts', '--trackingscheme', type=str, default = 'dr', help = "dead reckoning, boundary check")
     parser.add_argument('-fs', '--frameskips', type=int, default = 10, help = "skip frame count")
+    parser.add_argument('-sd', '--statsdump', type=float, default = 0, help = "print messaging latency stats every N seconds (0: off)")
+    parser.add_argument('-lt', '--livenesstimeout', type=float, default = 10, help = "evict cameras silent for N seconds (0: off)")
+    parser.add_argument('-mb', '--maxbatch', type=int, default = 8, help = "max frames per detection batch")
+    parser.add_argument('-mw', '--maxwait', type=float, default = 0.005, help = "max seconds to wait for a fuller batch")
+    parser.add_argument('-be', '--backend', type=str, default = 'torch', choices = BACKENDS, help = "detector runtime")
+    parser.add_argument('-th', '--threads', type=int, default = 0, help = "detector intra-op threads (0: runtime default)")
+    parser.add_argument('-dp', '--decodeprocs', type=int, default = 2, help = "JPEG decode worker processes (0: decode in the receiving thread)")
+    parser.add_argument('-sp', '--schedpolicy', type=str, default = 'target_first', choices = sorted(POLICIES), help = "order the camera queues are served in")
+    parser.add_argument('-qa', '--queueage', type=float, default = 2.0, help = "drop queued frames older than N seconds (0: keep all)")
+    parser.add_argument('-rec', '--record', type=str, default = None, help = "record received traffic to a file for traffic_replay.py")
+    parser.add_argument('-wc', '--weightcache', type=str, default = 'cache', help = "directory of the converted YOLO weights ('' to parse yolov3.weights every start)")
+    parser.add_argument('-lb', '--letterbox', type=str, default = '', help = "frame types (e.g. img_e1-1,img_p) the cameras letterbox to the detector input while searching")
+    parser.add_argument('-rs', '--roisize', type=int, default = 0, help = "detector input size (multiple of 32, e.g. 256) of the re-detections around the tracked target (0: full frame)")
+    parser.add_argument('-rm', '--roimargin', type=float, default = 0.5, help = "margin of the re-detection region around the tracked boxes, fraction of their size")
+    parser.add_argument('-ib', '--intervalbounds', type=int, nargs=2, default = None, help = "adapt the frames between re-detections while tracking to the trackers' confidence, motion and frame boundary, within these bounds. ex. -ib 2 30 (default: every frameskips frames)")
+    parser.add_argument('-tb', '--trackerbackend', type=str, default = 'dlib', choices = TRACKER_BACKENDS, help = "object trackers between detections")
+    parser.add_argument('-tt', '--trackerthreads', type=int, default = 4, help = "threads updating the trackers of a frame")
+    parser.add_argument('-mt', '--maxtargets', type=int, default = 4, help = "targets followed at once in the mt scheme")
+    parser.add_argument('-ht', '--handofftimeout', type=float, default = 5.0, help = "seconds a handed-off target waits for the neighbour camera to see it (mt)")
+    parser.add_argument('-ms', '--modelserver', type=str, default = None, help = "detect through model_server.py at this address (e.g. tcp://127.0.0.1:9600) instead of loading the models")
     ARGS = parser.parse_args()
     # Read 'master.ini'
     config = configparser.ConfigParser()
@@ -1739,23 +1767,48 @@ if __name__ == '__main__':
     label_path = config['detection_label']['yolo']
     prototxtpath =  config['mSSD']['prototxt']
     modelpath = config['mSSD']['model']
-    ctrl = Controller(controller_name, listen_port)
+    ctrl = Controller(controller_name, listen_port, ARGS.decodeprocs)
+    startup.mark('message bus')
     print("[INFO] Loading model...")
     print("[INFO] Please wait until setup is done...")
     ctrl.slacknoti("spencer start using")
-    ctrl.net = cv2.dnn.readNetFromCaffe(prototxtpath, modelpath)
+    if ARGS.modelserver is None:
+        ctrl.net = cv2.dnn.readNetFromCaffe(prototxtpath, modelpath)
+        startup.mark('caffe model')
 
     ctrl.confidence = ARGS.confidence
     ctrl.nms_thresh = ARGS.nms_thresh
+    ctrl.max_batch = ARGS.maxbatch
+    ctrl.max_wait = ARGS.maxwait
+    ctrl.backend = ARGS.backend
+    ctrl.threads = ARGS.threads
+    ctrl.max_age = ARGS.queueage
+    ctrl.scheduler.policy = ARGS.schedpolicy
     ctrl.display = ARGS.display
-    ctrl.model = Darknet("cfg/yolov3.cfg")
-    ctrl.model.load_weights('yolov3.weights')
+    ctrl.model_server = ARGS.modelserver
+    ctrl.roi_size = ARGS.roisize
+    ctrl.roi_margin = ARGS.roimargin
+    if ARGS.modelserver is not None:
+        pass # both models live in the model server
+    elif ARGS.weightcache:
+        ctrl.model, cached = load_model("cfg/yolov3.cfg", 'yolov3.weights', ARGS.weightcache)
+        startup.mark('yolo weights (cached)' if cached else 'yolo weights (cache miss)')
+    else:
+        ctrl.model = Darknet("cfg/yolov3.cfg")
+        ctrl.model.load_weights('yolov3.weights')
+        startup.mark('yolo weights')
 #ctrl.cuda = torch.cuda.is_available()
     ctrl.cuda = torch.cuda.device('cuda:0')
-    if torch.cuda.is_available():
-        ctrl.model.cuda()
-    ctrl.model.eval()
+    if ctrl.model is not None:
+        if torch.cuda.is_available():
+            ctrl.model.cuda()
+        ctrl.model.eval()
     ctrl.setup_before_detection_gpu()
+    if ARGS.modelserver is not None:
+        ctrl.net = ctrl.detector.caffe_net()
+    ctrl.letterbox_types = set(t for t in ARGS.letterbox.split(',') if t)
+    ctrl.advertise_detector() # cameras that joined during setup
+    startup.mark('detector backend')
 
     ctrl.logfile1 = open(ARGS.logfilename1, 'w')
     ctrl.logfile2 = open(ARGS.logfilename2, 'w')
@@ -1765,6 +1818,17 @@ if __name__ == '__main__':
     ctrl.tr = ARGS.transmission
     ctrl.ts = ARGS.trackingscheme
     ctrl.frame_skips = ARGS.frameskips
+    ctrl.interval_bounds = ARGS.intervalbounds
+    ctrl.tracker_stage = TrackerStage(ARGS.trackerbackend, ARGS.trackerthreads)
+    ctrl.targets = TargetTable(ARGS.maxtargets, handoff_timeout=ARGS.handofftimeout)
+    if ARGS.statsdump > 0:
+        ctrl.msg_bus.run_stats_dump(ARGS.statsdump)
+    if ARGS.livenesstimeout > 0:
+        ctrl.msg_bus.run_liveness_check(ARGS.livenesstimeout, on_evict=ctrl.handle_evict)
+    if ARGS.record is not None:
+        ctrl.msg_bus.start_recording(ARGS.record)
+    startup.mark('logs and messaging')
+    print(startup.report())
     print("[INFO] Finished setup!")
     if ARGS.transmission == 'e1-1':
         print('[Controller] running as an existing work 1-1. receiving all frames and strart tracking')
@@ -1775,6 +1839,10 @@ if __name__ == '__main__':
         print('[Controller] running as an existing work 1-2. (upon request)')
         time.sleep(1)
         ctrl.e1_2_proc_dequeue()
+    elif ARGS.transmission == 'mt':
+        print('[Controller] following up to {} targets at once. (upon request)'.format(ARGS.maxtargets))
+        time.sleep(1)
+        ctrl.mt_proc_dequeue()
     elif ARGS.transmission == 'e1g':
         print('[Controller] making ground truth data. receiving all frames')
         time.sleep(1)
@@ -0,0 +1,228 @@
+import argparse
+import copy
+import io
+import time
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from darknet import Darknet
+
+#
+# Runtimes for the YOLO detector. Every backend is called with the input
+# tensor (N, 3, H, W) and returns the same (N, boxes, 85) detections as
+# Darknet.forward, on the CPU:
+# - torch: Darknet.forward as it is (eager, block by block)
+# - torchscript: the model traced after load_weights, batch norm folded
+#   into the convolutions
+# - onnxruntime / opencv: the same graph exported to ONNX
+# The traced and exported graphs are for one input size (and batch size
+# for opencv); 'threads' sets the intra-op threads of the runtime.
+#
+BACKENDS = ('torch', 'torchscript', 'onnxruntime', 'opencv')
+
+
+#
+# Returns a copy of 'model' where every conv + batch norm pair is a
+# single conv (eval mode only).
+#
+def fold_batchnorm(model):
+    model = copy.deepcopy(model).eval()
+    for module in model.module_list:
+        if not isinstance(module, nn.Sequential) or len(module) < 2 or not isinstance(module[1], nn.BatchNorm2d):
+            continue
+        conv, bn = module[0], module[1]
+        scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+        folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, bias=True)
+        folded.weight.data.copy_(conv.weight.data * scale.view(-1, 1, 1, 1))
+        folded.bias.data.copy_(bn.bias.data - bn.running_mean * scale)
+        module[0] = folded
+        module[1] = nn.Identity()
+    return model
+
+
+#
+# Darknet.forward without the cuda flag, in-place updates and torch.cat
+# per YOLO layer, so that it traces and exports cleanly. Same output.
+#
+class ExportableDarknet(nn.Module):
+    def __init__(self, model):
+        super(ExportableDarknet, self).__init__()
+        self.module_list = model.module_list
+        self.types = [block['type'] for block in model.blocks[1:]]
+
+    def detect(self, layer, x, input_dim):
+        batch_size = x.size(0)
+        grid_size = x.size(2)
+        stride = input_dim // grid_size
+        attrs = layer.num_classes + 5
+        detection = x.view(batch_size, layer.num_anchors, attrs, grid_size, grid_size)
+
+        grid = torch.arange(grid_size, dtype=torch.float, device=x.device)
+        offsets = torch.stack((grid.view(1, -1).expand(grid_size, grid_size),
+                               grid.view(-1, 1).expand(grid_size, grid_size))).view(1, 1, 2, grid_size, grid_size)
+        anchors = layer.anchors.to(x.device).view(1, layer.num_anchors, 2, 1, 1)
+
+        xy = (torch.sigmoid(detection[:, :, :2]) + offsets) * stride
+        wh = torch.exp(detection[:, :, 2:4]) * anchors
+        scores = torch.sigmoid(detection[:, :, 4:])
+        detection = torch.cat((xy, wh, scores), dim=2)
+        return detection.permute(0, 1, 3, 4, 2).reshape(batch_size, -1, attrs)
+
+    def forward(self, x):
+        input_dim = x.size(3)
+        outputs = []
+        detections = []
+        for module, block_type in zip(self.module_list, self.types):
+            if block_type == 'convolutional' or block_type == 'upsample':
+                x = module(x)
+            elif block_type == 'shortcut':
+                x = module(x, outputs)
+            elif block_type == 'route':
+                x = module(outputs)
+            elif block_type == 'yolo':
+                x = self.detect(module, x, input_dim)
+                detections.insert(0, x) # Darknet.forward prepends every yolo layer
+            outputs.append(x)
+        return torch.cat(detections, dim=1)
+
+
+#
+# Traced on the device the model is on: freezing bakes the weights in
+# as constants, so the result cannot be moved to another device.
+#
+def export_torchscript(model, input_size, batch_size=1):
+    net = ExportableDarknet(fold_batchnorm(model)).eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(net, torch.zeros(batch_size, 3, input_size[0], input_size[1], device=device)))
+
+
+#
+# Returns the ONNX model as bytes; dynamic batch size unless
+# 'fixed_batch' (OpenCV DNN needs a fixed one).
+#
+def export_onnx(model, input_size, batch_size=1, fixed_batch=False):
+    net = ExportableDarknet(fold_batchnorm(model)).eval()
+    buf = io.BytesIO()
+    dynamic_axes = None if fixed_batch else {'input': {0: 'batch'}, 'detections': {0: 'batch'}}
+    with torch.no_grad():
+        torch.onnx.export(net, torch.zeros(batch_size, 3, input_size[0], input_size[1]), buf,
+                          input_names=['input'], output_names=['detections'],
+                          dynamic_axes=dynamic_axes, opset_version=11, dynamo=False)
+    return buf.getvalue()
+
+
+class TorchBackend(object):
+    def __init__(self, model, cuda):
+        self.model = model
+        self.cuda = cuda
+
+    def __call__(self, x):
+        if self.cuda:
+            x = x.cuda()
+        with torch.no_grad():
+            return self.model(x, self.cuda).cpu()
+
+
+class TorchScriptBackend(object):
+    def __init__(self, model, input_size, cuda):
+        self.cuda = cuda
+        self.net = export_torchscript(model.cuda() if cuda else model.cpu(), input_size)
+
+    def __call__(self, x):
+        if self.cuda:
+            x = x.cuda()
+        with torch.no_grad():
+            return self.net(x).cpu()
+
+
+class OnnxRuntimeBackend(object):
+    def __init__(self, model, input_size, threads):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(export_onnx(model.cpu(), input_size), options,
+                                                    providers=['CPUExecutionProvider'])
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {'input': x.numpy()})[0])
+
+
+#
+# OpenCV DNN runs a fixed batch size; other batch sizes are split into
+# single frames.
+#
+class OpenCVBackend(object):
+    def __init__(self, model, input_size):
+        self.net = cv2.dnn.readNetFromONNX(np.frombuffer(export_onnx(model.cpu(), input_size, fixed_batch=True), dtype=np.uint8))
+
+    def __call__(self, x):
+        outputs = []
+        for frame in x.numpy():
+            self.net.setInput(frame[np.newaxis])
+            outputs.append(torch.from_numpy(self.net.forward().copy()))
+        return torch.cat(outputs)
+
+
+#
+# Returns the backend 'name' for 'model' (weights loaded), falling back
+# to torch if its runtime is not installed.
+#
+def load_backend(name, model, input_size, cuda=False, threads=0):
+    if threads > 0:
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+    model.eval()
+    try:
+        if name == 'torchscript':
+            return TorchScriptBackend(model, input_size, cuda)
+        if name == 'onnxruntime':
+            return OnnxRuntimeBackend(model, input_size, threads)
+        if name == 'opencv':
+            return OpenCVBackend(model, input_size)
+    except (ImportError, torch.onnx.errors.OnnxExporterError) as e:
+        # onnxruntime, or the onnx package the exporter needs, is missing
+        print('[Controller] {} backend not available ({}), using torch'.format(name, e))
+    if cuda:
+        model.cuda()
+    return TorchBackend(model, cuda)
+
+
+#
+# CPU benchmark of the backends: frames/sec per input size.
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="YOLO backend benchmark (CPU)")
+    parser.add_argument('-c', '--cfg', type=str, default='cfg/yolov3.cfg', help="darknet cfg")
+    parser.add_argument('-w', '--weights', type=str, default=None, help="darknet weights (random if not given)")
+    parser.add_argument('-s', '--sizes', type=str, default='320,416,608', help="input sizes")
+    parser.add_argument('-b', '--backends', type=str, default=','.join(BACKENDS), help="backends to compare")
+    parser.add_argument('-th', '--threads', type=int, default=0, help="intra-op threads (0: runtime default)")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="frames per measurement")
+    ARGS = parser.parse_args()
+
+    for size in [int(s) for s in ARGS.sizes.split(',')]:
+        model = Darknet(ARGS.cfg)
+        model.net_info['height'] = model.net_info['width'] = size
+        for module in model.module_list:
+            if hasattr(module, 'input_dim'):
+                module.input_dim = size # yolo layers take the input size from the cfg
+        if ARGS.weights is not None:
+            model.load_weights(ARGS.weights)
+        model.eval()
+        x = torch.rand(1, 3, size, size)
+        with torch.no_grad():
+            reference = model(x.clone(), False)
+        for name in ARGS.backends.split(','):
+            s = time.time()
+            backend = load_backend(name, model, (size, size), False, ARGS.threads)
+            setup = time.time() - s
+            out = backend(x.clone()) # warm up
+            diff = float((out - reference).abs().max())
+            s = time.time()
+            for _ in range(ARGS.repeat):
+                backend(x.clone())
+            fps = ARGS.repeat / (time.time() - s)
+            print('{}x{} {:12s} {:6.2f} fps  (setup {:.1f}s, max diff to eager {:.2e})'.format(size, size, type(backend).__name__, fps, setup, diff))
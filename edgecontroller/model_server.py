@@ -0,0 +1,356 @@
+import argparse
+import collections
+import configparser
+import itertools
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+sys.path.insert(0, '../messaging')
+from shm_ring import ShmRingWriter, ShmRingReader
+import cv2
+import numpy as np
+import torch
+import zmq
+
+#
+# Local inference server: loads YOLOv3 and the Caffe MobileNet-SSD once
+# and serves every controller process on the host, instead of each
+# controller holding its own copy of the models.
+#
+# Frames go through shared memory (shm_ring.py): the client copies them
+# into its ring and sends only the descriptors over a DEALER socket to
+# the server's ROUTER, which copies them out on arrival.
+#   request:  [b'', JSON header, payload...]
+#     {'op': 'info'}
+#     {'op': 'yolo', 'id', 'client', 'keep', 'originals'}  payload: one descriptor per frame
+#     {'op': 'ssd', 'id', 'client', 'shape'}  payload: the float32 blob
+#   reply:    [b'', JSON header, payload]
+#     yolo: {'id', 'status', 'counts'}  payload: the detection rows (float32, 8 columns)
+#     ssd:  {'id', 'status', 'shape'}   payload: the net output (float32)
+#
+# YOLO frames are batched across clients: a batch is filled one frame per
+# client in turn (the client served first rotates), so a controller with
+# many cameras does not starve one with few. The server keeps all classes
+# and each request's 'keep' filters its own rows.
+#
+DEFAULT_PORT = 9600
+DETECTION_COLUMNS = 8
+CLIENT_RINGS = itertools.count() # shm ring prefix per client in this process
+
+
+class ModelServer(object):
+    def __init__(self, detector, net, port=DEFAULT_PORT, cuda=False):
+        self.detector = detector # BatchDetector, keep_classes=None
+        self.net = net # Caffe MobileNet-SSD, or None
+        self.cuda = cuda
+        self.ctx = zmq.Context()
+        self.sock = self.ctx.socket(zmq.ROUTER)
+        self.sock.bind('tcp://127.0.0.1:{}'.format(port))
+        self.reply_sock = self.ctx.socket(zmq.PULL)
+        self.reply_sock.bind('inproc://model_server_replies')
+        self.reader = ShmRingReader()
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict() # client -> deque of [job, next frame]
+        self.queued = 0 # frames waiting in pending
+        self.rotation = 0
+        self.ssd_jobs = queue.Queue()
+        self.clients = collections.defaultdict(lambda: {'requests': 0, 'frames': 0, 'busy': 0.0, 'stale': 0})
+        for target in (self.run_socket, self.run_yolo, self.run_ssd):
+            th = threading.Thread(target=target)
+            th.daemon = True
+            th.start()
+
+    def reply(self, sock, peer, header, payload=b''):
+        sock.send_multipart([peer, b'', json.dumps(header).encode(), payload])
+
+    def run_socket(self):
+        poller = zmq.Poller()
+        poller.register(self.sock, zmq.POLLIN)
+        poller.register(self.reply_sock, zmq.POLLIN)
+        while True:
+            try:
+                events = dict(poller.poll())
+                if self.reply_sock in events:
+                    while True:
+                        try:
+                            self.sock.send_multipart(self.reply_sock.recv_multipart(zmq.NOBLOCK))
+                        except zmq.Again:
+                            break
+                if self.sock in events:
+                    parts = self.sock.recv_multipart()
+                    self.handle_request(parts[0], json.loads(parts[2].decode()), parts[3:])
+            except zmq.ContextTerminated:
+                return
+            except (ValueError, IndexError, KeyError) as e:
+                print('[ModelServer] bad request: {}'.format(e))
+
+    def handle_request(self, peer, header, payload):
+        op = header['op']
+        if op == 'info':
+            self.reply(self.sock, peer, {'id': header['id'], 'input_size': list(self.detector.input_size), 'cuda': self.cuda,
+                                         'ssd': self.net is not None})
+        elif op == 'yolo':
+            # copied out now: the client's ring slot may be reused after this
+            frames = [self.reader.read(desc) for desc in payload]
+            if any(frame is None for frame in frames):
+                self.clients[header['client']]['stale'] += 1
+                self.reply(self.sock, peer, {'id': header['id'], 'status': 'stale'})
+                return
+            job = {'peer': peer, 'id': header['id'], 'client': header['client'], 'keep': header.get('keep'),
+                   'frames': frames, 'originals': header.get('originals') or [None] * len(frames), 'results': [None] * len(frames), 'done': 0, 'arrival': time.time()}
+            with self.cond:
+                self.pending.setdefault(job['client'], collections.deque()).append([job, 0])
+                self.queued += len(frames)
+                self.cond.notify()
+        elif op == 'ssd':
+            blob = np.frombuffer(payload[0], dtype=np.float32).reshape(header['shape'])
+            self.ssd_jobs.put((peer, header, blob, time.time()))
+
+    #
+    # Up to max_batch (job, frame index) pairs, one per client in turn.
+    #
+    def take_batch(self):
+        batch = []
+        clients = list(self.pending)
+        start = self.rotation % len(clients)
+        self.rotation += 1
+        clients = clients[start:] + clients[:start]
+        while clients and len(batch) < self.detector.max_batch:
+            for client in list(clients):
+                jobs = self.pending[client]
+                job, index = jobs[0]
+                batch.append((job, index))
+                if index + 1 == len(job['frames']):
+                    jobs.popleft()
+                else:
+                    jobs[0][1] = index + 1
+                if not jobs:
+                    del self.pending[client]
+                    clients.remove(client)
+                if len(batch) == self.detector.max_batch:
+                    break
+        self.queued -= len(batch)
+        return batch
+
+    def run_yolo(self):
+        sock = self.ctx.socket(zmq.PUSH)
+        sock.connect('inproc://model_server_replies')
+        while True:
+            with self.cond:
+                while self.queued == 0:
+                    self.cond.wait()
+                # give other clients max_wait to fill the batch
+                deadline = time.time() + self.detector.max_wait
+                while self.queued < self.detector.max_batch and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                batch = self.take_batch()
+            s = time.time()
+            results = self.detector.detect([job['frames'][index] for job, index in batch], all_classes=True,
+                                           originals=[job['originals'][index] for job, index in batch])
+            busy = (time.time() - s) / len(batch)
+            for (job, index), detections in zip(batch, results):
+                if len(detections) != 0:
+                    if job['keep'] is not None:
+                        detections = detections[torch.isin(detections[:, -1], torch.tensor(job['keep'], dtype=detections.dtype))]
+                    detections[:, 0] = index # batch index within the request
+                job['results'][index] = detections
+                job['done'] += 1
+                stats = self.clients[job['client']]
+                stats['frames'] += 1
+                stats['busy'] += busy
+                if job['done'] == len(job['frames']):
+                    stats['requests'] += 1
+                    rows = [d.reshape(-1, DETECTION_COLUMNS) for d in job['results'] if len(d) != 0]
+                    payload = torch.cat(rows).numpy().astype(np.float32).tobytes() if rows else b''
+                    self.reply(sock, job['peer'], {'id': job['id'], 'status': 'ok',
+                                                   'counts': [len(d) for d in job['results']]}, payload)
+
+    def run_ssd(self):
+        sock = self.ctx.socket(zmq.PUSH)
+        sock.connect('inproc://model_server_replies')
+        while True:
+            peer, header, blob, arrival = self.ssd_jobs.get()
+            if self.net is None:
+                self.reply(sock, peer, {'id': header['id'], 'status': 'no ssd model'})
+                continue
+            s = time.time()
+            self.net.setInput(blob)
+            out = np.ascontiguousarray(self.net.forward(), dtype=np.float32)
+            stats = self.clients[header['client']]
+            stats['requests'] += 1
+            stats['frames'] += 1
+            stats['busy'] += time.time() - s
+            self.reply(sock, peer, {'id': header['id'], 'status': 'ok', 'shape': list(out.shape)}, out.tobytes())
+
+    def stats(self):
+        with self.cond:
+            return {'queued': self.queued, 'detector': self.detector.stats(),
+                    'clients': {c: dict(s) for c, s in self.clients.items()}}
+
+    def close(self):
+        self.ctx.destroy(linger=0)
+        self.reader.close()
+
+
+class RemoteCaffeNet(object):
+    def __init__(self, client):
+        self.client = client
+        self.local = threading.local()
+
+    def setInput(self, blob):
+        self.local.blob = blob
+
+    def forward(self):
+        return self.client.ssd(self.local.blob)
+
+
+#
+# Thin client of ModelServer, used by a controller in place of its own
+# BatchDetector (same detect()/stats()); caffe_net() stands in for the
+# cv2.dnn net. Each calling thread has its own socket. A request that
+# gets no reply in 'timeout' seconds returns no detections.
+#
+class ModelClient(object):
+    def __init__(self, address, name, keep_classes=None, timeout=10.0):
+        self.address = address
+        self.name = '{}-{}'.format(name, os.getpid())
+        self.keep_classes = keep_classes
+        self.timeout = timeout
+        self.ctx = zmq.Context()
+        self.local = threading.local()
+        self.writer = ShmRingWriter('aiotms{}'.format(next(CLIENT_RINGS)), 32)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.requests = 0
+        self.frames = 0
+        self.wait_time = 0.0
+        self.failed = 0
+        info = self.request({'op': 'info'})[0]
+        if info is None:
+            raise RuntimeError('no model server at {}'.format(address))
+        self.input_size = info['input_size']
+        self.cuda = info['cuda']
+
+    def socket(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = self.local.sock = self.ctx.socket(zmq.DEALER)
+            sock.connect(self.address)
+        return sock
+
+    def request(self, header, payload=()):
+        with self.lock:
+            self.next_id += 1
+            header['id'] = self.next_id
+        header['client'] = self.name
+        sock = self.socket()
+        sock.send_multipart([b'', json.dumps(header).encode()] + list(payload))
+        deadline = time.time() + self.timeout
+        while sock.poll(max(deadline - time.time(), 0) * 1000, zmq.POLLIN):
+            parts = sock.recv_multipart()
+            reply = json.loads(parts[1].decode())
+            if reply.get('id') == header['id']:
+                return reply, parts[2] if len(parts) > 2 else b''
+            # a late reply to a request that timed out
+        # no reply: start over with a fresh socket next time
+        sock.close(linger=0)
+        self.local.sock = None
+        return None, None
+
+    def detect(self, frames, all_classes=False, originals=None):
+        s = time.time()
+        keep = None if all_classes or self.keep_classes is None else list(self.keep_classes)
+        originals = None if originals is None else [None if o is None else list(o) for o in originals]
+        for _ in range(2): # once more if the server found a slot already reused
+            descs = [self.writer.write(frame) for frame in frames]
+            reply, payload = self.request({'op': 'yolo', 'keep': keep, 'originals': originals}, descs)
+            if reply is None or reply['status'] != 'stale':
+                break
+        with self.lock:
+            self.requests += 1
+            self.frames += len(frames)
+            self.wait_time += time.time() - s
+            if reply is None or reply['status'] != 'ok':
+                self.failed += 1
+        if reply is None or reply['status'] != 'ok':
+            print('[Controller] model server: {}'.format('no reply' if reply is None else reply['status']))
+            return [torch.tensor([], dtype=torch.float) for _ in frames]
+        rows = torch.from_numpy(np.frombuffer(payload, dtype=np.float32).copy()).view(-1, DETECTION_COLUMNS)
+        results = []
+        start = 0
+        for count in reply['counts']:
+            results.append(rows[start:start + count] if count else torch.tensor([], dtype=torch.float))
+            start += count
+        return results
+
+    def ssd(self, blob):
+        blob = np.ascontiguousarray(blob, dtype=np.float32)
+        reply, payload = self.request({'op': 'ssd', 'shape': list(blob.shape)}, [blob.tobytes()])
+        if reply is None or reply['status'] != 'ok':
+            print('[Controller] model server: {}'.format('no reply' if reply is None else reply['status']))
+            return np.zeros((1, 1, 0, 7), dtype=np.float32)
+        return np.frombuffer(payload, dtype=np.float32).reshape(reply['shape'])
+
+    def caffe_net(self):
+        return RemoteCaffeNet(self)
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'frames': self.frames, 'failed': self.failed,
+                    'mean_wait_ms': 1000.0 * self.wait_time / max(self.requests, 1)}
+
+    def close(self):
+        self.writer.close()
+        self.ctx.destroy(linger=0)
+
+
+if __name__ == '__main__':
+    from weight_cache import load_model, StartupTimer
+    from inference_backend import load_backend, BACKENDS
+    from batch_detector import BatchDetector
+    import psutil
+    startup = StartupTimer(psutil.Process().create_time())
+    startup.mark('imports')
+    parser = argparse.ArgumentParser(description="model server shared by the controllers on this host")
+    parser.add_argument('-p', '--port', type=int, default=None, help="listen port (default: [model_server] port of master.ini)")
+    parser.add_argument("--confidence", dest = "confidence", help = "Object Confidence to filter predictions", default = 0.6)
+    parser.add_argument("--nms_thresh", dest = "nms_thresh", help = "NMS Threshhold", default = 0.5)
+    parser.add_argument('-mb', '--maxbatch', type=int, default = 8, help = "max frames per detection batch")
+    parser.add_argument('-mw', '--maxwait', type=float, default = 0.005, help = "max seconds to wait for a fuller batch")
+    parser.add_argument('-be', '--backend', type=str, default = 'torch', choices = BACKENDS, help = "detector runtime")
+    parser.add_argument('-th', '--threads', type=int, default = 0, help = "detector intra-op threads (0: runtime default)")
+    parser.add_argument('-wc', '--weightcache', type=str, default = 'cache', help = "directory of the converted YOLO weights")
+    parser.add_argument('-sd', '--statsdump', type=float, default = 0, help = "print per-client stats every N seconds (0: off)")
+    ARGS = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('../resource/config/master.ini')
+    port = ARGS.port if ARGS.port is not None else int(config['model_server']['port'])
+
+    net = cv2.dnn.readNetFromCaffe(config['mSSD']['prototxt'], config['mSSD']['model'])
+    startup.mark('caffe model')
+    model, cached = load_model("cfg/yolov3.cfg", 'yolov3.weights', ARGS.weightcache)
+    startup.mark('yolo weights (cached)' if cached else 'yolo weights (cache miss)')
+    use_cuda = torch.cuda.is_available()
+    input_size = [int(model.net_info['height']), int(model.net_info['width'])]
+    backend = load_backend(ARGS.backend, model, input_size, use_cuda, ARGS.threads)
+    detector = BatchDetector(model, input_size, use_cuda, float(ARGS.confidence), float(ARGS.nms_thresh),
+                             ARGS.maxbatch, ARGS.maxwait, None, backend)
+    startup.mark('detector backend')
+    server = ModelServer(detector, net, port, use_cuda)
+    print(startup.report())
+    print('[ModelServer] serving on port {}'.format(port))
+
+    def signal_handler(sig, frame):
+        print('[ModelServer] ', server.stats())
+        server.close()
+        sys.exit(0)
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    while True:
+        time.sleep(ARGS.statsdump if ARGS.statsdump > 0 else 3600)
+        if ARGS.statsdump > 0:
+            print('[ModelServer] ', server.stats())
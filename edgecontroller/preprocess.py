@@ -0,0 +1,82 @@
+import threading
+import cv2
+import numpy as np
+import torch
+
+#
+# Letterboxing for the detector input: same result as cv_image2tensor in
+# util.py (scale preserving the aspect ratio, pad with gray 128, BGR->RGB,
+# HWC->CHW, /255), but without its per-frame allocations.
+# - frames are resized straight into a preallocated uint8 canvas per
+#   batch position; the gray padding is only refilled when the frame
+#   shape at that position changes
+# - channel swap, transpose and the conversion to float happen in one
+#   copy into the output tensor (pinned when it goes to the GPU)
+# interpolation defaults to INTER_LINEAR; pass cv2.INTER_CUBIC to get
+# exactly what cv_image2tensor gives.
+#
+class Letterboxer(object):
+    def __init__(self, input_size, interpolation=cv2.INTER_LINEAR, pin_memory=False):
+        self.input_size = input_size # (height, width)
+        self.interpolation = interpolation
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.lock = threading.Lock()
+        self.canvas = np.full((0, input_size[0], input_size[1], 3), 128, dtype=np.uint8)
+        self.layouts = [] # per batch position: (frame shape, (y0, x0, h, w)) of its last frame
+        self.pinned = None
+
+    #
+    # Where a frame of 'shape' goes in the canvas: (y0, x0, h, w).
+    #
+    def layout(self, shape):
+        h, w = shape[0:2]
+        newh, neww = self.input_size
+        scale = min(newh / h, neww / w)
+        img_h, img_w = int(h * scale), int(w * scale)
+        return (newh - img_h) // 2, (neww - img_w) // 2, img_h, img_w
+
+    def ensure(self, n):
+        if len(self.canvas) < n:
+            canvas = np.full((n,) + self.canvas.shape[1:], 128, dtype=np.uint8)
+            canvas[:len(self.canvas)] = self.canvas
+            self.canvas = canvas
+            self.layouts.extend([None] * (n - len(self.layouts)))
+
+    #
+    # Letterboxes 'img' into batch position i and returns the canvas (BGR,
+    # HWC, uint8). The canvas is reused by the next call for position i.
+    #
+    def letterbox_into(self, i, img):
+        canvas = self.canvas[i]
+        if self.layouts[i] is None or self.layouts[i][0] != img.shape:
+            self.layouts[i] = (img.shape, self.layout(img.shape))
+            canvas[:] = 128
+        y0, x0, h, w = self.layouts[i][1]
+        canvas[y0:y0 + h, x0:x0 + w] = cv2.resize(img, (w, h), interpolation=self.interpolation)
+        return canvas
+
+    def letterbox(self, frames):
+        with self.lock:
+            self.ensure(len(frames))
+            return np.stack([self.letterbox_into(i, img) for i, img in enumerate(frames)])
+
+    #
+    # Returns the network input for 'frames': a float tensor (N, 3, H, W)
+    # in RGB order, scaled to [0, 1].
+    #
+    def to_tensor(self, frames):
+        n = len(frames)
+        with self.lock:
+            self.ensure(n)
+            for i, img in enumerate(frames):
+                self.letterbox_into(i, img)
+            src = torch.from_numpy(self.canvas[:n])
+            if self.pin_memory:
+                if self.pinned is None or len(self.pinned) < n:
+                    self.pinned = torch.empty((n, 3) + tuple(self.input_size), dtype=torch.float).pin_memory()
+                out = self.pinned[:n]
+            else:
+                out = torch.empty((n, 3) + tuple(self.input_size), dtype=torch.float)
+            for c in range(3):
+                out[:, c].copy_(src[:, :, :, 2 - c]) # BGR -> RGB, HWC -> CHW, uint8 -> float
+            return out.div_(255.0)
@@ -0,0 +1,84 @@
+import threading
+import numpy as np
+
+#
+# Re-detection restricted to where the target is tracked. The region is
+# the union of the tracked boxes, each also moved to where the centroid
+# tracker expects it next, grown by 'margin' (fraction of the region's
+# width and height) and clipped to the frame. It goes through
+# 'roi_detector' (a BatchDetector at a smaller input size) and the boxes
+# are moved back to frame coordinates. If no person above 'confidence'
+# is found there, the full frame goes through 'detector' as before.
+#
+# Cost is counted in detector input pixels relative to one full-frame
+# pass (YOLO's forward time is about linear in them): a ROI hit at
+# 256x256 against 416x416 costs 0.38, a miss 1.38.
+#
+class RoiDetector(object):
+    def __init__(self, detector, roi_detector, confidence, margin=0.5, max_area=0.6):
+        self.detector = detector
+        self.roi_detector = roi_detector # None: always the full frame
+        self.confidence = confidence
+        self.margin = margin
+        self.max_area = max_area # larger regions (fraction of the frame) go full frame directly
+        self.roi_cost = 0.0
+        if roi_detector is not None:
+            self.roi_cost = float(roi_detector.input_size[0] * roi_detector.input_size[1]) / (detector.input_size[0] * detector.input_size[1])
+        self.lock = threading.Lock()
+        self.counts = {'roi': 0, 'fallback': 0, 'full': 0}
+        self.cost = 0.0
+
+    #
+    # (x1, y1, x2, y2) of the region to detect in for 'boxes' (x1, y1,
+    # x2, y2 in frame coordinates), None for the full frame.
+    #
+    def region(self, shape, boxes):
+        if self.roi_detector is None or len(boxes) == 0:
+            return None
+        h, w = shape[0:2]
+        boxes = np.asarray(boxes, dtype=np.float64)
+        x1, y1 = boxes[:, 0].min(), boxes[:, 1].min()
+        x2, y2 = boxes[:, 2].max(), boxes[:, 3].max()
+        mw, mh = (x2 - x1) * self.margin, (y2 - y1) * self.margin
+        x1, y1 = max(0, int(x1 - mw)), max(0, int(y1 - mh))
+        x2, y2 = min(w, int(x2 + mw)), min(h, int(y2 + mh))
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            return None # tracked boxes outside the frame
+        if (x2 - x1) * (y2 - y1) > self.max_area * w * h:
+            return None
+        return x1, y1, x2, y2
+
+    def found(self, detections):
+        return len(detections) != 0 and bool((detections[:, 6] > self.confidence).any())
+
+    #
+    # Returns the detections of 'frame' (as BatchDetector.detect for one
+    # frame), how they were found ('roi', 'fallback' or 'full') and the
+    # cost of finding them.
+    #
+    def detect(self, frame, boxes):
+        region = self.region(frame.shape, boxes)
+        if region is None:
+            mode, cost = 'full', 1.0
+            detections = self.detector.detect([frame])[0]
+        else:
+            x1, y1, x2, y2 = region
+            detections = self.roi_detector.detect([np.ascontiguousarray(frame[y1:y2, x1:x2])])[0]
+            if len(detections) != 0:
+                detections = detections.clone()
+                detections[:, [1, 3]] += x1
+                detections[:, [2, 4]] += y1
+            mode, cost = 'roi', self.roi_cost
+            if not self.found(detections):
+                mode, cost = 'fallback', self.roi_cost + 1.0
+                detections = self.detector.detect([frame])[0]
+        with self.lock:
+            self.counts[mode] += 1
+            self.cost += cost
+        return detections, mode, cost
+
+    def stats(self):
+        with self.lock:
+            passes = sum(self.counts.values())
+            mean_cost = self.cost / max(passes, 1)
+            return dict(self.counts, mean_cost=mean_cost, saved=1.0 - mean_cost if passes else 0.0)
@@ -0,0 +1,221 @@
+import collections
+import itertools
+import threading
+import time
+
+#
+# The targets the controller follows at once (-tr mt). A target is one
+# person: the camera it is on, its tracker there, its recent centroids,
+# the exit they predict and its handoff status:
+#  - tracking: on 'device_name'
+#  - handoff: predicted to leave towards 'neighbor'. That camera is
+#    switched on as well, and the first person detected there that is
+#    not one of its own targets becomes this target.
+# A target missed by max_misses re-detections in a row is lost, a
+# handoff after handoff_timeout seconds.
+#
+TRACKING = 'tracking'
+HANDOFF = 'handoff'
+
+
+class Target(object):
+    __slots__ = ('target_id', 'device_name', 'tracker', 'box', 'centroids', 'status', 'neighbor', 'exit',
+                 'handoff_time', 'misses', 'counter')
+
+    def __init__(self, target_id, device_name, tracker, box, counter, queuesize=10):
+        self.target_id = target_id
+        self.device_name = device_name
+        self.tracker = tracker
+        self.centroids = collections.deque(maxlen=queuesize)
+        self.status = TRACKING
+        self.neighbor = None # camera the target is handed off to
+        self.exit = None # predicted exit direction (RIGHT, LEFT, TOP, BOTTOM)
+        self.handoff_time = 0.0
+        self.misses = 0 # re-detections in a row that did not find it
+        self.observe(box, counter)
+
+    def observe(self, box, counter):
+        self.box = tuple(int(v) for v in box)
+        self.counter = counter
+        self.centroids.append(((self.box[0] + self.box[2]) / 2.0, (self.box[1] + self.box[3]) / 2.0))
+
+    def speed(self):
+        if len(self.centroids) < 2:
+            return 0.0
+        (x0, y0), (x1, y1) = self.centroids[0], self.centroids[-1]
+        return ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5 / (len(self.centroids) - 1)
+
+    #
+    # CentroidTracker.predict on the target's own centroids.
+    #
+    def predict(self, next_spot=30):
+        (x0, y0), (x1, y1) = self.centroids[0], self.centroids[-1]
+        size = self.centroids.maxlen
+        return (x1 - x0) / size * next_spot + x1, (y1 - y0) / size * next_spot + y1
+
+    #
+    # The side of a frame of 'shape' the target leaves by within
+    # 'next_spot' frames (the rule of checkboundary_dir), or None.
+    #
+    def exit_direction(self, shape, next_spot=30):
+        h, w = shape[0:2]
+        prex, prey = self.predict(next_spot)
+        if prey <= 0 and 0 < prex <= w:
+            return 'TOP'
+        if prex > w and 0 < prey <= h:
+            return 'RIGHT'
+        if prex <= 0 and 0 < prey <= h:
+            return 'LEFT'
+        if prey > h and 0 < prex <= w:
+            return 'BOTTOM'
+        return None
+
+
+def iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = float(w * h)
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
+
+
+class TargetTable(object):
+    def __init__(self, max_targets=4, max_misses=2, handoff_timeout=5.0, min_iou=0.3):
+        self.max_targets = max_targets
+        self.max_misses = max_misses
+        self.handoff_timeout = handoff_timeout
+        self.min_iou = min_iou
+        self.targets = collections.OrderedDict() # target id -> Target
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.handoffs = 0
+        self.lost = 0
+
+    def __len__(self):
+        return len(self.targets)
+
+    def on_device(self, device_name):
+        with self.lock:
+            return [t for t in self.targets.values() if t.device_name == device_name]
+
+    #
+    # Cameras with a target on them (not the handoff neighbours, see
+    # devices()): the cameras whose frames are tracked at full size.
+    #
+    def tracked_devices(self):
+        with self.lock:
+            return set(t.device_name for t in self.targets.values())
+
+    def devices(self):
+        with self.lock:
+            devices = set(t.device_name for t in self.targets.values())
+            devices.update(t.neighbor for t in self.targets.values() if t.status == HANDOFF)
+            return devices
+
+    #
+    # The boxes of the targets on a camera and where they are expected
+    # next, for the re-detection region.
+    #
+    def boxes(self, device_name):
+        boxes = []
+        for t in self.on_device(device_name):
+            boxes.append(t.box)
+            prex, prey = t.predict(1)
+            dx, dy = prex - t.centroids[-1][0], prey - t.centroids[-1][1]
+            boxes.append((t.box[0] + dx, t.box[1] + dy, t.box[2] + dx, t.box[3] + dy))
+        return boxes
+
+    #
+    # The person boxes of one detection pass on a camera's frame: each
+    # goes to the target of that camera it overlaps most, then to a target
+    # handed off to the camera, then becomes a new target while there is
+    # room. start(box) starts a tracker on the frame; it is slow, so it is
+    # called outside the lock and a decision the table no longer agrees
+    # with afterwards (e.g. the target expired meanwhile) is dropped.
+    #
+    def assign(self, device_name, counter, boxes, start):
+        with self.lock:
+            own = [t for t in self.targets.values() if t.device_name == device_name]
+            pairs = sorted(((iou(t.box, box), i, j) for i, t in enumerate(own) for j, box in enumerate(boxes)), reverse=True)
+            matched_targets, matched_boxes = set(), set()
+            matches = []
+            for overlap, i, j in pairs:
+                if overlap < self.min_iou:
+                    break
+                if i in matched_targets or j in matched_boxes:
+                    continue
+                matched_targets.add(i)
+                matched_boxes.add(j)
+                matches.append((own[i], boxes[j]))
+            missed = [t for i, t in enumerate(own) if i not in matched_targets]
+            rest = [box for j, box in enumerate(boxes) if j not in matched_boxes]
+            incoming = sorted((t for t in self.targets.values() if t.status == HANDOFF and t.neighbor == device_name),
+                              key=lambda t: t.handoff_time)
+            handoffs = list(zip(incoming, rest))
+            new = rest[len(handoffs):][:max(0, self.max_targets - len(self.targets))]
+
+        match_trackers = [start(box) for t, box in matches]
+        handoff_trackers = [start(box) for t, box in handoffs]
+        new_trackers = [start(box) for box in new]
+
+        with self.lock:
+            for (t, box), tracker in zip(matches, match_trackers):
+                if self.targets.get(t.target_id) is t and t.device_name == device_name:
+                    t.tracker = tracker
+                    t.observe(box, counter)
+                    t.misses = 0
+            for t in missed:
+                if t.device_name == device_name:
+                    t.misses += 1
+            for (t, box), tracker in zip(handoffs, handoff_trackers):
+                if self.targets.get(t.target_id) is not t or t.status != HANDOFF or t.neighbor != device_name:
+                    continue
+                print('[Targets] target {} handed off {} -> {}'.format(t.target_id, t.device_name, device_name))
+                t.device_name = device_name
+                t.tracker = tracker
+                t.centroids.clear()
+                t.observe(box, counter)
+                t.status, t.neighbor, t.exit, t.misses = TRACKING, None, None, 0
+                self.handoffs += 1
+            for box, tracker in zip(new, new_trackers):
+                if len(self.targets) >= self.max_targets:
+                    break
+                t = Target(next(self.ids), device_name, tracker, box, counter)
+                self.targets[t.target_id] = t
+                self.created += 1
+                print('[Targets] new target {} on {}'.format(t.target_id, device_name))
+
+    #
+    # After a tracked frame: the predicted exit of a target and the
+    # camera in that direction (None: no neighbour there). A target that
+    # no longer heads out while still seen goes back to tracking.
+    #
+    def handoff(self, target, direction, neighbor):
+        with self.lock:
+            target.exit = direction
+            if direction is None:
+                if target.status == HANDOFF and target.misses == 0:
+                    target.status, target.neighbor = TRACKING, None
+            elif neighbor is not None and (target.status != HANDOFF or target.neighbor != neighbor):
+                target.status, target.neighbor, target.handoff_time = HANDOFF, neighbor, time.time()
+
+    #
+    # Drops the lost targets and returns them. A target handed off is kept
+    # for handoff_timeout even when its own camera lost it.
+    #
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            lost = [t for t in self.targets.values()
+                    if t.misses >= self.max_misses and (t.status != HANDOFF or now - t.handoff_time > self.handoff_timeout)]
+            for t in lost:
+                del self.targets[t.target_id]
+            self.lost += len(lost)
+            return lost
+
+    def stats(self):
+        with self.lock:
+            return {'targets': [(t.target_id, t.device_name, t.status, t.neighbor) for t in self.targets.values()],
+                    'created': self.created, 'handoffs': self.handoffs, 'lost': self.lost}
@@ -6,48 +6,46 @@ import cv2
 import numpy as np
 
 # conduct objectness score filtering and non max supperssion
-def process_result(detection, obj_threshhold, nms_threshhold):
-    detection = to_corner(detection)
-    output = torch.tensor([], dtype=torch.float)
-
-    # do it batchwise and classwise
-    for batchi in range(detection.size(0)):
-        bboxes = detection[batchi]
-        bboxes = bboxes[bboxes[:, 4] > obj_threshhold]
-
-        if len(bboxes) == 0:
-            continue
-
-        # attributes of each bounding box: x1, y1, x2, y2, objectness score, prediction score, prediction index
-        pred_score, pred_index = torch.max(bboxes[:, 5:], 1)
-        pred_score = pred_score.unsqueeze(-1)
-        pred_index = pred_index.float().unsqueeze(-1)
-        bboxes = torch.cat((bboxes[:, :5], pred_score, pred_index), dim=1)
-        pred_classes = torch.unique(bboxes[:, -1])
-        #print("pred_score: ", pred_score)
-        #print("pred_index: ", pred_index)
-        #print("bboxes: ", bboxes)
-        #print("pred_classes", pred_classes)
-        # non max suppression for each predicted class
-
-        for cls in pred_classes:
-            bboxes_cls = bboxes[bboxes[:, -1] == cls]   # select boxes that predict the class
-            _, sort_indices = torch.sort(bboxes_cls[:, 4], descending=True)
-            bboxes_cls = bboxes_cls[sort_indices]   # sort by objectness score
-
-            # select the box with the highest score and get rid of intercepting boxes with big IOU
-            boxi = 0
-            while boxi + 1 < bboxes_cls.size(0):
-                ious = compute_ious(bboxes_cls[boxi], bboxes_cls[boxi+1:])
-                bboxes_cls = torch.cat([bboxes_cls[:boxi+1], bboxes_cls[boxi+1:][ious < nms_threshhold]])
-                boxi += 1
-
-            # add batch index as the first attribute
-            batch_idx_add = torch.full((bboxes_cls.size(0), 1), batchi)
-            bboxes_cls = torch.cat((batch_idx_add, bboxes_cls), dim=1)
-            output = torch.cat((output, bboxes_cls))
-
-    return output
+# keep_classes: class indices to keep (e.g. only person), None keeps all;
+# filtering before nms gives the same boxes as filtering its output
+def process_result(detection, obj_threshhold, nms_threshhold, keep_classes=None):
+    # attributes of each bounding box: batch index, x1, y1, x2, y2, objectness score, prediction score, prediction index
+    batch_idx, box_idx = torch.nonzero(detection[:, :, 4] > obj_threshhold, as_tuple=True)
+    bboxes = to_corner(detection[batch_idx, box_idx].unsqueeze(0))[0] # only the boxes above the threshold
+    pred_score, pred_index = torch.max(bboxes[:, 5:], 1)
+    bboxes = torch.cat((batch_idx.float().unsqueeze(-1), bboxes[:, :5], pred_score.unsqueeze(-1), pred_index.float().unsqueeze(-1)), dim=1)
+    if keep_classes is not None:
+        bboxes = bboxes[torch.isin(pred_index, torch.tensor(list(keep_classes), dtype=pred_index.dtype))]
+    if len(bboxes) == 0:
+        return torch.tensor([], dtype=torch.float)
+
+    # order of the output: by batch, then class, then objectness score (descending)
+    order = torch.sort(bboxes[:, 5], descending=True, stable=True)[1]
+    order = order[torch.sort(bboxes[order, -1], stable=True)[1]]
+    order = order[torch.sort(bboxes[order, 0], stable=True)[1]]
+    bboxes = bboxes[order]
+
+    # non max suppression: within a (batch, class) group, a box is
+    # suppressed by a kept box before it (higher score) that does not
+    # overlap it by less than nms_threshhold. The groups are contiguous
+    # after the sort; each one gets a single iou matrix, and the greedy
+    # pass only visits the boxes that are kept.
+    keep = np.zeros(len(bboxes), dtype=bool)
+    group = bboxes[:, 0] * (bboxes[:, -1].max() + 1) + bboxes[:, -1]
+    start = 0
+    for count in torch.unique_consecutive(group, return_counts=True)[1].tolist():
+        suppress = torch.triu(~(compute_iou_matrix(bboxes[start:start + count, 1:5]) < nms_threshhold), diagonal=1).numpy()
+        keep_group = keep[start:start + count]
+        keep_group[:] = True
+        boxi = 0
+        while True:
+            keep_group[boxi + 1:] &= ~suppress[boxi, boxi + 1:]
+            rest = np.flatnonzero(keep_group[boxi + 1:])
+            if len(rest) == 0:
+                break
+            boxi += 1 + rest[0]
+        start += count
+    return bboxes[torch.from_numpy(keep)]
 
 def to_corner(bboxes):
     newbboxes = bboxes.clone()
@@ -76,6 +74,25 @@ def compute_ious(target_box, comp_boxes):
     ious = intercept_areas / union_areas
     return ious
 
+# compute_ious of every box against every box: ious[i, j] is the iou of
+# target box i and box j (same arithmetic, so the values are identical)
+def compute_iou_matrix(boxes):
+    x1s, y1s, x2s, y2s = boxes[:, :4].transpose(0, 1)
+
+    interceptx1s = torch.max(x1s.unsqueeze(1), x1s.unsqueeze(0))
+    intercepty1s = torch.max(y1s.unsqueeze(1), y1s.unsqueeze(0))
+    interceptx2s = torch.min(x2s.unsqueeze(1), x2s.unsqueeze(0))
+    intercepty2s = torch.min(y2s.unsqueeze(1), y2s.unsqueeze(0))
+
+    intercept_areas = torch.clamp(interceptx2s - interceptx1s + 1, 0) * torch.clamp(intercepty2s - intercepty1s + 1, 0)
+
+    areas = (x2s - x1s + 1) * (y2s - y1s + 1)
+
+    union_areas = areas.unsqueeze(0) + areas.unsqueeze(1) - intercept_areas
+
+    ious = intercept_areas / union_areas
+    return ious
+
 def load_images(impath):
     if osp.isdir(impath):
         imlist = [osp.join(impath, img) for img in os.listdir(impath)]
@@ -109,8 +126,8 @@ def resize_image(img, size):
 
 # transform bouning box position in the resized image(input image to the network) to the corresponding position in the original image
 def transform_result(detections, imgs, input_size):
-    # get the original image dimensions
-    img_dims = [[img.shape[0], img.shape[1]] for img in imgs]
+    # get the original image dimensions (an image, or its (height, width))
+    img_dims = [[img[0], img[1]] if isinstance(img, tuple) else [img.shape[0], img.shape[1]] for img in imgs]
     img_dims = torch.tensor(img_dims, dtype=torch.float)
     img_dims = torch.index_select(img_dims, 0, detections[:, 0].long())
 
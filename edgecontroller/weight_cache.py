@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import struct
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from darknet import Darknet
+from inference_backend import fold_batchnorm
+
+#
+# Cache of converted YOLO weights, so that a controller restart does not
+# parse yolov3.weights and copy it layer by layer again.
+#
+# The cache file holds the batch-norm-folded state_dict of the model
+# (plus the anchors of the yolo layers) as float32 arrays:
+#   magic 'AIOTWGT1', header length (u32), JSON header
+#   {key, tensors: [[name, shape, offset]]}, then the arrays, 64-byte
+#   aligned
+# It is memory-mapped copy-on-write and the parameters are views on it,
+# so loading does not copy anything until the pages are used.
+#
+# The key hashes the cfg text and the weights file's size, mtime and
+# first and last MiB (hashing all of it would cost as much as parsing it).
+#
+FILE_MAGIC = b'AIOTWGT1'
+HEADER_STRUCT = struct.Struct('!8sI')
+ALIGN = 64
+
+
+def cache_key(cfg, weights):
+    h = hashlib.sha1()
+    with open(cfg, 'rb') as f:
+        h.update(f.read())
+    st = os.stat(weights)
+    h.update('{}:{}'.format(st.st_size, st.st_mtime_ns).encode())
+    with open(weights, 'rb') as f:
+        h.update(f.read(1 << 20))
+        f.seek(max(st.st_size - (1 << 20), 0))
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def yolo_layers(model):
+    return [(i, module) for i, module in enumerate(model.module_list) if hasattr(module, 'anchors')]
+
+
+def save_folded(model, path, key):
+    tensors = dict(model.state_dict())
+    for i, layer in yolo_layers(model):
+        tensors['module_list.{}.anchors'.format(i)] = layer.anchors
+    entries = []
+    offset = 0
+    for name, tensor in tensors.items():
+        entries.append([name, list(tensor.shape), offset])
+        offset += (tensor.numel() * 4 + ALIGN - 1) // ALIGN * ALIGN
+    header = json.dumps({'key': key, 'tensors': entries}).encode()
+    data_offset = (HEADER_STRUCT.size + len(header) + ALIGN - 1) // ALIGN * ALIGN
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER_STRUCT.pack(FILE_MAGIC, len(header)))
+        f.write(header)
+        for (name, shape, off), tensor in zip(entries, tensors.values()):
+            f.seek(data_offset + off)
+            f.write(tensor.detach().cpu().float().contiguous().numpy().tobytes())
+        f.truncate(data_offset + offset)
+    os.replace(tmp, path) # a killed controller never leaves half a cache file
+
+
+#
+# Darknet of 'cfg' with the folded layout (conv with bias, no batch
+# norm), built on the meta device: nothing is allocated or initialized.
+#
+def folded_skeleton(cfg):
+    with torch.device('meta'):
+        model = Darknet(cfg)
+        for module in model.module_list:
+            if isinstance(module, nn.Sequential) and len(module) > 1 and isinstance(module[1], nn.BatchNorm2d):
+                conv = module[0]
+                module[0] = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, bias=True)
+                module[1] = nn.Identity()
+    return model
+
+
+def load_folded(cfg, path, key):
+    with open(path, 'rb') as f:
+        magic, header_len = HEADER_STRUCT.unpack(f.read(HEADER_STRUCT.size))
+        if magic != FILE_MAGIC:
+            return None
+        header = json.loads(f.read(header_len).decode())
+    if header['key'] != key:
+        return None
+    data_offset = (HEADER_STRUCT.size + header_len + ALIGN - 1) // ALIGN * ALIGN
+    blob = np.memmap(path, dtype=np.float32, mode='c', offset=data_offset)
+    tensors = {}
+    for name, shape, offset in header['tensors']:
+        n = int(np.prod(shape)) if shape else 1
+        tensors[name] = torch.from_numpy(blob[offset // 4:offset // 4 + n].reshape(shape))
+    model = folded_skeleton(cfg)
+    for i, layer in yolo_layers(model):
+        layer.anchors = tensors.pop('module_list.{}.anchors'.format(i))
+    model.load_state_dict(tensors, assign=True)
+    return model.eval()
+
+
+#
+# Returns (model, cached): the batch-norm-folded YOLO model of cfg +
+# weights, from the cache in 'cache_dir' if it is there, else converted
+# from the weights file and written to the cache.
+#
+def load_model(cfg, weights, cache_dir='cache'):
+    key = cache_key(cfg, weights)
+    path = os.path.join(cache_dir, 'yolo_{}.wgt'.format(key[:16]))
+    if os.path.exists(path):
+        try:
+            model = load_folded(cfg, path, key)
+            if model is not None:
+                return model, True
+        except (ValueError, KeyError, RuntimeError) as e:
+            print('[Controller] ignoring broken weight cache {}: {}'.format(path, e))
+    model = Darknet(cfg)
+    model.load_weights(weights)
+    model = fold_batchnorm(model)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_folded(model, path, key)
+    except OSError as e:
+        print('[Controller] could not write weight cache {}: {}'.format(path, e))
+    return model, False
+
+
+#
+# Wall time of the startup phases of a controller, reported once setup
+# is done. The first phase starts when the process was created, so it
+# includes the imports.
+#
+class StartupTimer(object):
+    def __init__(self, process_start=None):
+        self.last = process_start if process_start is not None else time.time()
+        self.start = self.last
+        self.phases = []
+
+    def mark(self, name):
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        lines = ['[INFO] startup {:.2f}s'.format(self.last - self.start)]
+        for name, seconds in self.phases:
+            lines.append('         {:<20s} {:6.2f}s'.format(name, seconds))
+        return '\n'.join(lines)
@@ -2,15 +2,15 @@ import argparse
 import configparser
 import sys
 import time
-from datetime import datetime,date
+from datetime import datetime,date,timedelta
 sys.path.insert(0, '../../messaging')
 from message_bus import MessageBus
+from letterbox import letterbox_image
+from detection_interval import DetectionInterval, centroid_speeds, near_boundary
+from tracker_stage import TrackerStage, BACKENDS as TRACKER_BACKENDS
 from utils import visualize_output
 from utils import deserialize_output
 import mvnc.mvncapi as mvnc
-import base64
-import dlib
-import json
 import redis
 import cv2
 import numpy as np
@@ -20,7 +20,6 @@ import threading
 import imutils
 from imutils.object_detection import non_max_suppression
 import signal
-import ntplib
 import trackableobject 
 import centroidtracker
 import queue
@@ -58,11 +57,13 @@ class Hypervisor(object):
         self.controller_port = controller_port
 
         self.msg_bus = MessageBus(name, port, 'camera')
+        self.msg_bus.start_broadcaster() # device_list fan-out to the neighbours that join us
         self.msg_bus.register_callback('join', self.handle_message)
         self.msg_bus.register_callback('device_list', self.handle_message)
         self.msg_bus.register_callback('handoff_request', self.handle_message)
         self.msg_bus.register_callback('control_op', self.handle_message)
         self.msg_bus.register_callback('neighbor_op', self.handle_message)
+        self.msg_bus.register_callback('detector_config', self.handle_message)
         signal.signal(signal.SIGINT, self.signal_handler)
 
 
@@ -88,8 +89,10 @@ class Hypervisor(object):
         self.gettimegap()
         self.curframe = None # current frame for being cropped
         self.frame_skips = None # how many frames should be skipped before detection 
+        self.interval = None # DetectionInterval: when to detect again while tracking
         self.ct = None # centroid tracker
         self.trackers = [] 
+        self.tracker_stage = TrackerStage() # starts and updates the trackers, see tracker_stage.py
         self.trobs = {} # tracking objects
         self.boundary = {} # check if its on the boundary of the frame 0: top, 1: right, 2: bottom, 3: left
         self.objstatus = {} # objects current moving direction
@@ -104,22 +107,32 @@ class Hypervisor(object):
         # e1-2 
         self.cop = "True" # if this is set as True, it will start sending again.
         self.neighbor_op = False
+        self.frame_transport = 'binary' # binary (multipart header + jpeg) or json (base64 string)
+        self.neighbors = {} # direction -> device_name, announced when joining
+        self.detector_config = None # detector input size and letterbox policy per message type, from the controller
 
 
         self.frameq = queue.Queue()
         self.timeq = queue.Queue()
 
+    #
+    # Follows the controller's clock in the background (min-delay filtered
+    # probes, see MessageBus.start_clock_sync). Startup does not block:
+    # timegap stays 0 until the first sample arrives.
+    #
     def gettimegap(self):
-        starttime = datetime.now()
-        #ntp_response = ntplib.NTPClient().request('2.kr.pool.ntp.org', version=3)
-        ntp_response = ntplib.NTPClient().request('143.248.55.71', version=3)
-        returntime = datetime.now()
-        self.timegap =datetime.fromtimestamp(ntp_response.tx_time) - starttime - (returntime - starttime)/2
+        self.timegap = timedelta()
+        self.msg_bus.start_clock_sync(self.controller_ip, self.controller_port, on_update=self.set_timegap)
+
+    def set_timegap(self, offset, uncertainty):
+        self.timegap = timedelta(seconds=offset)
 #        print(gapdt) # 0:00:00.124
 #        self.timegap = time.mktime(gapdt.timetuple())
 #        print (self.timegap)
 
     def signal_handler(self, sig, frame):
+        if self.interval is not None:
+            print('[Hypervisor] detection interval: ', self.interval.stats())
         self.logfile.close()
         print('closing logfile, exiting')
         sys.exit(0)
@@ -135,8 +148,7 @@ class Hypervisor(object):
 
         elif msg_dict['type'] == 'device_list':
            # print(msg_dict)
-           device_list = json.loads(msg_dict['devices'])
-           self.handle_device_list(device_list.copy())
+           self.handle_device_list(msg_dict)
 
         elif msg_dict['type'] == 'handoff_request':
             # self.process_cropped_image_tracking(msg_dict)
@@ -149,25 +161,26 @@ class Hypervisor(object):
         elif msg_dict['type'] == 'neighbor_op':
             print("received: ", msg_dict['type'])
             self.neighbor_op = msg_dict['neighbor_op']
+
+        elif msg_dict['type'] == 'detector_config':
+            print("detector input: ", msg_dict['input_size'], msg_dict['policy'])
+            self.detector_config = msg_dict
         else:
             # Silently ignore invalid message types.
             pass
 
-    def handle_device_list(self, device_list):
-        for item in device_list:
-            if item['device_name'] == self.device_name:
-                continue
-            else:
-                # adding a node info that i am not aware of...
-                print(' - adding a new node_info: ', item['device_name'])
-                self.msg_bus.node_table.add_entry(item['device_name'], item['ip'], item['port'], item['location'], item['capability'])
+    #
+    # Full lists and deltas (after a gap the message bus refetches the
+    # full list from the broadcaster).
+    #
+    def handle_device_list(self, msg_dict):
+        if self.msg_bus.apply_device_list(msg_dict):
+            print(' - node_table: ', self.msg_bus.node_table.get_names())
 
     def process_cropped_image_tracking(self, msg_dict):
         print(' - received handoff request')
 
-        decstr = base64.b64decode(msg_dict['img_string'])
-        imgarray = np.fromstring(decstr, dtype=np.uint8)
-        self.tracking_template = cv2.imdecode(imgarray, cv2.IMREAD_COLOR)
+        self.tracking_template = MessageBus.decode_image(msg_dict)
         w = self.tracking_template.shape[0]
         h = self.tracking_template.shape[1]
         print(self.tracking_template.shape[0], self.tracking_template.shape[1])
@@ -191,8 +204,10 @@ class Hypervisor(object):
     def join(self):
         print("connecting to edge server")
         join_msg = dict(type='join', device_name=self.device_name, ip=self.device_ip_ext, port=self.device_port_ext,
-                        location='N1_823_1', capability='no')
+                        location='N1_823_1', capability='no', neighbors=self.neighbors)
         self.msg_bus.send_message_json(self.controller_ip, self.controller_port, join_msg)
+        # device_list and control_op updates come on the controller's broadcaster
+        self.msg_bus.subscribe_node(self.controller_ip, self.controller_port)
         
         # We might not need to join other cameras, just sent handoff-message!
 
@@ -200,8 +215,9 @@ class Hypervisor(object):
         if self.device_name == "camera02": #if this devices is center device
             print("connecting to left cam")
             join_msg = dict(type='join', device_name=device_name, ip=self.device_ip_ext, port=self.device_port_ext,
-                        location='N1_823_1', capability='no')
+                        location='N1_823_1', capability='no', neighbors=self.neighbors)
             self.msg_bus.send_message_json(self.left_device_ip_int, self.left_device_port, join_msg)
+            self.msg_bus.subscribe_node(self.left_device_ip_int, self.left_device_port)
             #print("connecting to right cam")
             #join_msg = dict(type='join', device_name=device_name, ip=self.device_ip_ext, port=self.device_port_ext,
             #            location='N1_823_1', capability='no')
@@ -210,8 +226,9 @@ class Hypervisor(object):
         elif self.device_name == "camera01": # if this devices is the left device
             print("connecting to center cam")
             join_msg = dict(type='join', device_name=device_name, ip=self.device_ip_ext, port=self.device_port_ext,
-                        location='N1_823_1', capability='no')
+                        location='N1_823_1', capability='no', neighbors=self.neighbors)
             self.msg_bus.send_message_json(self.center_device_ip_int, self.center_device_port, join_msg)
+            self.msg_bus.subscribe_node(self.center_device_ip_int, self.center_device_port)
             
             #print("connecting to right cam")
             #join_msg = dict(type='join', device_name=device_name, ip=self.device_ip_ext, port=self.device_port_ext,
@@ -231,16 +248,10 @@ class Hypervisor(object):
             '''
             
     def handle_join(self, msg_dict):
-        node_table = self.msg_bus.node_table
-        node_table.add_entry(msg_dict['device_name'], msg_dict['ip'], int(msg_dict['port']), msg_dict['location'], msg_dict['capability'])
+        # full device_list back to the new node, a delta to everybody else
+        self.msg_bus.add_joined_node(msg_dict)
         print('@@Table: ', self.msg_bus.node_table.table)
 
-        # Send node_table
-        device_list_json = {"type": "device_list", "devices": self.msg_bus.node_table.get_list_str()}
-        for node_name in node_table.table.keys():
-            node_info = node_table.table[node_name]
-            self.msg_bus.send_message_json(node_info.ip, int(node_info.port), device_list_json)
-
     def connect_redis_db(self, redis_port):
         self.redis_db = redis.Redis(host='localhost', port=redis_port, db=0)
 
@@ -354,6 +365,31 @@ class Hypervisor(object):
         del (a)
         return numobj
 
+    #
+    # Sends a frame to the controller with the configured transport.
+    # 'binary' sends a small header plus the raw JPEG as one multipart
+    # message (or the raw frame through shared memory when the controller
+    # runs on this host); 'json' keeps the old base64-in-JSON messages.
+    # With 'binary', message types the controller's detector_config marks
+    # 'letterbox' are sent as a canvas of the detector input size.
+    #
+    def send_frame_to_controller(self, msg_type, frame, framecnt, coord=None):
+        if self.frame_transport == 'binary':
+            original = None
+            config = self.detector_config
+            if config is not None and config['policy'].get(msg_type) == 'letterbox':
+                original = frame.shape[0:2]
+                frame = letterbox_image(frame, config['input_size'])
+            self.msg_bus.send_frame(self.controller_ip, self.controller_port, msg_type, frame, framecnt, self.encode_param, coord, self.timegap, original=original)
+            return
+        if msg_type == 'img_e2':
+            jsonified_data = MessageBus.create_e2_message(frame, framecnt, self.encode_param, self.device_name, coord, self.timegap)
+        elif msg_type == 'img_e1-2':
+            jsonified_data = MessageBus.create_raw_req_message(frame, framecnt, self.encode_param, self.device_name, self.timegap)
+        else:
+            jsonified_data = MessageBus.create_raw_message(frame, framecnt, self.encode_param, self.device_name, self.timegap)
+        self.msg_bus.send_message_str(self.controller_ip, self.controller_port, jsonified_data)
+
     #
     # Exsiting work (E1-1): sending at adjusted frame rate. 
     # this scheme just sends frames. no communication. 
@@ -383,13 +419,17 @@ class Hypervisor(object):
                 frame = self.frameq.get()
                 st = time.time()
                 dqtime = self.timeq.get()
+                if not self.msg_bus.acquire_send_credit(self.controller_ip, self.controller_port):
+                    # the controller is behind: drop at the source, before resizing/encoding
+                    print("[cam1] framecnt: "+str(framecnt)+" no credit, dropping frame")
+                    framecnt += 1
+                    continue
                 if(self.width == None and self.height == None):
                     self.width = frame.shape[1]
                     self.height = frame.shape[0]
                 frame = cv2.resize(frame, (self.width, self.height))
                 print("[cam1] framecnt: "+str(framecnt)+" estimated transmitting fps {0}".format(cumlative_fps))
-                jsonified_data = self.msg_bus.create_raw_message(frame, framecnt, self.encode_param, self.device_name,self.timegap)
-                self.msg_bus.send_message_str(self.controller_ip, self.controller_port, jsonified_data)
+                self.send_frame_to_controller('img_e1-1', frame, framecnt)
 
                 framecnt += 1
 
@@ -437,11 +477,13 @@ class Hypervisor(object):
                 if(self.width == None and self.height == None):
                     self.width = frame.shape[1]
                     self.height = frame.shape[0]
-                frame = cv2.resize(frame, (self.width, self.height))
                 print("framecnt: "+str(framecnt)+" estimated transmitting or dropping fps {0}".format(cumlative_fps))
-                if(self.cop == "True"):
-                    jsonified_data = self.msg_bus.create_raw_req_message(frame, framecnt, self.encode_param, self.device_name,self.timegap)
-                    self.msg_bus.send_message_str(self.controller_ip, self.controller_port, jsonified_data)
+                if(self.cop == "True" and not self.msg_bus.acquire_send_credit(self.controller_ip, self.controller_port)):
+                    # the controller is behind: drop at the source, before resizing/encoding
+                    print("framecnt: "+ str(framecnt)+" no credit, dropping frame")
+                elif(self.cop == "True"):
+                    frame = cv2.resize(frame, (self.width, self.height))
+                    self.send_frame_to_controller('img_e1-2', frame, framecnt)
                 else: # drop the frames. 
                     print("framecnt: "+ str(framecnt)+" dropping frames..")
 
@@ -860,7 +902,8 @@ class Hypervisor(object):
                 cpu = psutil.cpu_percent()
                 ram = psutil.virtual_memory()
 
-                if self.counter % self.frame_skips ==0:
+                if self.interval.due(self.counter):
+                    self.interval.detected(self.counter)
                     self.trackers = []
                     graph.LoadTensor(img, 'user object')
 
@@ -879,29 +922,20 @@ class Hypervisor(object):
                                 (y1, x1) = output_dict.get('detection_boxes_' + str(i))[0]
                                 (y2, x2) = output_dict.get('detection_boxes_' + str(i))[1]
                             
-                                tracker = dlib.correlation_tracker()
-                                rect = dlib.rectangle(x1, y1, x2, y2)
-                                tracker.start_track(rgb,rect)
-                                self.trackers.append(tracker)
+                                self.trackers.append(self.tracker_stage.start(rgb, (x1, y1, x2, y2)))
 
                                 
                 else:
-                    for tracker in self.trackers: 
-                        tracker.update(rgb)
-                        pos = tracker.get_position()
-                        startX = int(pos.left())
-                        startY = int(pos.top())
-                        endX = int(pos.right())
-                        endY = int(pos.bottom())
-                        positions.append((startX, startY, endX, endY))
+                    psrs, positions = self.tracker_stage.update(self.trackers, rgb)
+                    near = dict((objectID, near_boundary(centroid, frame.shape, self.framethr)) for objectID, centroid in list(self.ct.objects.items()))
+                    self.interval.observe(psrs, centroid_speeds(self.ct), near)
                 dett = time.time()
                 objects = self.ct.update(positions)
                 # prints all existing indexes.
                 #self.ct.getall()
                 if self.ct.checknumberofexisting() or self.neighbor_op:
                     print("[Tracking object EXIST] send to mars")
-                    k = MessageBus.create_det_message(frame, self.counter, self.encode_param, self.device_name,self.timegap)
-                    self.msg_bus.send_message_str(self.controller_ip, self.controller_port, k)
+                    self.send_frame_to_controller('img_e1-1', frame, self.counter)
                     self.sumframebytes+=sys.getsizeof(frame)
 #                    self.neighbor_op = False
                 transt = time.time()
@@ -1080,6 +1114,27 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--colormode', type=str,
                         default="bgr",
                         help="RGB vs BGR color sequence. This is network dependent.")
+    parser.add_argument('-ft', '--frametransport', type=str,
+                        default="binary",
+                        help="frame transport to the controller (binary, json)")
+    parser.add_argument('-aq', '--adaptivequality', type=str,
+                        default="on",
+                        help="adapt JPEG quality and downscale to the link and detector feedback (on, off)")
+    parser.add_argument('-qb', '--qualitybounds', type=int, nargs=2,
+                        default=[40, 95],
+                        help="JPEG quality range for adaptive encoding. ex. -qb 40 95")
+    parser.add_argument('-sb', '--scalebounds', type=float, nargs=2,
+                        default=[0.5, 1.0],
+                        help="downscale range for adaptive encoding. ex. -sb 0.5 1.0")
+    parser.add_argument('-shm', '--sharedmemory', type=str,
+                        default="on",
+                        help="send raw frames through shared memory if the controller is on this host (on, off)")
+    parser.add_argument('-sd', '--statsdump', type=float,
+                        default=0,
+                        help="print messaging latency stats every N seconds (0: off)")
+    parser.add_argument('-hb', '--heartbeat', type=float,
+                        default=2,
+                        help="send a heartbeat to the controller every N seconds (0: off)")
     parser.add_argument('-ln', '--logname', type=str,
                         default='logfile.txt',
                         help="your log filename name.")
@@ -1090,6 +1145,15 @@ if __name__ == '__main__':
     parser.add_argument('-sk', '--skipcount', type=int,
                         default=10,
                         help="number of skipping frames for object detection.")
+    parser.add_argument('-ib', '--intervalbounds', type=int, nargs=2,
+                        default=None,
+                        help="adapt the frames between detections while tracking to the trackers' confidence, motion and the frame boundary, within these bounds. ex. -ib 2 30 (default: every skipcount frames)")
+    parser.add_argument('-tb', '--trackerbackend', type=str,
+                        default="dlib", choices=TRACKER_BACKENDS,
+                        help="object trackers between detections (dlib, kcf, flow)")
+    parser.add_argument('-tt', '--trackerthreads', type=int,
+                        default=4,
+                        help="threads updating the trackers of a frame")
     parser.add_argument('-dt', '--disappear_thr', type=int,
                         default=20,
                         help="number of frames until frame is regarded as disappeared from tracking list.")
@@ -1124,11 +1188,13 @@ if __name__ == '__main__':
     #connection to other cameras 
     if(device_name == "camera01"):
         hyp.center_device_name = config['message_bus']['center_device_name']
+        hyp.neighbors['RIGHT'] = hyp.center_device_name
         hyp.center_device_port = config['message_bus']['center_device_port']
         hyp.center_device_ip_int = config['message_bus']['center_device_ip_int']
         hyp.center_device_ip_ext = config['message_bus']['center_device_ip_ext']
     elif(device_name == "camera02"):
         hyp.left_device_name = config['message_bus']['left_device_name']
+        hyp.neighbors['LEFT'] = hyp.left_device_name
         hyp.left_device_port = config['message_bus']['left_device_port']
         hyp.left_device_ip_int = config['message_bus']['left_device_ip_int']
         hyp.left_device_ip_ext = config['message_bus']['left_device_ip_ext']    
@@ -1141,6 +1207,8 @@ if __name__ == '__main__':
     
 
     hyp.join()
+    if ARGS.heartbeat > 0:
+        hyp.msg_bus.run_heartbeat(controller_ip, controller_port, ARGS.heartbeat)
     # Camera-related settings
 
     hyp.display = ARGS.display
@@ -1156,10 +1224,20 @@ if __name__ == '__main__':
     hyp.load_labels(ARGS.labels)
     hyp.logfile = open(ARGS.logname, 'w')
     hyp.frame_skips = ARGS.skipcount
+    bounds = ARGS.intervalbounds or (ARGS.skipcount, ARGS.skipcount)
+    hyp.interval = DetectionInterval(bounds[0], bounds[1], ARGS.skipcount)
+    hyp.tracker_stage = TrackerStage(ARGS.trackerbackend, ARGS.trackerthreads)
     hyp.framethr = ARGS.boundary_thr
     hyp.movingdelta = ARGS.movingdelta
     hyp.futuresteps = ARGS.futuresteps
     hyp.trackingscheme= ARGS.trackingscheme
+    hyp.frame_transport = ARGS.frametransport
+    hyp.msg_bus.shm_transport = ARGS.sharedmemory == "on"
+    if ARGS.adaptivequality == "on":
+        hyp.msg_bus.enable_adaptive_encoding(min_quality=ARGS.qualitybounds[0], max_quality=ARGS.qualitybounds[1],
+                                             min_scale=ARGS.scalebounds[0], max_scale=ARGS.scalebounds[1])
+    if ARGS.statsdump > 0:
+        hyp.msg_bus.run_stats_dump(ARGS.statsdump)
     #hyp.tr = ARGS.transmission
     hyp.ct = centroidtracker.CentroidTracker(maxDisappeared=ARGS.disappear_thr, maxDistance =50, queuesize = 10)
     # running in background to chug frames to queue
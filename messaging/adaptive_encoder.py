@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+import cv2
+
+#
+# Picks the JPEG quality and downscale factor of each frame within
+# configured bounds, so that a frame fits the measured link:
+#  - bandwidth: bytes / (send time - rtt) of recent frames (EWMA)
+#  - rtt: the clock-sync round trip when known, otherwise a slowly
+#    rising minimum of the send (ack) times
+#  - controller feedback: the detector's recent person confidence. While the
+#    detector is unsure the quality/scale floor is raised towards the maxima;
+#    when it is confident the full range may be used.
+# A frame budget of 'utilization' x bandwidth / target_fps bytes is the
+# goal. Over budget: quality goes down first, then the scale. Well under
+# budget: scale goes up first, then the quality.
+#
+class AdaptiveEncoder(object):
+    def __init__(self, min_quality=40, max_quality=95, min_scale=0.5, max_scale=1.0,
+                 target_fps=15.0, utilization=0.8, rtt_limit=0.2,
+                 conf_low=0.5, conf_high=0.8, feedback_ttl=5.0):
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.target_fps = target_fps
+        self.utilization = utilization
+        self.rtt_limit = rtt_limit
+        self.conf_low = conf_low
+        self.conf_high = conf_high
+        self.feedback_ttl = feedback_ttl
+        self.lock = threading.Lock()
+        self.quality = max_quality
+        self.scale = max_scale
+        self.bandwidth = None # bytes/s
+        self.rtt = None # s
+        self.last_bytes = None
+        self.confidence = None
+        self.confidence_time = 0.0
+
+    def on_feedback(self, confidence):
+        with self.lock:
+            self.confidence = confidence
+            self.confidence_time = time.time()
+
+    #
+    # 'duration' is the time from send to ack; failed sends count as a
+    # congested link.
+    #
+    def on_sent(self, nbytes, duration, acked=True, rtt=None):
+        with self.lock:
+            self.last_bytes = nbytes
+            if not acked:
+                self.bandwidth = self.bandwidth * 0.5 if self.bandwidth else None
+            else:
+                if rtt is not None:
+                    self.rtt = rtt
+                else:
+                    self.rtt = duration if self.rtt is None else min(duration, self.rtt * 1.05)
+                transfer = max(duration - self.rtt, 1e-3)
+                sample = nbytes / transfer
+                self.bandwidth = sample if self.bandwidth is None else 0.8 * self.bandwidth + 0.2 * sample
+            self.adapt()
+
+    #
+    # 0 (unsure, keep the image good) .. 1 (confident, may degrade).
+    #
+    def degrade_allowance(self):
+        if self.confidence is None or time.time() - self.confidence_time > self.feedback_ttl:
+            return 1.0
+        a = (self.confidence - self.conf_low) / (self.conf_high - self.conf_low)
+        return min(1.0, max(0.0, a))
+
+    # Caller must hold self.lock.
+    def adapt(self):
+        if self.bandwidth is None or self.last_bytes is None:
+            return
+        allow = self.degrade_allowance()
+        quality_floor = self.max_quality - allow * (self.max_quality - self.min_quality)
+        scale_floor = self.max_scale - allow * (self.max_scale - self.min_scale)
+        budget = self.utilization * self.bandwidth / self.target_fps
+        congested = self.rtt is not None and self.rtt > self.rtt_limit
+        if self.last_bytes > budget or congested:
+            if self.quality - 5 >= quality_floor:
+                self.quality -= 5
+            elif self.scale * 0.9 >= scale_floor:
+                self.scale *= 0.9
+        elif self.last_bytes < 0.6 * budget:
+            if self.scale < self.max_scale:
+                self.scale = min(self.max_scale, self.scale / 0.9)
+            elif self.quality < self.max_quality:
+                self.quality = min(self.max_quality, self.quality + 5)
+        # feedback may have raised the floors
+        self.quality = int(max(self.quality, quality_floor))
+        self.scale = max(self.scale, scale_floor)
+
+    def settings(self):
+        with self.lock:
+            return self.quality, self.scale
+
+    #
+    # Returns (image to encode, encode_param, scale).
+    #
+    def prepare(self, img):
+        quality, scale = self.settings()
+        if scale < 0.999:
+            width = img.shape[1]
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            scale = img.shape[1] / float(width) # the exact ratio, to restore the size
+        else:
+            scale = 1.0
+        return img, [int(cv2.IMWRITE_JPEG_QUALITY), quality], scale
+
+    def stats(self):
+        with self.lock:
+            return {'quality': self.quality, 'scale': self.scale, 'bandwidth': self.bandwidth,
+                    'rtt': self.rtt, 'confidence': self.confidence}
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import struct
+import threading
+import zmq
+
+#
+# Broadcast channel for membership and control updates (device_list,
+# control_op), replacing one REQ/REP round trip per node.
+#
+# Every update is a three-part PUB message [topic, seq, json] where seq is
+# a sequence number shared by all topics of one publisher. The publisher
+# keeps the last update of every topic, and serves them on a snapshot
+# socket (port + 1) so a late joiner can resync: it subscribes first,
+# fetches the snapshot, and then skips live updates it already has.
+# Topics are last-value state, so a lost update is repaired by the next one.
+# An update may also be a delta: publish(topic, delta, state) sends the
+# delta live but keeps the full 'state' for snapshots, and a subscriber
+# that finds a gap in the deltas calls resync(topic) to fetch it again.
+#
+SEQ_STRUCT = struct.Struct('!Q')
+SNAPSHOT_REQ = b'snapshot'
+
+
+def control_topic(device_name):
+    return 'control_op/{}'.format(device_name)
+
+
+def config_topic(device_name):
+    return 'detector_config/{}'.format(device_name)
+
+
+class Broadcaster(object):
+    def __init__(self, ctx, port):
+        self.port = port
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.state = {} # topic -> (seq, msg_dict) of its last update
+        self.pub = ctx.socket(zmq.PUB)
+        self.pub.bind('tcp://*:{}'.format(port))
+        self.snap = ctx.socket(zmq.ROUTER)
+        self.snap.bind('tcp://*:{}'.format(port + 1))
+        th = threading.Thread(target=self.run_snapshot_server)
+        th.daemon = True
+        th.start()
+
+    def publish(self, topic, msg_dict, state=None):
+        with self.lock:
+            self.seq += 1
+            self.state[topic] = (self.seq, msg_dict if state is None else state)
+            self.pub.send_multipart([topic.encode(), SEQ_STRUCT.pack(self.seq), json.dumps(msg_dict).encode()])
+            return self.seq
+
+    def snapshot(self):
+        with self.lock:
+            return {'seq': self.seq, 'state': {t: [s, m] for t, (s, m) in self.state.items()}}
+
+    def run_snapshot_server(self):
+        while True:
+            try:
+                peer, _, req = self.snap.recv_multipart()
+            except zmq.ContextTerminated:
+                return
+            if req == SNAPSHOT_REQ:
+                self.snap.send_multipart([peer, b'', json.dumps(self.snapshot()).encode()])
+
+
+#
+# Follows one publisher and hands every update of 'topics' to
+# callback(msg_str), in sequence order.
+#
+class Subscriber(object):
+    def __init__(self, ctx, ip, port, topics, callback, timeout=1000):
+        self.ctx = ctx
+        self.ip = ip
+        self.port = port
+        self.topics = set(topics)
+        self.callback = callback
+        self.timeout = timeout
+        self.seen = {} # topic -> last applied seq
+        self.synced = False
+        self.sub = ctx.socket(zmq.SUB)
+        self.sub.connect('tcp://{}:{}'.format(ip, port))
+        for topic in self.topics:
+            self.sub.setsockopt(zmq.SUBSCRIBE, topic.encode())
+        th = threading.Thread(target=self.run)
+        th.daemon = True
+        th.start()
+
+    def apply(self, topic, seq, msg_str):
+        if topic not in self.topics or seq <= self.seen.get(topic, 0):
+            return
+        self.seen[topic] = seq
+        self.callback(msg_str)
+
+    #
+    # Drops what was applied of 'topic' and fetches the snapshot again
+    # (from the subscriber thread, before the next live update).
+    #
+    def resync(self, topic):
+        self.seen.pop(topic, None)
+        self.synced = False
+
+    #
+    # Asks the publisher for its last-value state. The SUB socket is
+    # already connected, so nothing published after the snapshot is lost.
+    #
+    def fetch_snapshot(self):
+        sock = self.ctx.socket(zmq.DEALER)
+        sock.connect('tcp://{}:{}'.format(self.ip, self.port + 1))
+        try:
+            sock.send_multipart([b'', SNAPSHOT_REQ])
+            if not sock.poll(self.timeout, zmq.POLLIN):
+                print('[MESSAGING] no snapshot from {}:{}, retrying'.format(self.ip, self.port + 1))
+                return False
+            snap = json.loads(sock.recv_multipart()[-1].decode())
+        finally:
+            sock.close(linger=0)
+        for topic, (seq, msg_dict) in sorted(snap['state'].items(), key=lambda item: item[1][0]):
+            self.apply(topic, seq, json.dumps(msg_dict))
+        print('[MESSAGING] synced with {}:{} at seq {}'.format(self.ip, self.port, snap['seq']))
+        return True
+
+    def run(self):
+        while True:
+            try:
+                if not self.synced:
+                    self.synced = self.fetch_snapshot()
+                if not self.sub.poll(self.timeout, zmq.POLLIN):
+                    continue
+                topic, seq, msg = self.sub.recv_multipart()
+            except zmq.ContextTerminated:
+                return
+            self.apply(topic.decode(), SEQ_STRUCT.unpack(seq)[0], msg.decode())
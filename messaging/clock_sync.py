@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import struct
+import threading
+import time
+import zmq
+
+#
+# Peer-to-peer clock offset estimation (NTP-style).
+# A reference node (normally the controller) runs a ClockServer; other nodes
+# run a ClockSync that probes it in small bursts. Each probe gives
+#   offset = ((t2 - t1) + (t3 - t4)) / 2
+#   delay  = (t4 - t1) - (t3 - t2)
+# and, like the NTP clock filter, the sample with the smallest delay in the
+# recent window is trusted most, since queueing only adds delay.
+#
+PROBE_STRUCT = struct.Struct('!d')
+REPLY_STRUCT = struct.Struct('!ddd')
+DRIFT_RATE = 15e-6 # assumed worst-case clock drift (s/s) for the uncertainty
+
+
+class ClockServer(object):
+    def __init__(self, ctx, port, offset_fn=None):
+        self.port = port
+        self.offset_fn = offset_fn # the server's own offset, if it is not the reference
+        self.sock = ctx.socket(zmq.ROUTER)
+        self.sock.bind('tcp://*:{}'.format(port))
+        th = threading.Thread(target=self.run)
+        th.daemon = True
+        th.start()
+
+    def now(self):
+        return time.time() + (self.offset_fn() if self.offset_fn is not None else 0.0)
+
+    def run(self):
+        while True:
+            try:
+                peer, _, probe = self.sock.recv_multipart()
+                t2 = self.now()
+                t1, = PROBE_STRUCT.unpack(probe)
+                self.sock.send_multipart([peer, b'', REPLY_STRUCT.pack(t1, t2, self.now())])
+            except zmq.ContextTerminated:
+                return
+            except struct.error:
+                continue
+
+
+class ClockSync(object):
+    def __init__(self, ctx, ip, port, interval=10.0, burst=4, window=32, timeout=1000, on_update=None):
+        self.ctx = ctx
+        self.ip = ip
+        self.port = port
+        self.interval = interval
+        self.burst = burst
+        self.timeout = timeout
+        self.on_update = on_update
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=window) # (offset, delay, local time)
+        self.offset = 0.0
+        self.uncertainty = None # unknown until the first sample
+        self.delay = None # round trip of the best sample
+        self.failures = 0
+        th = threading.Thread(target=self.run)
+        th.daemon = True
+        th.start()
+
+    def probe(self, sock):
+        t1 = time.time()
+        sock.send_multipart([b'', PROBE_STRUCT.pack(t1)])
+        if not sock.poll(self.timeout, zmq.POLLIN):
+            return None
+        t4 = time.time()
+        r1, t2, t3 = REPLY_STRUCT.unpack(sock.recv_multipart()[-1])
+        if r1 != t1:
+            return None # a late reply to an earlier probe
+        return ((t2 - t1) + (t3 - t4)) / 2.0, (t4 - t1) - (t3 - t2), t4
+
+    def update(self):
+        now = time.time()
+        with self.lock:
+            best = min(self.samples, key=lambda s: s[1])
+            offsets = [s[0] for s in self.samples]
+            jitter = (sum((o - best[0]) ** 2 for o in offsets) / len(offsets)) ** 0.5
+            self.offset = best[0]
+            self.delay = best[1]
+            self.uncertainty = best[1] / 2.0 + DRIFT_RATE * (now - best[2]) + jitter
+            offset, uncertainty = self.offset, self.uncertainty
+        if self.on_update is not None:
+            self.on_update(offset, uncertainty)
+
+    def run(self):
+        sock = None
+        while True:
+            try:
+                if sock is None:
+                    sock = self.ctx.socket(zmq.DEALER)
+                    sock.connect('tcp://{}:{}'.format(self.ip, self.port))
+                got = 0
+                for _ in range(self.burst):
+                    sample = self.probe(sock)
+                    if sample is None:
+                        # no reply: start over with a fresh socket next round
+                        sock.close(linger=0)
+                        sock = None
+                        break
+                    with self.lock:
+                        self.samples.append(sample)
+                    got += 1
+                if got > 0:
+                    self.failures = 0
+                    self.update()
+                else:
+                    self.failures += 1
+                    print('[MESSAGING] no clock reply from {}:{} ({} rounds)'.format(self.ip, self.port, self.failures))
+            except zmq.ContextTerminated:
+                return
+            time.sleep(self.interval)
+
+    def get_offset(self):
+        with self.lock:
+            return self.offset, self.uncertainty
@@ -0,0 +1,8 @@
+import os
+import sys
+
+#
+# The modules in this directory import each other by their flat names
+# (as the controllers do with sys.path.insert(0, '../messaging')).
+#
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
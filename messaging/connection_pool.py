@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import time
+import zmq
+
+
+#
+# A long-lived channel to one peer listener (a ROUTER socket, see
+# MessageBus.run_router_listener).
+# DEALER is used instead of REQ so that a channel can also send without
+# waiting for the ack; acks of such sends are drained lazily later on.
+# Frames an ack carries after the ack string (e.g. send credits) are
+# passed to on_ack(ip, port, frames).
+# Sends never block: the socket only queues for a connected peer
+# (IMMEDIATE) and at most 'max_pending' messages (SNDHWM); a message that
+# does not fit is dropped. A peer that leaves more than 'max_pending' acks
+# unread gets a fresh socket.
+#
+class Channel(object):
+    def __init__(self, ctx, ip, port, on_ack=None, max_pending=100, connect_wait=100):
+        self.ctx = ctx
+        self.on_ack = on_ack
+        self.max_pending = max_pending
+        self.connect_wait = connect_wait # ms after connect() a send without ack waits for the peer
+        self.ip = ip
+        self.port = port
+        self.lock = threading.Lock()
+        self.sock = None
+        self.connected_at = 0.0
+        self.pending_acks = 0 # sent messages whose ack was not read yet
+        self.users = 0 # guarded by the pool lock
+        self.last_used = time.time()
+
+    def connect(self):
+        self.sock = self.ctx.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.IMMEDIATE, 1)
+        self.sock.setsockopt(zmq.SNDHWM, self.max_pending)
+        self.sock.connect('tcp://{}:{}'.format(self.ip, self.port))
+        self.connected_at = time.time()
+        self.pending_acks = 0
+
+    def close(self, linger=1000):
+        if self.sock is not None:
+            self.sock.close(linger=linger)
+            self.sock = None
+        self.pending_acks = 0
+
+    #
+    # Each ack is [b'', ack, extra...] because the listener keeps the
+    # empty delimiter. Returns the ack string.
+    #
+    def read_ack(self, flags=0):
+        frames = self.sock.recv_multipart(flags)
+        self.pending_acks -= 1
+        if len(frames) > 2 and self.on_ack is not None:
+            self.on_ack(self.ip, self.port, frames[2:])
+        return frames[1]
+
+    #
+    # Reads acks that already arrived without blocking.
+    #
+    def drain_acks(self):
+        rep = None
+        while self.pending_acks > 0:
+            try:
+                rep = self.read_ack(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        return rep
+
+    #
+    # Blocks until every pending ack is read or timeout (ms) expires.
+    # Returns the last ack, which belongs to the most recent send.
+    #
+    def wait_acks(self, timeout):
+        rep = None
+        deadline = time.time() + timeout / 1000.0
+        while self.pending_acks > 0:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0 or not self.sock.poll(remaining, zmq.POLLIN):
+                return None
+            rep = self.read_ack()
+        return rep
+
+    #
+    # Sends a list of frames and optionally waits for the ack.
+    # A peer that does not ack within the timeout gets a fresh socket
+    # (lazy pirate pattern) and the message is resent up to 'retries' times;
+    # only idempotent messages should be retried, since the first copy may
+    # have arrived with just its ack late. Returns None if the message
+    # was not acked, or, without wait_ack, could not be queued.
+    #
+    def send(self, frames, wait_ack=True, timeout=3000, retries=1):
+        with self.lock:
+            self.last_used = time.time()
+            for attempt in range(retries + 1):
+                if self.sock is None:
+                    self.connect()
+                self.drain_acks()
+                if self.pending_acks >= self.max_pending:
+                    print('[MESSAGING] {} unread acks from {}:{}, reconnecting'.format(self.pending_acks, self.ip, self.port))
+                    self.close(linger=0)
+                    self.connect()
+                try:
+                    # a new socket may still be connecting: wait a little for it
+                    wait = timeout if wait_ack else max(0, int(self.connect_wait - (time.time() - self.connected_at) * 1000))
+                    if not self.sock.poll(wait, zmq.POLLOUT):
+                        raise zmq.Again()
+                    self.sock.send_multipart([b''] + list(frames), zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    if not wait_ack:
+                        return None
+                else:
+                    self.pending_acks += 1
+                    if not wait_ack:
+                        return b''
+                    rep = self.wait_acks(timeout)
+                    if rep is not None:
+                        return rep
+                print('[MESSAGING] no ack from {}:{}, reconnecting ({}/{})'.format(self.ip, self.port, attempt + 1, retries + 1))
+                self.close(linger=0)
+            return None
+
+
+#
+# Keeps one channel per (ip, port) so that senders do not pay a TCP
+# handshake per message and the number of open sockets stays bounded.
+# Channels idle for more than 'idle_timeout' seconds are closed, and the
+# least recently used one is closed when 'max_channels' is exceeded.
+#
+class ConnectionPool(object):
+    def __init__(self, ctx, max_channels=64, idle_timeout=60.0, on_ack=None):
+        self.ctx = ctx
+        self.on_ack = on_ack
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.channels = collections.OrderedDict() # (ip, port) -> Channel, LRU first
+        self.last_reap = time.time()
+
+    def acquire(self, ip, port):
+        key = (str(ip), int(port))
+        with self.lock:
+            ch = self.channels.pop(key, None)
+            if ch is None:
+                ch = Channel(self.ctx, key[0], key[1], self.on_ack)
+            self.channels[key] = ch
+            ch.users += 1
+            self.release_idle()
+            self.evict_overflow()
+        return ch
+
+    def release(self, ch):
+        with self.lock:
+            ch.users -= 1
+
+    def send(self, ip, port, frames, wait_ack=True, timeout=3000, retries=1):
+        ch = self.acquire(ip, port)
+        try:
+            return ch.send(frames, wait_ack, timeout, retries)
+        finally:
+            self.release(ch)
+
+    # Caller must hold self.lock.
+    def release_idle(self):
+        now = time.time()
+        if now - self.last_reap < self.idle_timeout / 4.0:
+            return
+        self.last_reap = now
+        for key, ch in list(self.channels.items()):
+            if ch.users == 0 and now - ch.last_used > self.idle_timeout:
+                print('[MESSAGING] closing idle channel to {}:{}'.format(key[0], key[1]))
+                del self.channels[key]
+                ch.close()
+
+    # Caller must hold self.lock.
+    def evict_overflow(self):
+        for key, ch in list(self.channels.items()):
+            if len(self.channels) <= self.max_channels:
+                break
+            if ch.users == 0:
+                del self.channels[key]
+                ch.close()
+
+    def stats(self):
+        with self.lock:
+            return {'channels': len(self.channels),
+                    'pending_acks': sum(ch.pending_acks for ch in self.channels.values())}
+
+    def close_all(self):
+        with self.lock:
+            for ch in self.channels.values():
+                ch.close(linger=0)
+            self.channels.clear()
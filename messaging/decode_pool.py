@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import threading
+import time
+import cv2
+from shm_ring import ShmRingWriter, ShmRingReader
+from frame_codec import decode_jpeg
+
+#
+# JPEG decoding in separate processes, so that decoding frames from many
+# cameras does not compete for the GIL with the controller's detection
+# and tracking loop.
+#
+# Every worker process decodes into its own shared-memory ring
+# (shm_ring.py) and only sends the slot descriptor back; the caller's
+# thread copies the frame out of the slot. A worker has at most half its
+# ring slots in flight, so a slot is never reused before it is read.
+#
+# The workers are forked, so the pool has to be created before the
+# process starts threads or a ZMQ context (MessageBus creates it first
+# thing); spawning them instead would re-import the controller, torch
+# included, in every worker.
+#
+def run_decode_worker(index, jobs, results, slots):
+    cv2.setNumThreads(1)
+    writer = ShmRingWriter('aiotdec{}'.format(index), slots)
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            job_id, buf, scale = job
+            s = time.time()
+            img = decode_jpeg(buf, scale)
+            desc = writer.write(img) if img is not None else None
+            results.put((index, job_id, desc, time.time() - s))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+
+
+class DecodePool(object):
+    def __init__(self, num_procs=2, slots=16):
+        ctx = multiprocessing.get_context('fork')
+        self.reader = ShmRingReader()
+        self.lock = threading.Lock()
+        self.results = ctx.Queue()
+        self.jobs = []
+        self.procs = []
+        self.room = []
+        self.inflight = [0] * num_procs
+        self.usable = [True] * num_procs # False once the worker died
+        self.waiting = {} # job id -> [event, descriptor]
+        self.next_id = 0
+        self.decoded = [0] * num_procs
+        self.busy_time = [0.0] * num_procs
+        self.failed = 0
+        self.starttime = time.time()
+        for i in range(num_procs):
+            jobs = ctx.Queue()
+            proc = ctx.Process(target=run_decode_worker, args=(i, jobs, self.results, slots))
+            proc.daemon = True
+            proc.start()
+            self.jobs.append(jobs)
+            self.procs.append(proc)
+            self.room.append(threading.BoundedSemaphore(max(slots // 2, 1)))
+        th = threading.Thread(target=self.run_collector)
+        th.daemon = True
+        th.start()
+
+    def run_collector(self):
+        while True:
+            try:
+                index, job_id, desc, busy = self.results.get()
+            except (EOFError, OSError):
+                return
+            with self.lock:
+                self.decoded[index] += 1
+                self.busy_time[index] += busy
+                waiter = self.waiting.pop(job_id, None)
+            if waiter is not None:
+                waiter[1] = desc
+                waiter[0].set()
+
+    #
+    # The live worker with the fewest jobs in flight, or None if all died.
+    # A dead worker is not used again (it is not respawned: forking once
+    # the process has threads is not safe).
+    # Caller must hold self.lock.
+    #
+    def pick_worker(self):
+        for i, proc in enumerate(self.procs):
+            if self.usable[i] and not proc.is_alive():
+                print('[MESSAGING] decode worker {} died (exit code {}), decoding without it'.format(i, proc.exitcode))
+                self.usable[i] = False
+        live = [i for i in range(len(self.procs)) if self.usable[i]]
+        if not live:
+            return None
+        return min(live, key=lambda i: self.inflight[i])
+
+    #
+    # Decodes a JPEG (bytes-like) on the least loaded worker and returns
+    # the image, or None if it could not be decoded. Blocks the calling
+    # thread only, without holding the GIL. With no live worker left, or
+    # if the worker dies or times out, it decodes in the calling thread.
+    #
+    def decode(self, buf, scale=1.0, timeout=5.0):
+        with self.lock:
+            index = self.pick_worker()
+            if index is None:
+                self.failed += 1
+        if index is None:
+            return decode_jpeg(buf, scale)
+        with self.lock:
+            self.inflight[index] += 1
+            self.next_id += 1
+            job_id = self.next_id
+            waiter = [threading.Event(), None]
+            self.waiting[job_id] = waiter
+        self.room[index].acquire()
+        try:
+            self.jobs[index].put((job_id, bytes(buf), scale))
+            deadline = time.time() + timeout
+            while not waiter[0].wait(min(0.5, max(deadline - time.time(), 0.0))):
+                if self.procs[index].is_alive() and time.time() < deadline:
+                    continue
+                print('[MESSAGING] decode worker {} {}, decoding in place'.format(
+                    index, 'timed out' if self.procs[index].is_alive() else 'died'))
+                with self.lock:
+                    self.waiting.pop(job_id, None)
+                    self.failed += 1
+                return decode_jpeg(buf, scale)
+            if waiter[1] is None:
+                return None
+            img = self.reader.read(waiter[1])
+            if img is None:
+                with self.lock:
+                    self.failed += 1
+                return decode_jpeg(buf, scale)
+            return img
+        finally:
+            self.room[index].release()
+            with self.lock:
+                self.inflight[index] -= 1
+
+    #
+    # Per-worker load; utilization is the share of wall time spent decoding.
+    #
+    def stats(self):
+        elapsed = max(time.time() - self.starttime, 1e-6)
+        with self.lock:
+            return {'decoded': list(self.decoded),
+                    'inflight': list(self.inflight),
+                    'dead': [i for i, usable in enumerate(self.usable) if not usable],
+                    'utilization': [b / elapsed for b in self.busy_time],
+                    'mean_decode_ms': [1000.0 * b / max(n, 1) for b, n in zip(self.busy_time, self.decoded)],
+                    'failed': self.failed}
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for proc in self.procs:
+            proc.join(1.0)
+            if proc.is_alive():
+                proc.terminate()
+        self.reader.close()
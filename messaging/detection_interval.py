@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import math
+import threading
+
+#
+# When to run the detector again while tracking, instead of every
+# frame_skips-th frame. After every tracked frame each tracked object
+# gets an interval between min_interval and max_interval frames:
+#  - tracker confidence: the peak-to-side-lobe ratio dlib's
+#    correlation_tracker.update() returns. Under psr_low the tracker is
+#    about to drift (min_interval); at psr_high and above it does not
+#    shorten the interval.
+#  - motion: the centroid speed over the CentroidTracker history, in
+#    pixels per frame. At speed_high and above: min_interval.
+#  - boundary: an object within the boundary margin of the frame edge
+#    (the 'not CC' of checkboundary) is about to leave or hand off:
+#    min_interval.
+# The next detection is due once the frames since the last one reach the
+# smallest interval of the objects. With nothing tracked, idle_interval.
+# min_interval == max_interval gives the fixed cadence.
+#
+class DetectionInterval(object):
+    def __init__(self, min_interval=2, max_interval=30, idle_interval=10,
+                 psr_low=7.0, psr_high=15.0, speed_high=15.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_interval = idle_interval
+        self.psr_low = psr_low
+        self.psr_high = psr_high
+        self.speed_high = speed_high
+        self.lock = threading.Lock()
+        self.last = None # frame counter of the last detection
+        self.interval = idle_interval
+        self.detections = 0
+        self.tracked_frames = 0
+
+    def due(self, counter):
+        with self.lock:
+            return self.last is None or int(counter) - self.last >= self.interval or int(counter) < self.last
+
+    def detected(self, counter):
+        with self.lock:
+            self.last = int(counter)
+            self.detections += 1
+
+    def object_interval(self, psr=None, speed=None, near_boundary=False):
+        if near_boundary:
+            return self.min_interval
+        factor = 1.0
+        if psr is not None:
+            factor *= min(max((psr - self.psr_low) / (self.psr_high - self.psr_low), 0.0), 1.0)
+        if speed is not None:
+            factor *= min(max(1.0 - speed / self.speed_high, 0.0), 1.0)
+        return self.min_interval + int((self.max_interval - self.min_interval) * factor)
+
+    #
+    # After a tracked frame: 'psrs' of the trackers, 'speeds' and
+    # 'near_boundary' of the objects (by object ID) of the centroid
+    # tracker.
+    #
+    def observe(self, psrs, speeds, near_boundary):
+        intervals = [self.object_interval(psr=psr) for psr in psrs]
+        intervals += [self.object_interval(speed=speed, near_boundary=near_boundary.get(objectID, False))
+                      for objectID, speed in speeds.items()]
+        with self.lock:
+            self.interval = min(intervals) if intervals else self.idle_interval
+            if intervals:
+                self.tracked_frames += 1
+            return self.interval
+
+    def stats(self):
+        with self.lock:
+            return {'detections': self.detections, 'tracked_frames': self.tracked_frames, 'interval': self.interval,
+                    'frames_per_detection': self.tracked_frames / float(max(self.detections, 1))}
+
+
+#
+# Centroid speed (pixels per frame) of every object of a CentroidTracker,
+# over the centroids it keeps per object.
+#
+def centroid_speeds(ct):
+    speeds = {}
+    for objectID in list(ct.objects.keys()):
+        if objectID not in ct.lqx:
+            continue
+        xs, ys = list(ct.lqx[objectID].queue.queue), list(ct.lqy[objectID].queue.queue)
+        if len(xs) < 2:
+            continue
+        speeds[objectID] = math.hypot(xs[-1] - xs[0], ys[-1] - ys[0]) / (len(xs) - 1)
+    return speeds
+
+
+#
+# The rule of checkboundary: a centroid within 'margin' pixels of an
+# edge of a frame of 'shape' (height, width) is on the boundary.
+#
+def near_boundary(centroid, shape, margin):
+    h, w = shape[0:2]
+    return not (margin < centroid[0] <= w - margin and margin < centroid[1] <= h - margin)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import time
+
+
+#
+# Receiver side of the credit-based flow control.
+# For every frame it acks, the receiver grants the sending device a number
+# of credits, i.e. how many more frames it may send right now. The grant
+# keeps the device's queue at about 'target_latency' seconds of work,
+# using the rate at which that queue is actually drained.
+# The dequeue rate is derived from the enqueue count and the queue depth,
+# so only on_enqueue() has to be called by the receiver.
+#
+class CreditManager(object):
+    def __init__(self, target_latency=0.5, max_credit=30, initial_rate=15.0, rate_window=1.0):
+        self.target_latency = target_latency
+        self.max_credit = max_credit
+        self.initial_rate = initial_rate
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.enqueued = collections.Counter() # device -> frames put in its queue
+        self.rate = {} # device -> dequeue rate (frames/s, EWMA)
+        self.last = {} # device -> (time, dequeued) of the last rate update
+        self.granted = {} # device -> last grant
+
+    def on_enqueue(self, device_name):
+        with self.lock:
+            self.enqueued[device_name] += 1
+
+    def update_rate(self, device_name, depth, now):
+        dequeued = self.enqueued[device_name] - depth
+        if device_name not in self.last:
+            self.last[device_name] = (now, dequeued)
+            return self.rate.get(device_name, self.initial_rate)
+        t0, d0 = self.last[device_name]
+        rate = self.rate.get(device_name, self.initial_rate)
+        if now - t0 >= self.rate_window:
+            rate = 0.7 * rate + 0.3 * (dequeued - d0) / (now - t0)
+            self.rate[device_name] = rate
+            self.last[device_name] = (now, dequeued)
+        return rate
+
+    #
+    # 'depth' is the device's queue, 'backlog' what is received but not
+    # queued yet. Nothing waiting means the consumer keeps up, so the
+    # device gets the full window; otherwise the credit shrinks as the
+    # backlog grows.
+    #
+    def grant(self, device_name, depth, backlog=0):
+        with self.lock:
+            rate = self.update_rate(device_name, depth, time.time())
+            waiting = depth + backlog
+            if waiting == 0:
+                credit = self.max_credit
+            else:
+                credit = int(rate * self.target_latency) - waiting
+            credit = max(0, min(self.max_credit, credit))
+            self.granted[device_name] = credit
+            return credit
+
+    def stats(self):
+        with self.lock:
+            return {'rate': dict(self.rate), 'granted': dict(self.granted),
+                    'enqueued': dict(self.enqueued)}
+
+
+#
+# Sender side: the credits last granted by each receiver (ip, port) to
+# each device sending to it (one process may send for several devices,
+# e.g. traffic_replay.py). Every frame consumes one credit. Without credits the sender drops frames
+# at the source, but still sends one probe frame per 'probe_interval'
+# seconds so that its ack can bring new credits (i.e. the stream is
+# downsampled instead of stopped). Receivers that never granted credits
+# are not flow controlled.
+#
+class CreditWallet(object):
+    def __init__(self, probe_interval=0.2):
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.credits = {} # (ip, port, device_name) -> remaining credits
+        self.last_send = {}
+        self.sent = collections.Counter()
+        self.dropped = collections.Counter()
+
+    def update(self, ip, port, device_name, credit):
+        with self.lock:
+            self.credits[(str(ip), int(port), device_name)] = credit
+
+    def acquire(self, ip, port, device_name):
+        key = (str(ip), int(port), device_name)
+        now = time.time()
+        with self.lock:
+            credit = self.credits.get(key)
+            if credit is None or credit > 0 or now - self.last_send.get(key, 0) >= self.probe_interval:
+                if credit:
+                    self.credits[key] = credit - 1
+                self.last_send[key] = now
+                self.sent[key] += 1
+                return True
+            self.dropped[key] += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {'credits': dict(self.credits), 'sent': dict(self.sent),
+                    'dropped': dict(self.dropped)}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import struct
+import cv2
+import numpy as np
+
+#
+# Binary frame messages are sent as a two-part ZMQ message:
+#   [0] header: fixed struct + message type + device name (utf-8)
+#   [1] payload: the raw JPEG bytes, never base64-encoded
+#
+# Header layout (network byte order):
+#   magic 'FB', version, len(type), len(device_name), framecnt,
+#   timestamp (epoch seconds, float64), x1, y1, x2, y2,
+#   encode_time (seconds spent encoding the JPEG, float32),
+#   quality (JPEG quality, 0 if unknown), scale (downscale factor, float32),
+#   original height, width (u16; the frame is a letterboxed canvas of a
+#   frame this size, see letterbox.py; 0, 0 if it is not)
+#
+HEADER_MAGIC = b'FB'
+HEADER_VERSION = 4
+HEADER_STRUCT = struct.Struct('!2sBBBIdiiiifBfHH')
+NO_COORD = (0, 0, 0, 0)
+
+
+def is_frame_message(frames):
+    return len(frames) == 2 and bytes(frames[0].buffer[:2]) == HEADER_MAGIC
+
+
+def pack_header(msg_type, framecnt, device_name, timestamp, coord=None, encode_time=0.0, quality=0, scale=1.0, original=None):
+    t = msg_type.encode()
+    d = device_name.encode()
+    x1, y1, x2, y2 = [int(c) for c in (coord if coord is not None else NO_COORD)]
+    orig_h, orig_w = [int(c) for c in (original if original is not None else (0, 0))]
+    return HEADER_STRUCT.pack(HEADER_MAGIC, HEADER_VERSION, len(t), len(d), int(framecnt),
+                              float(timestamp), x1, y1, x2, y2, float(encode_time),
+                              int(quality), float(scale), orig_h, orig_w) + t + d
+
+
+def unpack_header(buf):
+    (magic, version, tlen, dlen, framecnt, timestamp, x1, y1, x2, y2,
+     encode_time, quality, scale, orig_h, orig_w) = HEADER_STRUCT.unpack_from(buf)
+    if magic != HEADER_MAGIC or version != HEADER_VERSION:
+        raise ValueError('unknown frame header {}/{}'.format(magic, version))
+    off = HEADER_STRUCT.size
+    msg_type = bytes(buf[off:off + tlen]).decode()
+    device_name = bytes(buf[off + tlen:off + tlen + dlen]).decode()
+    return {'type': msg_type, 'framecnt': framecnt, 'device_name': device_name,
+            'timestamp': timestamp, 'coordinates': (x1, y1, x2, y2), 'encode_time': encode_time,
+            'quality': quality, 'scale': scale, 'original': (orig_h, orig_w) if orig_h else None}
+
+
+#
+# Reads only the device name, e.g. to route a frame before decoding it.
+#
+def peek_device_name(buf):
+    tlen, dlen = HEADER_STRUCT.unpack_from(buf)[2:4]
+    off = HEADER_STRUCT.size + tlen
+    return bytes(buf[off:off + dlen]).decode()
+
+
+#
+# Wraps a received JPEG frame without copying it. The returned array
+# keeps the ZMQ frame alive for as long as it is referenced.
+#
+def payload_array(frame):
+    return np.frombuffer(frame.buffer, dtype=np.uint8)
+
+
+#
+# Decodes a JPEG payload; a frame the sender's adaptive encoder
+# downscaled by 'scale' is resized back to the camera's size.
+#
+def decode_jpeg(buf, scale=1.0):
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is not None and scale < 0.999:
+        # downscaled by the sender's adaptive encoder: restore the original
+        # size so coordinates stay in the camera's frame
+        size = (int(round(img.shape[1] / scale)), int(round(img.shape[0] / scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_LINEAR)
+    return img
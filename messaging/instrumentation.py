@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import struct
+import threading
+import time
+
+#
+# Every message sent through MessageBus ends with a small binary stamp
+# frame: magic 'TS', monotonic send time and clock-offset-corrected wall
+# send time (both float64 seconds). The receiver uses the monotonic time
+# for peers on the same host and the corrected wall time otherwise.
+#
+STAMP_MAGIC = b'TS'
+STAMP_STRUCT = struct.Struct('!2sdd')
+LOCAL_PEERS = ('127.0.0.1', '::1', 'localhost')
+
+
+def make_stamp(clock_offset=0.0):
+    return STAMP_STRUCT.pack(STAMP_MAGIC, time.monotonic(), time.time() + clock_offset)
+
+
+#
+# Returns (frames without the stamp, (mono, wall) or None).
+#
+def split_stamp(frames):
+    if len(frames) > 1:
+        last = frames[-1]
+        buf = last.buffer if hasattr(last, 'buffer') else last
+        if len(buf) == STAMP_STRUCT.size and bytes(buf[:2]) == STAMP_MAGIC:
+            _, mono, wall = STAMP_STRUCT.unpack(buf)
+            return frames[:-1], (mono, wall)
+    return frames, None
+
+
+def peer_address(frame):
+    try:
+        return frame.get('Peer-Address')
+    except Exception:
+        return None
+
+
+#
+# Fixed-bucket latency histogram (bucket bounds in milliseconds).
+# Percentiles are reported as the upper bound of their bucket.
+#
+class Histogram(object):
+    BOUNDS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        i = 0
+        while i < len(self.BOUNDS_MS) and ms > self.BOUNDS_MS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, p):
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n > 0 and seen >= target:
+                return self.BOUNDS_MS[i] if i < len(self.BOUNDS_MS) else self.max
+        return None
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean_ms': self.total / self.count,
+                'min_ms': self.min, 'max_ms': self.max,
+                'p50_ms': self.percentile(50), 'p90_ms': self.percentile(90),
+                'p99_ms': self.percentile(99)}
+
+
+#
+# Per (direction, message type, peer) histograms of
+#   encode  - JPEG encoding on the sender (reported in the frame header)
+#   wire    - send stamp to arrival at the listener
+#   queue   - arrival to the start of the handler (listener workers)
+#   handler - time spent in the registered callbacks
+# plus message and byte counts.
+#
+class MessageStats(object):
+    STAGES = ('encode', 'wire', 'queue', 'handler')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.starttime = time.time()
+            self.hists = collections.defaultdict(dict) # key -> stage -> Histogram
+            self.messages = collections.Counter()
+            self.bytes = collections.Counter()
+
+    def add(self, direction, msg_type, peer, stage, seconds):
+        if seconds is None or seconds < 0:
+            return
+        with self.lock:
+            stages = self.hists[(direction, msg_type, peer)]
+            if stage not in stages:
+                stages[stage] = Histogram()
+            stages[stage].add(seconds)
+
+    def count(self, direction, msg_type, peer, nbytes):
+        key = (direction, msg_type, peer)
+        with self.lock:
+            self.messages[key] += 1
+            self.bytes[key] += nbytes
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.starttime, 1e-6)
+            entries = []
+            for key in sorted(set(self.messages) | set(self.hists)):
+                entry = {'direction': key[0], 'type': key[1], 'peer': key[2],
+                         'messages': self.messages[key], 'bytes': self.bytes[key],
+                         'msg_rate': self.messages[key] / elapsed,
+                         'byte_rate': self.bytes[key] / elapsed}
+                for stage, hist in self.hists.get(key, {}).items():
+                    entry[stage] = hist.summary()
+                entries.append(entry)
+            return {'elapsed': elapsed, 'entries': entries}
+
+    #
+    # One line per (direction, type, peer) with rates and mean/p90 per stage.
+    #
+    def format(self):
+        snap = self.snapshot()
+        lines = ['[MESSAGING] stats over {:.1f}s'.format(snap['elapsed'])]
+        for e in snap['entries']:
+            text = ' {} {:<12} {:<16} {:7.1f} msg/s {:9.1f} KB/s'.format(
+                e['direction'], e['type'], str(e['peer']), e['msg_rate'], e['byte_rate'] / 1000.0)
+            for stage in self.STAGES:
+                if stage in e and e[stage]['count'] > 0:
+                    text += ' {} {:.2f}/{}ms'.format(stage, e[stage]['mean_ms'], e[stage]['p90_ms'])
+            lines.append(text)
+        return '\n'.join(lines)
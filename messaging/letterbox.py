@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cv2
+import numpy as np
+
+#
+# Letterboxing at the sender. The controller publishes a detector_config
+# per device (detector input size, and 'full' or 'letterbox' per frame
+# message type); for 'letterbox' the camera scales the frame into a
+# canvas of the detector input size (aspect ratio kept, gray padding)
+# before encoding it, and the frame header carries the original size so
+# the controller can map boxes back to the camera's coordinates.
+# The layout is the one of the controller's own letterboxing
+# (util.cv_image2tensor / preprocess.Letterboxer).
+#
+POLICIES = ('full', 'letterbox')
+
+
+def config_message(input_size, policy):
+    return {'type': 'detector_config', 'input_size': list(input_size), 'policy': dict(policy)}
+
+
+#
+# Where a frame of 'shape' goes in a canvas of input_size (height,
+# width): (y0, x0, h, w).
+#
+def layout(shape, input_size):
+    h, w = shape[0:2]
+    newh, neww = input_size
+    scale = min(newh / h, neww / w)
+    img_h, img_w = int(h * scale), int(w * scale)
+    return (newh - img_h) // 2, (neww - img_w) // 2, img_h, img_w
+
+
+def letterbox_image(img, input_size, interpolation=cv2.INTER_AREA):
+    y0, x0, h, w = layout(img.shape, input_size)
+    canvas = np.full((input_size[0], input_size[1]) + img.shape[2:], 128, dtype=img.dtype)
+    canvas[y0:y0 + h, x0:x0 + w] = cv2.resize(img, (w, h), interpolation=interpolation)
+    return canvas
+
+
+#
+# Back to a frame of the original (height, width): the content of the
+# canvas, scaled up. Only as sharp as the canvas; the coordinates match
+# the camera's again.
+#
+def restore_image(canvas, original, interpolation=cv2.INTER_LINEAR):
+    y0, x0, h, w = layout(original, canvas.shape[0:2])
+    return cv2.resize(canvas[y0:y0 + h, x0:x0 + w], (int(original[1]), int(original[0])), interpolation=interpolation)
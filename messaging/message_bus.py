@@ -3,14 +3,27 @@ import threading
 import base64
 import cv2
 import json
+import frame_codec
 from node_table import NodeTable
+from connection_pool import ConnectionPool
+from worker_pool import WorkerPool
+from flow_control import CreditWallet
+from broadcast import Broadcaster, Subscriber, control_topic, config_topic
+from instrumentation import MessageStats, make_stamp, split_stamp, peer_address, LOCAL_PEERS
+from clock_sync import ClockServer, ClockSync
+from adaptive_encoder import AdaptiveEncoder
+from traffic_log import TrafficWriter
 import netif_util
 import collections
+import queue
 from datetime import datetime,timedelta
-import ntplib
 from time import ctime
 import time
 
+BROADCAST_PORT_OFFSET = 1000 # default broadcaster port = listen port + offset
+CLOCK_PORT_OFFSET = 2000 # default clock server port = listen port + offset
+RETRY_TYPES = ('heartbeat',) # besides frames (img*): safe to send twice
+
 #
 # Decorator for threading methods in a class
 #
@@ -22,15 +35,55 @@ def threaded(fn):
     return wrapper
 
 
+#
+# listener: 'router' acks every message on a ROUTER socket and hands it to
+# a bounded worker pool (ordered per sending device); 'rep' is the
+# original REP socket that starts one thread per message.
+#
 class MessageBus(object):
-    def __init__(self, device_name, listen_port, role):
+    def __init__(self, device_name, listen_port, role, listener='router', num_workers=4, worker_queue_size=256, decode_procs=0):
+        # forked before anything else starts a thread
+        self.decoder = None
+        if decode_procs > 0:
+            try:
+                from decode_pool import DecodePool
+                self.decoder = DecodePool(decode_procs)
+            except ImportError as e:
+                print('[MESSAGING] no decode processes ({}), decoding in the handler threads'.format(e))
         self.ctx = zmq.Context()
         self.device_name = device_name
         self.listen_port = listen_port
         self.role = role
         self.handlers = collections.defaultdict(set)
         self.node_table = NodeTable()
-        self.run_message_listener()
+        self.pool = ConnectionPool(self.ctx, on_ack=self.handle_ack)
+        self.wallet = CreditWallet()
+        self.credit_provider = None
+        self.feedback = {} # device -> detector confidence returned in its acks
+        self.encoder = None
+        self.broadcaster = None
+        self.subscribers = {} # (ip, port) -> Subscriber
+        self.published_version = None # node_table version of the last device_list broadcast
+        self.stats = MessageStats()
+        self.clock_offset = 0.0 # seconds to add to the local clock to get the reference time
+        self.clock_server = None
+        self.clock_sync = None
+        self.shm_transport = True # raw frames through shared memory for same-host peers
+        self.shm_module = None # shm_ring once imported, False if it cannot be
+        self.shm_lock = threading.Lock()
+        self.shm_writer = None
+        self.shm_reader = None
+        self.local_ips = None
+        self.recorder = None # TrafficWriter while recording
+        self.record_queue = None
+        self.record_thread = None
+        self.record_dropped = 0
+        self.workers = None
+        if listener == 'router':
+            self.workers = WorkerPool(num_workers, worker_queue_size)
+            self.run_router_listener()
+        else:
+            self.run_message_listener()
 
     #
     # Creates a socket for listening messages from other nodes
@@ -43,22 +96,287 @@ class MessageBus(object):
         sock = self.ctx.socket(zmq.REP)
         sock.bind('tcp://*:{}'.format(self.listen_port))
         while True:
-            data = sock.recv()
-            msg = data.decode()
-            self.handle_message(msg)
+            frames = sock.recv_multipart(copy=False)
+            frames, arrival = self.arrival_info(frames)
+            if self.recorder is not None:
+                self.record_traffic(frames, arrival)
             ack_msg = '{}.{}'.format(self.device_name, 'ack')
-            sock.send(ack_msg.encode())
+            if frame_codec.is_frame_message(frames):
+                self.handle_frame_message(frames, arrival)
+                device = frame_codec.peek_device_name(frames[0].buffer)
+                sock.send_multipart([ack_msg.encode()] + self.ack_extras(device))
+            else:
+                self.handle_message(frames[0].bytes.decode(), arrival)
+                sock.send(ack_msg.encode())
+
+    #
+    # Same as run_message_listener, but acks right away on a ROUTER socket
+    # and queues the message on a worker instead of starting a thread.
+    # Frames are routed by device name so each device keeps its order,
+    # and are dropped when that worker is full; other messages are routed
+    # by the sending peer and never dropped.
+    #
+    @threaded
+    def run_router_listener(self):
+        print('[MESSAGING] Starting ZMQ router listener... device_name:{}, port:{}'.format(self.device_name, self.listen_port))
+
+        sock = self.ctx.socket(zmq.ROUTER)
+        sock.bind('tcp://*:{}'.format(self.listen_port))
+        ack_msg = '{}.{}'.format(self.device_name, 'ack').encode()
+        while True:
+            frames = sock.recv_multipart(copy=False)
+            peer = frames[0].bytes
+            acked = False
+            try:
+                body, arrival = self.arrival_info(frames[2:]) # skip the peer identity and the empty delimiter
+                if self.recorder is not None:
+                    self.record_traffic(body, arrival)
+                if frame_codec.is_frame_message(body):
+                    device = frame_codec.peek_device_name(body[0].buffer)
+                    sock.send_multipart([peer, b'', ack_msg] + self.ack_extras(device))
+                    acked = True
+                    self.workers.submit(device, self.dispatch_frame_message, (body, arrival), droppable=True)
+                else:
+                    sock.send_multipart([peer, b'', ack_msg])
+                    acked = True
+                    self.workers.submit(peer.hex(), self.dispatch_message, (body[0].bytes.decode(), arrival))
+            except zmq.ContextTerminated:
+                return
+            except Exception as e:
+                # a malformed message is dropped, but still acked so the sender does not wait for it
+                print('[MESSAGING] dropping malformed message from {}: {}'.format(peer.hex(), e))
+                if not acked:
+                    try:
+                        sock.send_multipart([peer, b'', ack_msg])
+                    except zmq.ZMQError:
+                        pass
+
+    #
+    # Strips the send stamp off a received message and notes when and
+    # from where it arrived, for the latency statistics.
+    #
+    def arrival_info(self, frames):
+        frames, stamp = split_stamp(frames)
+        arrival = {'mono': time.monotonic(), 'wall': time.time(), 'stamp': stamp,
+                   'addr': peer_address(frames[0]), 'nbytes': sum(len(f.buffer) for f in frames)}
+        return frames, arrival
+
+    #
+    # Records one received message. Wire latency uses the monotonic clock
+    # for local peers and the offset-corrected wall clocks otherwise.
+    #
+    def record_received(self, msg_type, peer, arrival, start, encode_time=None):
+        end = time.monotonic()
+        peer = peer or arrival['addr'] or 'unknown'
+        stamp = arrival['stamp']
+        if stamp is not None:
+            if arrival['addr'] in LOCAL_PEERS:
+                wire = arrival['mono'] - stamp[0]
+            else:
+                wire = arrival['wall'] + self.clock_offset - stamp[1]
+            self.stats.add('rx', msg_type, peer, 'wire', wire)
+        if encode_time:
+            self.stats.add('rx', msg_type, peer, 'encode', encode_time)
+        self.stats.add('rx', msg_type, peer, 'queue', start - arrival['mono'])
+        self.stats.add('rx', msg_type, peer, 'handler', end - start)
+        self.stats.count('rx', msg_type, peer, arrival['nbytes'])
+
+    #
+    # Traffic recording: every received message (without its send stamp)
+    # and its arrival time go to a TrafficWriter file, which
+    # traffic_replay.py can feed into a controller again. Shared-memory
+    # frames only live until the sender reuses their slot, so they are
+    # recorded as JPEGs.
+    # The listener only queues the message (and copies a shared-memory
+    # frame out of its slot); a writer thread encodes and writes it. When
+    # the writer falls behind by 'queue_size' messages, they are dropped
+    # from the recording.
+    #
+    def start_recording(self, path, queue_size=512):
+        self.stop_recording()
+        self.record_queue = queue.Queue(queue_size)
+        self.record_dropped = 0
+        self.recorder = TrafficWriter(path)
+        self.record_thread = threading.Thread(target=self.run_recorder, args=(self.recorder, self.record_queue))
+        self.record_thread.daemon = True
+        self.record_thread.start()
+        print('[MESSAGING] recording received messages to {}'.format(path))
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            self.record_queue.put(None)
+            self.record_thread.join(10.0)
+            if self.record_dropped:
+                print('[MESSAGING] {} messages were not recorded (writer behind)'.format(self.record_dropped))
+
+    def record_traffic(self, frames, arrival):
+        recorder, record_queue = self.recorder, self.record_queue
+        if recorder is None:
+            return
+        try:
+            img = None
+            reader = self.shm_frame_reader(frames[1]) if frame_codec.is_frame_message(frames) else None
+            if reader is not None:
+                img = reader.read(frames[1])
+                if img is None:
+                    return
+            record_queue.put_nowait((frames, img, arrival['mono']))
+        except queue.Full:
+            self.record_dropped += 1
+        except Exception as e:
+            print('[MESSAGING] recording error: {}'.format(e))
+
+    def run_recorder(self, recorder, record_queue):
+        while True:
+            item = record_queue.get()
+            if item is None:
+                recorder.close()
+                return
+            frames, img, arrival = item
+            try:
+                if img is not None:
+                    _, encimg = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+                    frames = [frames[0], encimg.tobytes()]
+                recorder.record(frames, arrival)
+            except Exception as e:
+                print('[MESSAGING] recording error: {}'.format(e))
+
+    #
+    # Latency/throughput statistics (see MessageStats.snapshot), with the
+    # clock offset the wire latencies were corrected with.
+    #
+    def get_message_stats(self):
+        snap = self.stats.snapshot()
+        snap['clock'] = self.get_clock_offset()
+        return snap
+
+    #
+    # Clock synchronization: the reference node (the controller) serves its
+    # time with start_clock_server(); the others follow it in the background
+    # with start_clock_sync() instead of a one-shot NTP request.
+    #
+    def start_clock_server(self, port=None):
+        if self.clock_server is None:
+            if port is None:
+                port = int(self.listen_port) + CLOCK_PORT_OFFSET
+            self.clock_server = ClockServer(self.ctx, port, lambda: self.clock_offset)
+            print('[MESSAGING] Starting clock server... device_name:{}, port:{}'.format(self.device_name, port))
+        return self.clock_server.port
+
+    def start_clock_sync(self, ref_ip, ref_listen_port, interval=10.0, on_update=None):
+        def update(offset, uncertainty):
+            self.clock_offset = offset
+            if on_update is not None:
+                on_update(offset, uncertainty)
+        if self.clock_sync is None:
+            self.clock_sync = ClockSync(self.ctx, ref_ip, int(ref_listen_port) + CLOCK_PORT_OFFSET, interval, on_update=update)
+
+    #
+    # Returns the current offset and its uncertainty (seconds); the
+    # uncertainty is 0 on the reference and None before the first sample.
+    #
+    def get_clock_offset(self):
+        if self.clock_sync is None:
+            return {'offset': self.clock_offset, 'uncertainty': 0.0 if self.clock_server is not None else None}
+        offset, uncertainty = self.clock_sync.get_offset()
+        return {'offset': offset, 'uncertainty': uncertainty,
+                'reference': '{}:{}'.format(self.clock_sync.ip, self.clock_sync.port)}
 
     #
-    # Sends a JSON Object through the ZeroMQ socket
+    # Prints (or appends to 'logfile') the statistics every 'interval' seconds.
     #
-    def send_message_json(self, target_ip, target_port, msg_dict):
-        sock = self.ctx.socket(zmq.REQ)
-        sock.connect('tcp://{}:{}'.format(target_ip, target_port))
+    @threaded
+    def run_stats_dump(self, interval=10.0, logfile=None):
+        while True:
+            time.sleep(interval)
+            clock = self.get_clock_offset()
+            text = self.stats.format() + '\n clock offset {:.6f}s +/- {}'.format(clock['offset'], clock['uncertainty'])
+            if logfile is None:
+                print(text)
+            else:
+                with open(logfile, 'a') as f:
+                    f.write(text + '\n')
+
+    #
+    # Flow control: a receiver registers provider(device_name, backlog) ->
+    # credits, where backlog is the number of messages still waiting for a
+    # listener worker. Every ack of a frame from that device carries the
+    # grant as an extra frame. Senders check acquire_send_credit() before
+    # each frame.
+    #
+    def set_credit_provider(self, provider):
+        self.credit_provider = provider
+
+    def grant_credit(self, device_name):
+        if self.credit_provider is None:
+            return b''
+        backlog = self.workers.pending(device_name) if self.workers is not None else 0
+        try:
+            return str(int(self.credit_provider(device_name, backlog))).encode()
+        except Exception as e:
+            print('[MESSAGING] credit provider error: {}'.format(e))
+            return b''
+
+    #
+    # Encoder feedback: the last detector confidence for a device goes back
+    # in the acks of its frames, for the sender's AdaptiveEncoder.
+    #
+    def set_feedback(self, device_name, confidence):
+        self.feedback[device_name] = confidence
+
+    #
+    # Extra ack frames of a frame message: [credit, confidence, device_name],
+    # where an empty credit means no flow control and an empty confidence
+    # none. The device name tells a sender of several devices whose credit
+    # it is.
+    #
+    def ack_extras(self, device_name):
+        extras = [self.grant_credit(device_name), b'']
+        if device_name in self.feedback:
+            extras[1] = '{:.3f}'.format(self.feedback[device_name]).encode()
+        elif extras[0] == b'':
+            return []
+        return extras + [device_name.encode()]
+
+    def handle_ack(self, ip, port, extra):
+        try:
+            device_name = extra[2].decode() if len(extra) > 2 else self.device_name
+            if extra[0]:
+                self.wallet.update(ip, port, device_name, int(extra[0]))
+            if len(extra) > 1 and extra[1] and self.encoder is not None:
+                self.encoder.on_feedback(float(extra[1]))
+        except ValueError:
+            pass
+
+    #
+    # Whether a frame of 'device_name' (default: this node) may be sent to
+    # the target now.
+    #
+    def acquire_send_credit(self, target_ip, target_port, device_name=None):
+        return self.wallet.acquire(target_ip, target_port, device_name or self.device_name)
+
+    def get_credit_stats(self):
+        return self.wallet.stats()
+
+    #
+    # Queue depths and counters of the router listener workers.
+    #
+    def get_listener_stats(self):
+        if self.workers is None:
+            return None
+        return self.workers.stats()
+
+    #
+    # Sends a JSON Object through the pooled channel of the target.
+    # With wait_ack=False the call returns as soon as the message is queued.
+    # Returns the ack string, or None if the target did not answer.
+    #
+    def send_message_json(self, target_ip, target_port, msg_dict, wait_ack=True):
         print('[MESSAGING] sending msg to {}:{} (type: {})'.format(target_ip, target_port, msg_dict['type']))
-        sock.send_json(msg_dict)
-        rep = sock.recv().decode()
+        rep = self.send_stamped(target_ip, target_port, [json.dumps(msg_dict).encode()], msg_dict['type'], wait_ack)
         # print(' - Reply from receiver: {}'.format(rep))
+        return rep if rep is None else rep.decode()
 
     @threaded
     def send_message_json_scheduled(self, target_ip, target_port, msg_dict, seconds):
@@ -66,15 +384,260 @@ class MessageBus(object):
         self.send_message_json(target_ip, target_port, msg_dict)
 
     #
-    # Sends a plain-text string through the ZeroMQ socket
+    # Sends a plain-text string through the pooled channel of the target
     #
-    def send_message_str(self, target_ip, target_port, msg_str):
-        sock = self.ctx.socket(zmq.REQ)
-        sock.connect('tcp://{}:{}'.format(target_ip, target_port))
+    def send_message_str(self, target_ip, target_port, msg_str, wait_ack=True):
         #print('[MESSAGING] sending msg to {}:{}'.format(target_ip, target_port))
-        sock.send_string(msg_str)
-        rep = sock.recv().decode()
+        rep = self.send_stamped(target_ip, target_port, [msg_str.encode()], 'str', wait_ack)
         # print(' - Reply from receiver: {}'.format(rep))
+        return rep if rep is None else rep.decode()
+
+    #
+    # Sends a binary frame message (see create_frame_message) as one
+    # multipart message. The JPEG buffer is handed to ZMQ without a copy.
+    #
+    def send_message_frames(self, target_ip, target_port, frames, wait_ack=True):
+        header = frame_codec.unpack_header(frames[0])
+        self.stats.add('tx', header['type'], target_ip, 'encode', header['encode_time'])
+        rep = self.send_stamped(target_ip, target_port, frames, header['type'], wait_ack)
+        return rep if rep is None else rep.decode()
+
+    #
+    # Sends an image as a frame message. Peers on the same host get the raw
+    # frame through a shared-memory ring (only a descriptor goes over ZMQ);
+    # others get the JPEG from create_frame_message. 'original' is the
+    # (height, width) 'img' was letterboxed from, if it was (letterbox.py).
+    #
+    def send_frame(self, target_ip, target_port, msg_type, img, framecnt, encode_param, coord=None, timegap=timedelta(), wait_ack=True, original=None):
+        shm = self.shm_ring() if self.shm_transport and self.is_local_peer(target_ip) else None
+        if shm is not None:
+            if self.shm_writer is None:
+                self.shm_writer = shm.ShmRingWriter('aiot_{}'.format(self.device_name))
+            timestamp = ((datetime.utcnow() + timegap) - datetime(1970, 1, 1)).total_seconds()
+            header = frame_codec.pack_header(msg_type, framecnt, self.device_name, timestamp, coord, original=original)
+            frames = [header, self.shm_writer.write(img)]
+        elif self.encoder is not None:
+            img, encode_param, scale = self.encoder.prepare(img)
+            frames = MessageBus.create_frame_message(msg_type, img, framecnt, encode_param, self.device_name, coord, timegap, scale, original)
+            s = time.monotonic()
+            rep = self.send_message_frames(target_ip, target_port, frames, wait_ack)
+            if wait_ack:
+                rtt = self.clock_sync.delay if self.clock_sync is not None else None
+                self.encoder.on_sent(len(frames[1]), time.monotonic() - s, rep is not None, rtt)
+            return rep
+        else:
+            frames = MessageBus.create_frame_message(msg_type, img, framecnt, encode_param, self.device_name, coord, timegap, original=original)
+        return self.send_message_frames(target_ip, target_port, frames, wait_ack)
+
+    #
+    # Lets send_frame pick JPEG quality and downscale per frame
+    # (see AdaptiveEncoder for the bounds); encode_param is then ignored.
+    #
+    def enable_adaptive_encoding(self, **bounds):
+        self.encoder = AdaptiveEncoder(**bounds)
+        return self.encoder
+
+    #
+    # shm_ring needs multiprocessing.shared_memory (Python 3.8+), which the
+    # cameras do not have, so it is imported on first use. Without it
+    # frames are sent as JPEG.
+    #
+    def shm_ring(self):
+        if self.shm_module is None:
+            try:
+                import shm_ring
+                self.shm_module = shm_ring
+            except ImportError as e:
+                print('[MESSAGING] no shared-memory transport ({}), sending JPEG frames'.format(e))
+                self.shm_module = False
+                self.shm_transport = False
+        return self.shm_module or None
+
+    #
+    # The reader for a received payload that is a shared-memory descriptor,
+    # None for a JPEG payload.
+    #
+    def shm_frame_reader(self, payload):
+        shm = self.shm_ring()
+        if shm is None or not shm.is_shm_descriptor(payload):
+            return None
+        with self.shm_lock:
+            if self.shm_reader is None:
+                self.shm_reader = shm.ShmRingReader()
+            return self.shm_reader
+
+    def is_local_peer(self, ip):
+        if ip in LOCAL_PEERS:
+            return True
+        if self.local_ips is None:
+            try:
+                self.local_ips = set(netif['ipv4'] for netif in netif_util.get_netif_list())
+            except Exception:
+                self.local_ips = set()
+        return ip in self.local_ips
+
+    #
+    # Appends the send stamp and counts the message before it is sent.
+    # Only idempotent messages are resent when their ack is late; a join,
+    # control_op or device_list could otherwise arrive twice.
+    #
+    def send_stamped(self, target_ip, target_port, frames, msg_type, wait_ack):
+        self.stats.count('tx', msg_type, target_ip, sum(len(f) for f in frames))
+        retries = 1 if msg_type.startswith('img') or msg_type in RETRY_TYPES else 0
+        return self.pool.send(target_ip, target_port, list(frames) + [make_stamp(self.clock_offset)], wait_ack,
+                              retries=retries)
+
+    #
+    # Starts publishing broadcast updates on 'port' (and serving snapshots
+    # on port + 1). Returns the port, which subscribers need to know.
+    #
+    def start_broadcaster(self, port=None):
+        if self.broadcaster is None:
+            if port is None:
+                port = self.listen_port + BROADCAST_PORT_OFFSET
+            self.broadcaster = Broadcaster(self.ctx, port)
+            print('[MESSAGING] Starting broadcaster... device_name:{}, port:{}'.format(self.device_name, port))
+        return self.broadcaster.port
+
+    def broadcast(self, topic, msg_dict, state=None):
+        return self.broadcaster.publish(topic, msg_dict, state)
+
+    #
+    # Sends a control_op to one device, or to every device with 'all'.
+    #
+    def broadcast_control_op(self, device_name, msg_dict):
+        msg_dict = dict(msg_dict, target=device_name)
+        return self.broadcast(control_topic(device_name), msg_dict)
+
+    #
+    # The detector input size and per-message-type letterbox policy for one
+    # device (see letterbox.py). A topic of its own, so that it stays in
+    # the snapshot for a camera that subscribes after it was published.
+    #
+    def broadcast_detector_config(self, device_name, msg_dict):
+        return self.broadcast(config_topic(device_name), msg_dict)
+
+    #
+    # Follows the broadcaster of another node. Its device_list and the
+    # control_ops for this device (or 'all') go to the registered callbacks.
+    #
+    def subscribe(self, publisher_ip, publisher_port, topics=None):
+        key = (str(publisher_ip), int(publisher_port))
+        if key in self.subscribers:
+            return
+        if topics is None:
+            topics = ['device_list', control_topic('all'), control_topic(self.device_name), config_topic(self.device_name)]
+        self.subscribers[key] = Subscriber(self.ctx, key[0], key[1], topics, self.dispatch_message)
+
+    #
+    # Subscribes to the broadcaster of the node listening on ip:listen_port,
+    # assuming it uses the default broadcaster port.
+    #
+    def subscribe_node(self, ip, listen_port):
+        self.subscribe(ip, int(listen_port) + BROADCAST_PORT_OFFSET)
+
+    #
+    # Fetches the snapshot of 'topic' again from every followed broadcaster.
+    #
+    def resync(self, topic):
+        for subscriber in self.subscribers.values():
+            subscriber.resync(topic)
+
+    #
+    # Membership: the node a device joins adds it to its node_table and
+    # sends the full device_list straight back (the new node may not be
+    # subscribed yet); everybody else gets only the changes since the last
+    # broadcast, while the broadcaster keeps the full list for late joiners.
+    #
+    def add_joined_node(self, msg_dict):
+        self.node_table.add_entry(msg_dict['device_name'], msg_dict['ip'], int(msg_dict['port']),
+                                  msg_dict['location'], msg_dict['capability'], msg_dict.get('neighbors'))
+        self.send_message_json(msg_dict['ip'], int(msg_dict['port']), self.device_list_message())
+        self.broadcast_device_list()
+
+    def device_list_message(self):
+        with self.node_table.lock:
+            return {'type': 'device_list', 'origin': self.device_name, 'version': self.node_table.version,
+                    'devices': self.node_table.get_list_str()}
+
+    def broadcast_device_list(self):
+        if self.broadcaster is None:
+            return
+        with self.node_table.lock:
+            full = self.device_list_message()
+            delta = None
+            if self.published_version is not None:
+                delta = self.node_table.get_delta(self.published_version)
+            self.published_version = full['version']
+            if delta is None:
+                self.broadcast('device_list', full)
+            else:
+                msg_dict = {'type': 'device_list', 'origin': self.device_name, 'delta': delta}
+                self.broadcast('device_list', msg_dict, full)
+
+    #
+    # Applies a received device_list (full or delta) to node_table.
+    # Returns False if a delta was missed; the full list is then fetched
+    # again from the broadcasters.
+    #
+    def apply_device_list(self, msg_dict):
+        origin = msg_dict.get('origin')
+        if 'delta' in msg_dict:
+            if not self.node_table.apply_delta(origin, msg_dict['delta'], skip=self.device_name):
+                print('[MESSAGING] device_list gap from {}, resyncing'.format(origin))
+                self.resync('device_list')
+                return False
+        else:
+            self.node_table.apply_list(origin, msg_dict.get('version', 0), json.loads(msg_dict['devices']),
+                                       skip=self.device_name)
+        return True
+
+    #
+    # Liveness: a node sends a heartbeat to 'target' every 'interval'
+    # seconds (any other message counts as well), and the node it joined
+    # evicts the nodes it has not heard of for 'timeout' seconds, telling
+    # the others with a device_list update and on_evict(names). A node
+    # heard of again after its eviction is added back and announced.
+    #
+    @threaded
+    def run_heartbeat(self, target_ip, target_port, interval=2.0):
+        msg = json.dumps({'type': 'heartbeat', 'device_name': self.device_name}).encode()
+        while True:
+            try:
+                self.send_stamped(target_ip, target_port, [msg], 'heartbeat', False)
+            except zmq.ContextTerminated:
+                return
+            time.sleep(interval)
+
+    def touch_node(self, device_name):
+        if self.node_table.touch(device_name):
+            print('[MESSAGING] evicted node {} is back'.format(device_name))
+            self.broadcast_device_list()
+
+    @threaded
+    def run_liveness_check(self, timeout=10.0, interval=2.0, on_evict=None):
+        while True:
+            time.sleep(interval)
+            dead = self.node_table.evict_dead(timeout)
+            if dead:
+                print('[MESSAGING] evicting silent nodes: {}'.format(dead))
+                self.broadcast_device_list()
+                if on_evict is not None:
+                    on_evict(dead)
+
+    #
+    # Closes all pooled channels and the ZMQ context.
+    #
+    def close(self):
+        self.stop_recording()
+        if self.decoder is not None:
+            self.decoder.close()
+        if self.shm_writer is not None:
+            self.shm_writer.close()
+        if self.shm_reader is not None:
+            self.shm_reader.close()
+        self.pool.close_all()
+        self.ctx.destroy(linger=0)
 
     #
     # Retrieves an IPv4 address and a port number for
@@ -95,9 +658,14 @@ class MessageBus(object):
         self.handlers[msg_type].add(callback)
 
     @threaded
-    def handle_message(self, msg):
+    def handle_message(self, msg, arrival=None):
+        self.dispatch_message(msg, arrival)
+
+    def dispatch_message(self, msg, arrival=None):
         try:
             msg_dict = json.loads(msg)
+            start = time.monotonic()
+            self.touch_node(msg_dict.get('device_name'))
 
             if 'type' in msg_dict:
                 if msg_dict['type'] == 'join':
@@ -128,11 +696,19 @@ class MessageBus(object):
                 elif msg_dict['type'] == 'control_op':
                     for handler in self.handlers.get('control_op', []):
                         handler(msg_dict)
+                elif msg_dict['type'] == 'detector_config':
+                    for handler in self.handlers.get('detector_config', []):
+                        handler(msg_dict)
+                elif msg_dict['type'] == 'heartbeat':
+                    for handler in self.handlers.get('heartbeat', []):
+                        handler(msg_dict)
                 else:
                     pass
             else:
                 # Key 'type' does not exist. Discard the message.
                 pass
+            if arrival is not None:
+                self.record_received(msg_dict.get('type', 'unknown'), msg_dict.get('device_name'), arrival, start)
 
         except json.decoder.JSONDecodeError:
             print(' - Error: invalid JSON format.')
@@ -142,6 +718,85 @@ class MessageBus(object):
             print(str(e))
             return
 
+    #
+    # Handles a binary frame message. The handlers get the same dictionary
+    # as for JSON image messages, except that the JPEG is in 'img_buffer'
+    # (a view on the received ZMQ frame) instead of 'img_string', or, for
+    # shared-memory frames, the raw image is in 'img'.
+    #
+    @threaded
+    def handle_frame_message(self, frames, arrival=None):
+        self.dispatch_frame_message(frames, arrival)
+
+    def dispatch_frame_message(self, frames, arrival=None):
+        try:
+            start = time.monotonic()
+            msg_dict = frame_codec.unpack_header(frames[0].buffer)
+            self.touch_node(msg_dict['device_name'])
+            reader = self.shm_frame_reader(frames[1])
+            if reader is not None:
+                msg_dict['img'] = reader.read(frames[1])
+                if msg_dict['img'] is None:
+                    print('[MESSAGING] dropping frame {} of {}: shared memory slot reused'.format(msg_dict['framecnt'], msg_dict['device_name']))
+                    return
+            else:
+                msg_dict['img_buffer'] = frame_codec.payload_array(frames[1])
+            msg_dict['time'] = datetime.utcfromtimestamp(msg_dict['timestamp']).strftime('%H:%M:%S.%f')
+            for handler in self.handlers.get(msg_dict['type'], []):
+                handler(msg_dict)
+            if arrival is not None:
+                self.record_received(msg_dict['type'], msg_dict['device_name'], arrival, start, msg_dict['encode_time'])
+        except Exception as e:
+            print(' - Error: invalid frame message.')
+            print(str(e))
+            return
+
+    #
+    # Decodes the image of a received message, whichever transport it used.
+    #
+    @staticmethod
+    def decode_image(msg_dict):
+        if 'img' in msg_dict:
+            return msg_dict['img'] # shared-memory frames are not encoded
+        if 'img_buffer' in msg_dict:
+            imgarray = msg_dict['img_buffer']
+        else:
+            imgarray = base64.b64decode(msg_dict['img_string'])
+        return frame_codec.decode_jpeg(imgarray, msg_dict.get('scale', 1.0))
+
+    #
+    # Decode stage: with decode_procs > 0, decode() hands JPEGs to worker
+    # processes (see decode_pool.py) instead of decoding them in the
+    # handler thread.
+    #
+    def decode(self, msg_dict):
+        if self.decoder is None or 'img' in msg_dict:
+            return MessageBus.decode_image(msg_dict)
+        if 'img_buffer' in msg_dict:
+            buf = msg_dict['img_buffer']
+        else:
+            buf = base64.b64decode(msg_dict['img_string'])
+        return self.decoder.decode(buf, msg_dict.get('scale', 1.0))
+
+    def decode_stats(self):
+        return self.decoder.stats() if self.decoder is not None else None
+
+    #
+    # Binary counterpart of the create_*_message functions below:
+    # returns [header, jpeg] for send_message_frames.
+    #
+    @staticmethod
+    def create_frame_message(msg_type, img, framecnt, encode_param, device_name, coord=None, timegap=timedelta(), scale=1.0, original=None):
+        s = time.monotonic()
+        _, encimg = cv2.imencode('.jpg', img, encode_param)
+        encode_time = time.monotonic() - s
+        timestamp = ((datetime.utcnow() + timegap) - datetime(1970, 1, 1)).total_seconds()
+        quality = 0
+        if encode_param and int(cv2.IMWRITE_JPEG_QUALITY) in encode_param[::2]:
+            quality = encode_param[encode_param.index(int(cv2.IMWRITE_JPEG_QUALITY)) + 1]
+        header = frame_codec.pack_header(msg_type, framecnt, device_name, timestamp, coord, encode_time, quality, scale, original)
+        return [header, encimg]
+
     @staticmethod # e1-1
     def create_raw_message(img, framecnt, encode_param, device_name,timegap=timedelta()): # e1-1 (send frames no matter what)
         _, encimg = cv2.imencode('.jpg', img, encode_param)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import json
+import time
 
 
 class NodeInfo(object):
@@ -11,17 +12,32 @@ class NodeInfo(object):
         self.location = 'N1'
         self.capability = 'no'
 
-    def __init__(self, device_name, ip, port, location, capability):
+    def __init__(self, device_name, ip, port, location, capability, neighbors=None):
         self.device_name = device_name
         self.ip = ip
         self.port = port
         self.location = location
         self.capability = capability
+        self.neighbors = dict(neighbors) if neighbors else {} # direction -> device_name
+        self.last_seen = time.time()
 
-    def to_json(self):
+    #
+    # Capabilities are a comma-separated string, e.g. 'ncs,gpu' ('no': none).
+    #
+    def capabilities(self):
+        if not self.capability or self.capability == 'no':
+            return set()
+        return set(c.strip() for c in str(self.capability).split(',') if c.strip())
+
+    def to_dict(self):
         d = {'device_name': self.device_name, 'ip': self.ip, 'port': self.port, 'location': self.location,
              'capability': self.capability}
-        return json.dumps(d, default=lambda o: o.__dict__)
+        if self.neighbors:
+            d['neighbors'] = self.neighbors
+        return d
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), default=lambda o: o.__dict__)
 
     def __repr__(self):
         # d = {'device_name': self.device_name, 'ip': self.ip, 'port': self.port, 'location': self.location, 'capability': self.capability}
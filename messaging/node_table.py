@@ -1,18 +1,86 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import collections
+import json
+import threading
+import time
 from node_info import NodeInfo
 
+OPPOSITE = {'LEFT': 'RIGHT', 'RIGHT': 'LEFT', 'TOP': 'BOTTOM', 'BOTTOM': 'TOP'}
 
+
+#
+# Joined nodes by name, with secondary indexes by location and capability
+# and a neighbour map (direction -> device) for handoffs, so that lookups
+# stay O(1) as the number of cameras grows.
+# Every change bumps 'version' and is kept in a short change log, so that
+# peers can be sent deltas instead of the whole table.
+# Nodes refresh 'last_seen' with any message (see touch) and are evicted
+# when silent for longer than the liveness timeout. An evicted node that
+# is heard of again is added back as it was.
+#
 class NodeTable(object):
-    def __init__(self):
+    def __init__(self, max_changes=256, max_evicted=256):
+        self.lock = threading.RLock()
         self.table = {}
+        self.by_location = collections.defaultdict(set)
+        self.by_capability = collections.defaultdict(set)
+        self.version = 0
+        self.changes = collections.deque(maxlen=max_changes) # (version, 'add'/'remove', name)
+        self.remote_versions = {} # origin -> last applied version of its table
+        self.origin_of = {} # name -> origin of entries learnt from a device_list
+        self.evicted = collections.OrderedDict() # name -> entry of the nodes evicted last
+        self.max_evicted = max_evicted
 
-    def add_entry(self, device_name, ip, port, location, capability):
-        entry = NodeInfo(device_name, ip, port, location, capability)
-        self.table[str(device_name)] = entry
+    def add_entry(self, device_name, ip, port, location, capability, neighbors=None):
+        entry = NodeInfo(device_name, ip, port, location, capability, neighbors)
+        name = str(device_name)
+        with self.lock:
+            self.evicted.pop(name, None)
+            self.unindex(name)
+            self.table[name] = entry
+            self.by_location[entry.location].add(name)
+            for cap in entry.capabilities():
+                self.by_capability[cap].add(name)
+            for direction, other in list(entry.neighbors.items()):
+                self.link(name, direction, other)
+            # links other nodes declared towards this one
+            for other_name, other in self.table.items():
+                for direction, target in other.neighbors.items():
+                    if target == name and direction in OPPOSITE:
+                        entry.neighbors.setdefault(OPPOSITE[direction], other_name)
+            self.log_change('add', name)
 
     def remove_entry(self, device_name):
-        self.table.pop(device_name, None)
+        with self.lock:
+            if device_name not in self.table:
+                return
+            # neighbours keep their link by name; get_neighbor skips absent nodes
+            self.unindex(device_name)
+            del self.table[device_name]
+            self.origin_of.pop(device_name, None)
+            self.log_change('remove', device_name)
+
+    # Caller must hold self.lock.
+    def unindex(self, name):
+        entry = self.table.get(name)
+        if entry is None:
+            return
+        self.by_location[entry.location].discard(name)
+        for cap in entry.capabilities():
+            self.by_capability[cap].discard(name)
+
+    # Caller must hold self.lock.
+    def link(self, name, direction, other):
+        self.table[name].neighbors[direction] = other
+        peer = self.table.get(other)
+        if peer is not None and direction in OPPOSITE:
+            peer.neighbors[OPPOSITE[direction]] = name
+
+    # Caller must hold self.lock.
+    def log_change(self, op, name):
+        self.version += 1
+        self.changes.append((self.version, op, name))
 
     def get_entry(self, device_name):
         if device_name in self.table:
@@ -20,11 +88,121 @@ class NodeTable(object):
         else:
             return None
 
+    def get_by_location(self, location):
+        with self.lock:
+            return sorted(self.by_location.get(location, ()))
+
+    def get_by_capability(self, capability):
+        with self.lock:
+            return sorted(self.by_capability.get(capability, ()))
+
+    #
+    # The device next to 'device_name' in 'direction' (LEFT, RIGHT, ...),
+    # or None if it is unknown or not joined.
+    #
+    def get_neighbor(self, device_name, direction):
+        entry = self.table.get(device_name)
+        if entry is None:
+            return None
+        other = entry.neighbors.get(direction)
+        return self.table.get(other) if other is not None else None
+
+    def get_names(self):
+        with self.lock:
+            return list(self.table.keys())
+
+    #
+    # Liveness: any message from a node counts as a heartbeat. Returns True
+    # if the node had been evicted and is added back.
+    #
+    def touch(self, device_name):
+        entry = self.table.get(device_name)
+        if entry is not None:
+            entry.last_seen = time.time()
+            return False
+        if device_name not in self.evicted:
+            return False
+        with self.lock:
+            entry = self.evicted.pop(device_name, None)
+            if entry is None or device_name in self.table:
+                return False
+            self.add_entry(entry.device_name, entry.ip, entry.port, entry.location, entry.capability, entry.neighbors)
+            return True
+
+    def evict_dead(self, timeout):
+        now = time.time()
+        with self.lock:
+            dead = [name for name, entry in self.table.items() if now - entry.last_seen > timeout]
+            for name in dead:
+                self.evicted[name] = self.table[name]
+                self.remove_entry(name)
+            while len(self.evicted) > self.max_evicted:
+                self.evicted.popitem(last=False)
+        return dead
+
+    #
+    # Compact JSON list of all entries (what device_list messages carry).
+    #
     def get_list_str(self):
-        t = []
-        for key in self.table.keys():
-            t.append(self.table[key])
-        return str(t)
+        with self.lock:
+            return json.dumps([entry.to_dict() for entry in self.table.values()], separators=(',', ':'))
+
+    #
+    # Changes since 'base' as {'base', 'version', 'added': [entries],
+    # 'removed': [names]}, or None if the change log no longer reaches
+    # back to 'base' and a full list has to be sent instead.
+    #
+    def get_delta(self, base):
+        with self.lock:
+            if base > self.version or (base < self.version and (not self.changes or self.changes[0][0] > base + 1)):
+                return None
+            added, removed = {}, set()
+            for version, op, name in self.changes:
+                if version <= base:
+                    continue
+                if op == 'add' and name in self.table:
+                    added[name] = self.table[name].to_dict()
+                    removed.discard(name)
+                elif op == 'remove':
+                    added.pop(name, None)
+                    removed.add(name)
+            return {'base': base, 'version': self.version,
+                    'added': list(added.values()), 'removed': sorted(removed)}
+
+    def add_item(self, item, origin):
+        self.add_entry(item['device_name'], item['ip'], item['port'], item['location'], item['capability'],
+                       item.get('neighbors'))
+        self.origin_of[item['device_name']] = origin
+
+    #
+    # Receiver side. Entries named 'skip' (i.e. ourselves) are ignored.
+    # A full list replaces what was learnt from 'origin' and resets its
+    # version; a delta is only applied on top of the version it was made
+    # from. Returns False when a delta does not fit, in which case the full
+    # list has to be fetched.
+    #
+    def apply_list(self, origin, version, items, skip=None):
+        with self.lock:
+            names = set(item['device_name'] for item in items)
+            for name in [n for n, o in self.origin_of.items() if o == origin and n not in names]:
+                self.remove_entry(name)
+            for item in items:
+                if item['device_name'] != skip:
+                    self.add_item(item, origin)
+            self.remote_versions[origin] = version
+
+    def apply_delta(self, origin, delta, skip=None):
+        with self.lock:
+            if self.remote_versions.get(origin) != delta['base']:
+                return False
+            for item in delta['added']:
+                if item['device_name'] != skip:
+                    self.add_item(item, origin)
+            for name in delta['removed']:
+                if name != skip:
+                    self.remove_entry(name)
+            self.remote_versions[origin] = delta['version']
+            return True
 
 
 #
@@ -35,12 +213,20 @@ if __name__ == '__main__':
 
     node_table.add_entry('Controller_N1_8F', '143.248.55.122', 8888, 'N1_8F', None)
     node_table.add_entry('Camera_N1_823_1', '143.248.55.122', 9999, '(10.1, 17.5)', None)
-    node_table.add_entry('Camera_N1_823_2', '143.248.55.122', 9998, '(10.1, 18.8)', None)
+    node_table.add_entry('Camera_N1_823_2', '143.248.55.122', 9998, '(10.1, 18.8)', 'ncs', {'LEFT': 'Camera_N1_823_1'})
 
     print(node_table.table)
+    print(node_table.get_neighbor('Camera_N1_823_1', 'RIGHT'))
+    print(node_table.get_by_capability('ncs'))
 
+    base = node_table.version
     node_table.remove_entry('Camera_N1_823_1')
     print(node_table.table)
+    print(node_table.get_delta(base))
+
+    node_table.get_entry('Camera_N1_823_2').last_seen -= 60
+    print(node_table.evict_dead(30))
+    print(node_table.touch('Camera_N1_823_2'), node_table.get_names())
 
     node_info = node_table.get_entry('Controller_N1_8F')
     print(node_info.device_name, node_info.ip)
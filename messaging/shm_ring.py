@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import struct
+import threading
+import numpy as np
+from multiprocessing import shared_memory
+
+#
+# Shared-memory frame transport for peers on the same host.
+# The sender copies raw BGR frames into a ring of fixed-size slots and
+# only sends a small descriptor over ZMQ; the receiver maps the same
+# segment and reads the slot, so nothing is JPEG-encoded or decoded.
+#
+# Slot layout: seq (u64), nbytes (u64), frame bytes.
+# seq is zeroed while a slot is being written (a seqlock), so a reader
+# can tell whether the slot still holds the frame its descriptor names.
+#
+# Descriptor (network byte order):
+#   magic 'SM', seq, slot, slot_size, height, width, channels, len(name),
+#   followed by the segment name (utf-8)
+#
+SLOT_HEADER = struct.Struct('QQ')
+DESC_MAGIC = b'SM'
+DESC_STRUCT = struct.Struct('!2sQIIIIIB')
+
+
+def is_shm_descriptor(frame):
+    buf = frame.buffer if hasattr(frame, 'buffer') else frame
+    return len(buf) >= DESC_STRUCT.size and bytes(buf[:2]) == DESC_MAGIC
+
+
+class ShmRingWriter(object):
+    def __init__(self, prefix, slots=16):
+        self.prefix = prefix
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.shm = None
+        self.slot_size = 0
+        self.generation = 0
+        self.seq = 0
+
+    #
+    # (Re)creates the segment when a frame does not fit its slots,
+    # e.g. after a resolution change.
+    #
+    def ensure(self, nbytes):
+        if self.shm is not None and nbytes <= self.slot_size:
+            return
+        self.close()
+        self.generation += 1
+        self.slot_size = nbytes
+        name = '{}_{}_{}'.format(self.prefix, os.getpid(), self.generation)
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=self.slots * (SLOT_HEADER.size + self.slot_size))
+
+    #
+    # Copies 'img' into the next slot and returns its descriptor.
+    #
+    def write(self, img):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        h, w = img.shape[:2]
+        c = img.shape[2] if img.ndim == 3 else 1
+        with self.lock:
+            self.ensure(img.nbytes)
+            self.seq += 1
+            slot = self.seq % self.slots
+            off = slot * (SLOT_HEADER.size + self.slot_size)
+            buf = self.shm.buf
+            SLOT_HEADER.pack_into(buf, off, 0, 0)
+            dst = np.ndarray(img.shape, dtype=np.uint8, buffer=buf, offset=off + SLOT_HEADER.size)
+            np.copyto(dst, img)
+            SLOT_HEADER.pack_into(buf, off, self.seq, img.nbytes)
+            name = self.shm.name.encode()
+            return DESC_STRUCT.pack(DESC_MAGIC, self.seq, slot, self.slot_size, h, w, c, len(name)) + name
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class ShmRingReader(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = {} # name -> SharedMemory
+        self.stale = 0
+
+    def attach(self, name):
+        with self.lock:
+            shm = self.segments.get(name)
+            if shm is None:
+                # a new generation of a writer replaces its older segment
+                writer = name.rsplit('_', 1)[0]
+                for old in [n for n in self.segments if n.rsplit('_', 1)[0] == writer]:
+                    self.release(self.segments.pop(old))
+                shm = shared_memory.SharedMemory(name=name)
+                try:
+                    # the sender owns the segment; do not unlink it when we exit
+                    from multiprocessing import resource_tracker
+                    resource_tracker.unregister(shm._name, 'shared_memory')
+                except Exception:
+                    pass
+                self.segments[name] = shm
+            return shm
+
+    #
+    # Returns the frame a descriptor names, or None if the sender has
+    # already reused its slot. With copy=False the array is a view on the
+    # segment, valid only until the sender wraps around the ring.
+    #
+    def read(self, desc, copy=True):
+        buf = desc.buffer if hasattr(desc, 'buffer') else desc
+        _, seq, slot, slot_size, h, w, c, nlen = DESC_STRUCT.unpack_from(buf)
+        name = bytes(buf[DESC_STRUCT.size:DESC_STRUCT.size + nlen]).decode()
+        shm = self.attach(name)
+        off = slot * (SLOT_HEADER.size + slot_size)
+        shape = (h, w, c) if c > 1 else (h, w)
+        if SLOT_HEADER.unpack_from(shm.buf, off)[0] != seq:
+            self.stale += 1
+            return None
+        img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=off + SLOT_HEADER.size)
+        if copy:
+            img = img.copy()
+            if SLOT_HEADER.unpack_from(shm.buf, off)[0] != seq:
+                self.stale += 1
+                return None
+        return img
+
+    def release(self, shm):
+        try:
+            shm.close()
+        except BufferError:
+            pass # a handler still holds a view; the mapping goes with it
+
+    def close(self):
+        with self.lock:
+            for shm in self.segments.values():
+                self.release(shm)
+            self.segments.clear()
@@ -0,0 +1,90 @@
+import pytest
+import flow_control
+from flow_control import CreditManager, CreditWallet
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(flow_control.time, 'time', clock)
+    return clock
+
+
+def test_grant_full_window_when_idle(clock):
+    manager = CreditManager(max_credit=30)
+    assert manager.grant('cam1', depth=0) == 30
+
+
+def test_grant_shrinks_with_backlog(clock):
+    manager = CreditManager(target_latency=1.0, max_credit=30, initial_rate=20.0)
+    assert manager.grant('cam1', depth=5) == 15
+    assert manager.grant('cam1', depth=5, backlog=5) == 10
+    assert manager.grant('cam1', depth=25) == 0
+    assert manager.stats()['granted'] == {'cam1': 0}
+
+
+def test_grant_follows_dequeue_rate(clock):
+    manager = CreditManager(target_latency=1.0, max_credit=100, initial_rate=10.0, rate_window=1.0)
+    manager.on_enqueue('cam1')
+    manager.grant('cam1', depth=1)
+    # 60 more frames in, 50 of them consumed over 1 s: the rate moves towards 50/s
+    for _ in range(60):
+        manager.on_enqueue('cam1')
+    clock.now += 0.5
+    # within the rate window: still the initial rate
+    assert manager.grant('cam1', depth=5) == 10 - 5
+    clock.now += 0.5
+    assert manager.grant('cam1', depth=11) == int(0.7 * 10.0 + 0.3 * 50) - 11
+    assert manager.stats()['rate']['cam1'] == pytest.approx(22.0)
+
+
+def test_grant_is_per_device(clock):
+    manager = CreditManager(target_latency=1.0, max_credit=30, initial_rate=20.0)
+    assert manager.grant('cam1', depth=20) == 0
+    assert manager.grant('cam2', depth=0) == 30
+
+
+def test_wallet_without_grant_is_not_flow_controlled(clock):
+    wallet = CreditWallet()
+    assert all(wallet.acquire('10.0.0.1', 8888, 'cam1') for _ in range(100))
+
+
+def test_wallet_consumes_credits(clock):
+    wallet = CreditWallet(probe_interval=0.2)
+    wallet.update('10.0.0.1', '8888', 'cam1', 2)
+    assert wallet.acquire('10.0.0.1', 8888, 'cam1')
+    assert wallet.acquire('10.0.0.1', 8888, 'cam1')
+    assert not wallet.acquire('10.0.0.1', 8888, 'cam1')
+    stats = wallet.stats()
+    assert stats['sent'][('10.0.0.1', 8888, 'cam1')] == 2
+    assert stats['dropped'][('10.0.0.1', 8888, 'cam1')] == 1
+
+
+def test_wallet_probes_without_credits(clock):
+    wallet = CreditWallet(probe_interval=0.2)
+    wallet.update('10.0.0.1', 8888, 'cam1', 0)
+    assert wallet.acquire('10.0.0.1', 8888, 'cam1')
+    assert not wallet.acquire('10.0.0.1', 8888, 'cam1')
+    clock.now += 0.1
+    assert not wallet.acquire('10.0.0.1', 8888, 'cam1')
+    clock.now += 0.1
+    assert wallet.acquire('10.0.0.1', 8888, 'cam1')
+    assert wallet.stats()['credits'][('10.0.0.1', 8888, 'cam1')] == 0
+
+
+def test_wallet_is_per_device(clock):
+    wallet = CreditWallet()
+    wallet.update('10.0.0.1', 8888, 'cam1', 0)
+    wallet.update('10.0.0.1', 8888, 'cam2', 1)
+    wallet.acquire('10.0.0.1', 8888, 'cam1')
+    assert not wallet.acquire('10.0.0.1', 8888, 'cam1')
+    assert wallet.acquire('10.0.0.1', 8888, 'cam2')
+    assert wallet.acquire('10.0.0.1', 9999, 'cam1')
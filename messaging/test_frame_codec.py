@@ -0,0 +1,88 @@
+import struct
+import cv2
+import numpy as np
+import pytest
+import zmq
+import frame_codec
+
+
+def pack(**kwargs):
+    args = dict(msg_type='img_e2', framecnt=42, device_name='Camera_N1_823_1', timestamp=1234.5)
+    args.update(kwargs)
+    return frame_codec.pack_header(**args)
+
+
+def test_header_round_trip():
+    header = frame_codec.unpack_header(pack(coord=(1, 2, 30, 40), encode_time=0.25, quality=80,
+                                            scale=0.5, original=(480, 640)))
+    assert header == {'type': 'img_e2', 'framecnt': 42, 'device_name': 'Camera_N1_823_1',
+                      'timestamp': 1234.5, 'coordinates': (1, 2, 30, 40), 'encode_time': 0.25,
+                      'quality': 80, 'scale': 0.5, 'original': (480, 640)}
+
+
+def test_header_defaults():
+    header = frame_codec.unpack_header(pack())
+    assert header['coordinates'] == frame_codec.NO_COORD
+    assert header['original'] is None
+    assert header['scale'] == 1.0
+
+
+def test_header_non_ascii_device_name():
+    buf = pack(device_name='카메라_1')
+    assert frame_codec.unpack_header(buf)['device_name'] == '카메라_1'
+    assert frame_codec.peek_device_name(buf) == '카메라_1'
+
+
+def test_peek_device_name():
+    assert frame_codec.peek_device_name(pack()) == 'Camera_N1_823_1'
+    assert frame_codec.peek_device_name(memoryview(pack())) == 'Camera_N1_823_1'
+
+
+def test_version_byte():
+    buf = bytearray(pack())
+    assert buf[2] == frame_codec.HEADER_VERSION
+    buf[2] = frame_codec.HEADER_VERSION - 1
+    with pytest.raises(ValueError):
+        frame_codec.unpack_header(bytes(buf))
+
+
+def test_bad_magic():
+    buf = b'XX' + pack()[2:]
+    with pytest.raises(ValueError):
+        frame_codec.unpack_header(buf)
+
+
+def test_is_frame_message():
+    assert frame_codec.is_frame_message([zmq.Frame(pack()), zmq.Frame(b'jpeg')])
+
+
+@pytest.mark.parametrize('frames', [
+    [],
+    [zmq.Frame(b'')],
+    [zmq.Frame(pack())],
+    [zmq.Frame(b''), zmq.Frame(b'jpeg')],
+    [zmq.Frame(b'F'), zmq.Frame(b'jpeg')],
+    [zmq.Frame(b'{"type": "img"}'), zmq.Frame(b'jpeg')],
+    [zmq.Frame(pack()), zmq.Frame(b'jpeg'), zmq.Frame(b'')],
+])
+def test_is_frame_message_malformed(frames):
+    assert not frame_codec.is_frame_message(frames)
+
+
+@pytest.mark.parametrize('buf', [b'', b'FB', pack()[:frame_codec.HEADER_STRUCT.size - 1]])
+def test_truncated_header(buf):
+    with pytest.raises(struct.error):
+        frame_codec.peek_device_name(buf)
+    with pytest.raises(struct.error):
+        frame_codec.unpack_header(buf)
+
+
+def test_decode_jpeg():
+    img = np.zeros((48, 64, 3), dtype=np.uint8)
+    img[:, :32] = 255
+    ok, jpeg = cv2.imencode('.jpg', img)
+    assert ok
+    payload = frame_codec.payload_array(zmq.Frame(jpeg.tobytes()))
+    assert frame_codec.decode_jpeg(payload).shape == (48, 64, 3)
+    assert frame_codec.decode_jpeg(payload, scale=0.5).shape == (96, 128, 3)
+    assert frame_codec.decode_jpeg(b'not a jpeg') is None
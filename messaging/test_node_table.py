@@ -0,0 +1,96 @@
+from node_table import NodeTable
+
+
+def make_table():
+    table = NodeTable()
+    table.add_entry('Controller_N1_8F', '10.0.0.1', 8888, 'N1_8F', 'gpu')
+    table.add_entry('Camera_1', '10.0.0.2', 9999, 'N1_823', 'ncs')
+    table.add_entry('Camera_2', '10.0.0.3', 9998, 'N1_823', 'ncs', {'LEFT': 'Camera_1'})
+    return table
+
+
+def test_indexes_and_neighbors():
+    table = make_table()
+    assert table.get_by_location('N1_823') == ['Camera_1', 'Camera_2']
+    assert table.get_by_capability('ncs') == ['Camera_1', 'Camera_2']
+    assert table.get_neighbor('Camera_1', 'RIGHT').device_name == 'Camera_2'
+    assert table.get_neighbor('Camera_2', 'LEFT').device_name == 'Camera_1'
+
+
+def test_delta_since_base():
+    table = make_table()
+    base = table.version
+    table.remove_entry('Camera_1')
+    table.add_entry('Camera_3', '10.0.0.4', 9997, 'N1_824', 'no')
+    delta = table.get_delta(base)
+    assert delta['base'] == base
+    assert delta['version'] == table.version
+    assert [item['device_name'] for item in delta['added']] == ['Camera_3']
+    assert delta['removed'] == ['Camera_1']
+
+
+def test_delta_up_to_date_and_too_old():
+    table = NodeTable(max_changes=2)
+    for i in range(4):
+        table.add_entry('Camera_{}'.format(i), '10.0.0.1', 9000 + i, 'N1', 'no')
+    assert table.get_delta(table.version) == {'base': table.version, 'version': table.version,
+                                              'added': [], 'removed': []}
+    assert table.get_delta(0) is None
+    assert table.get_delta(table.version + 1) is None
+
+
+def test_apply_delta():
+    table = make_table()
+    peer = NodeTable()
+    peer.apply_list('Controller_N1_8F', table.version, [e.to_dict() for e in table.table.values()],
+                    skip='Controller_N1_8F')
+    assert sorted(peer.get_names()) == ['Camera_1', 'Camera_2']
+
+    base = table.version
+    table.remove_entry('Camera_1')
+    assert peer.apply_delta('Controller_N1_8F', table.get_delta(base))
+    assert peer.get_names() == ['Camera_2']
+    # a delta made from another version does not apply
+    assert not peer.apply_delta('Controller_N1_8F', table.get_delta(base))
+
+
+def test_evict_dead():
+    table = make_table()
+    table.get_entry('Camera_1').last_seen -= 60
+    assert table.evict_dead(30) == ['Camera_1']
+    assert table.get_entry('Camera_1') is None
+    assert table.get_by_capability('ncs') == ['Camera_2']
+    assert table.get_neighbor('Camera_2', 'LEFT') is None
+    assert table.evict_dead(30) == []
+
+
+def test_touch_re_adds_evicted_node():
+    table = make_table()
+    table.get_entry('Camera_1').last_seen -= 60
+    table.evict_dead(30)
+    base = table.version
+    assert table.touch('Camera_1')
+    entry = table.get_entry('Camera_1')
+    assert (entry.ip, entry.port) == ('10.0.0.2', 9999)
+    assert table.get_by_capability('ncs') == ['Camera_1', 'Camera_2']
+    assert table.get_neighbor('Camera_2', 'LEFT').device_name == 'Camera_1'
+    assert [item['device_name'] for item in table.get_delta(base)['added']] == ['Camera_1']
+    # already back: a plain heartbeat
+    assert not table.touch('Camera_1')
+
+
+def test_touch_unknown_node():
+    table = make_table()
+    assert not table.touch('Camera_9')
+    assert table.get_entry('Camera_9') is None
+
+
+def test_evicted_entries_are_bounded():
+    table = NodeTable(max_evicted=2)
+    for i in range(4):
+        table.add_entry('Camera_{}'.format(i), '10.0.0.1', 9000 + i, 'N1', 'no')
+        table.get_entry('Camera_{}'.format(i)).last_seen -= 60
+    table.evict_dead(30)
+    assert list(table.evicted) == ['Camera_2', 'Camera_3']
+    assert not table.touch('Camera_0')
+    assert table.touch('Camera_3')
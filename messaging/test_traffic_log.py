@@ -0,0 +1,95 @@
+import pytest
+import zmq
+from traffic_log import TrafficReader, TrafficWriter
+
+MESSAGES = [
+    (100.0, [b'{"type": "heartbeat"}']),
+    (100.5, [b'FB-header', b'\xff\xd8jpeg\xff\xd9']),
+    (101.25, [b'', b'x' * 70000]),
+]
+
+
+def record(path, close=True):
+    writer = TrafficWriter(str(path))
+    for arrival, frames in MESSAGES:
+        writer.record(frames, arrival)
+    if close:
+        writer.close()
+    else:
+        writer.f.flush() # as if the recording process was killed
+    return writer
+
+
+def expected():
+    return [(arrival - MESSAGES[0][0], frames) for arrival, frames in MESSAGES]
+
+
+def test_read_with_index(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    record(path)
+    reader = TrafficReader(str(path))
+    assert len(reader) == 3
+    assert list(reader) == expected()
+    assert reader.read(1) == expected()[1]
+    assert reader.duration() == 1.25
+    reader.close()
+
+
+def test_find(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    record(path)
+    reader = TrafficReader(str(path))
+    assert reader.find(0.0) == 0
+    assert reader.find(0.1) == 1
+    assert reader.find(0.5) == 1
+    assert reader.find(2.0) == 3
+    reader.close()
+
+
+def test_records_zmq_frames(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    writer = TrafficWriter(str(path))
+    writer.record([zmq.Frame(b'header'), zmq.Frame(b'payload')], 5.0)
+    writer.close()
+    # closed writers ignore late records
+    writer.record([b'late'], 6.0)
+    reader = TrafficReader(str(path))
+    assert list(reader) == [(0.0, [b'header', b'payload'])]
+    reader.close()
+
+
+def test_scan_unclosed_file(tmp_path, capsys):
+    path = tmp_path / 'traffic.rec'
+    writer = record(path, close=False)
+    reader = TrafficReader(str(path))
+    assert 'no index' in capsys.readouterr().out
+    assert list(reader) == expected()
+    reader.close()
+    writer.close()
+
+
+def test_scan_ignores_truncated_record(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    writer = record(path, close=False)
+    writer.f.close()
+    data = path.read_bytes()
+    path.write_bytes(data[:-10])
+    reader = TrafficReader(str(path))
+    assert list(reader) == expected()[:2]
+    reader.close()
+
+
+def test_empty_recording(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    TrafficWriter(str(path)).close()
+    reader = TrafficReader(str(path))
+    assert len(reader) == 0
+    assert reader.duration() == 0.0
+    reader.close()
+
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    path.write_bytes(b'not a recording')
+    with pytest.raises(ValueError):
+        TrafficReader(str(path))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+#
+# The per-frame tracker update of the tracking loops. The loop converts
+# the frame to RGB once; start() makes a tracker on it, update() moves
+# all trackers of the frame and returns their confidence and boxes.
+# Backends:
+#  - dlib: dlib.correlation_tracker, the trackers updated in parallel on
+#    a thread pool (dlib and OpenCV release the GIL while they work).
+#    The confidence is the peak-to-side-lobe ratio update() returns.
+#  - kcf: OpenCV's KCF tracker (opencv-contrib), in parallel as well.
+#    Confidence FLOW_PSR when it reports the target, 0 when it lost it.
+#  - flow: pyramidal Lucas-Kanade optical flow of corner points in every
+#    box, all boxes of a frame in one batched call (plus the backward
+#    check). Confidence FLOW_PSR times the share of points that tracked.
+# The confidences are on the scale of dlib's ratio, so that the
+# detection interval (detection_interval.py) works with any backend.
+#
+BACKENDS = ('dlib', 'kcf', 'flow')
+FLOW_PSR = 20.0
+
+
+def kcf_factory():
+    create = getattr(cv2, 'TrackerKCF_create', None)
+    if create is None and hasattr(cv2, 'legacy'):
+        create = getattr(cv2.legacy, 'TrackerKCF_create', None)
+    return create
+
+
+class DlibTracker(object):
+    def __init__(self, rgb, box):
+        import dlib
+        self.tracker = dlib.correlation_tracker()
+        self.tracker.start_track(rgb, dlib.rectangle(int(box[0]), int(box[1]), int(box[2]), int(box[3])))
+
+    def update(self, rgb):
+        psr = self.tracker.update(rgb)
+        pos = self.tracker.get_position()
+        return psr, (int(pos.left()), int(pos.top()), int(pos.right()), int(pos.bottom()))
+
+    def position(self):
+        pos = self.tracker.get_position()
+        return (int(pos.left()), int(pos.top()), int(pos.right()), int(pos.bottom()))
+
+
+class KcfTracker(object):
+    def __init__(self, rgb, box, create):
+        self.tracker = create()
+        self.box = tuple(int(v) for v in box)
+        self.tracker.init(rgb, (self.box[0], self.box[1], self.box[2] - self.box[0], self.box[3] - self.box[1]))
+
+    def update(self, rgb):
+        ok, (x, y, w, h) = self.tracker.update(rgb)
+        if ok:
+            self.box = (int(x), int(y), int(x + w), int(y + h))
+        return (FLOW_PSR if ok else 0.0), self.box
+
+    def position(self):
+        return self.box
+
+
+#
+# Corner points of one box, moved by the batched flow of flow_batch.
+#
+class FlowTracker(object):
+    def __init__(self, gray, box):
+        self.box = np.array(box, dtype=np.float32)
+        self.gray = gray
+        self.points = self.seed(gray)
+        self.seeded = len(self.points)
+
+    def seed(self, gray):
+        h, w = gray.shape[0:2]
+        x1, y1 = max(int(self.box[0]), 0), max(int(self.box[1]), 0)
+        x2, y2 = min(int(self.box[2]), w), min(int(self.box[3]), h)
+        points = None
+        if x2 - x1 > 4 and y2 - y1 > 4:
+            points = cv2.goodFeaturesToTrack(gray[y1:y2, x1:x2], 30, 0.01, 3)
+        if points is None or len(points) < 4:
+            xs, ys = np.meshgrid(np.linspace(self.box[0], self.box[2], 5)[1:-1], np.linspace(self.box[1], self.box[3], 5)[1:-1])
+            return np.stack((xs.ravel(), ys.ravel()), axis=1).astype(np.float32)
+        return points.reshape(-1, 2) + np.array([x1, y1], dtype=np.float32)
+
+    #
+    # The box follows the median motion (and spread) of the points that
+    # tracked both ways; the points are re-seeded when half are lost.
+    #
+    def move(self, gray, old, new, good):
+        if good.sum() >= 3:
+            old, new = old[good], new[good]
+            shift = np.median(new - old, axis=0)
+            spread_old = np.linalg.norm(old - old.mean(axis=0), axis=1)
+            spread_new = np.linalg.norm(new - new.mean(axis=0), axis=1)
+            valid = spread_old > 1.0
+            scale = float(np.clip(np.median(spread_new[valid] / spread_old[valid]), 0.8, 1.25)) if valid.any() else 1.0
+            center = (self.box[0:2] + self.box[2:4]) / 2.0 + shift
+            half = (self.box[2:4] - self.box[0:2]) / 2.0 * scale
+            self.box = np.concatenate((center - half, center + half)).astype(np.float32)
+            self.points = new
+        confidence = FLOW_PSR * float(good.sum()) / max(self.seeded, 1)
+        self.gray = gray
+        if len(self.points) < self.seeded / 2 or good.sum() < 3:
+            self.points = self.seed(gray)
+            self.seeded = len(self.points)
+        return confidence, self.position()
+
+    def position(self):
+        return tuple(int(v) for v in self.box)
+
+
+#
+# One forward and one backward calcOpticalFlowPyrLK for the points of
+# all trackers that were last updated on the same frame.
+#
+def flow_batch(trackers, gray, fb_threshold=1.0):
+    results = [None] * len(trackers)
+    groups = {}
+    for i, tracker in enumerate(trackers):
+        groups.setdefault(id(tracker.gray), []).append(i)
+    for indices in groups.values():
+        prev = trackers[indices[0]].gray
+        counts = [len(trackers[i].points) for i in indices]
+        old = np.concatenate([trackers[i].points for i in indices]).reshape(-1, 1, 2)
+        new, status, _ = cv2.calcOpticalFlowPyrLK(prev, gray, old, None, winSize=(15, 15), maxLevel=2)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev, new, None, winSize=(15, 15), maxLevel=2)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (np.linalg.norm((back - old).reshape(-1, 2), axis=1) < fb_threshold)
+        old, new = old.reshape(-1, 2), new.reshape(-1, 2)
+        start = 0
+        for i, n in zip(indices, counts):
+            results[i] = trackers[i].move(gray, old[start:start + n], new[start:start + n], good[start:start + n])
+            start += n
+    return results
+
+
+class TrackerStage(object):
+    def __init__(self, backend='dlib', threads=4):
+        if backend == 'kcf' and kcf_factory() is None:
+            print('[Tracker] kcf backend not available (needs opencv-contrib), using dlib')
+            backend = 'dlib'
+        self.backend = backend
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 and backend != 'flow' else None
+        self.gray_of = (None, None) # (rgb, its gray) of the last frame, for the flow backend
+
+    def gray(self, rgb):
+        if self.gray_of[0] is not rgb:
+            self.gray_of = (rgb, cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY))
+        return self.gray_of[1]
+
+    def start(self, rgb, box):
+        if self.backend == 'flow':
+            return FlowTracker(self.gray(rgb), box)
+        if self.backend == 'kcf':
+            return KcfTracker(rgb, box, kcf_factory())
+        return DlibTracker(rgb, box)
+
+    #
+    # Returns the confidences and the (x1, y1, x2, y2) boxes of 'trackers'
+    # on the frame 'rgb', in order.
+    #
+    def update(self, trackers, rgb):
+        if len(trackers) == 0:
+            return [], []
+        if self.backend == 'flow':
+            results = flow_batch(trackers, self.gray(rgb))
+        elif self.pool is not None and len(trackers) > 1:
+            results = list(self.pool.map(lambda tracker: tracker.update(rgb), trackers))
+        else:
+            results = [tracker.update(rgb) for tracker in trackers]
+        return [r[0] for r in results], [r[1] for r in results]
+
+
+#
+# Synthetic benchmark: 'n' textured boxes drifting over a noisy frame,
+# ms per frame of the update stage per backend and object count.
+#
+def synthetic_scene(n, shape, rng):
+    background = rng.integers(0, 255, shape, dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (7, 7), 0)
+    patches = [rng.integers(0, 255, (60, 30, 3), dtype=np.uint8) for _ in range(n)]
+    starts = rng.uniform([40, 40], [shape[1] - 120, shape[0] - 120], (n, 2))
+    speeds = rng.uniform(-2, 2, (n, 2))
+    return background, patches, starts, speeds
+
+
+def render(scene, t):
+    background, patches, starts, speeds = scene
+    frame = background.copy()
+    boxes = []
+    for patch, start, speed in zip(patches, starts, speeds):
+        x, y = (start + speed * t).astype(int)
+        frame[y:y + 60, x:x + 30] = patch
+        boxes.append((x, y, x + 30, y + 60))
+    return frame, boxes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="tracker update stage benchmark")
+    parser.add_argument('-b', '--backends', type=str, default=','.join(BACKENDS), help="backends to compare")
+    parser.add_argument('-n', '--objects', type=str, default='1,5,10,20,50', help="object counts")
+    parser.add_argument('-th', '--threads', type=int, default=4, help="tracker threads")
+    parser.add_argument('-f', '--frames', type=int, default=30, help="frames per measurement")
+    ARGS = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n in [int(v) for v in ARGS.objects.split(',')]:
+        scene = synthetic_scene(n, (720, 1280, 3), rng)
+        for name in ARGS.backends.split(','):
+            for threads in ([1] if name == 'flow' else sorted(set([1, ARGS.threads]))): # flow is one batched call
+                try:
+                    stage = TrackerStage(name, threads)
+                    frame, boxes = render(scene, 0)
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    trackers = [stage.start(rgb, box) for box in boxes]
+                except ImportError as e:
+                    print('{:3d} objects {:5s} not available ({})'.format(n, name, e))
+                    break
+                elapsed = 0.0
+                error = 0.0
+                for t in range(1, ARGS.frames + 1):
+                    frame, boxes = render(scene, t)
+                    s = time.time()
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    _, positions = stage.update(trackers, rgb)
+                    elapsed += time.time() - s
+                    error += np.mean([abs(p[0] - b[0]) + abs(p[1] - b[1]) for p, b in zip(positions, boxes)])
+                print('{:3d} objects {:5s} {} threads {:7.2f} ms/frame  (mean corner error {:.1f}px)'.format(
+                    n, stage.backend, threads, 1000.0 * elapsed / ARGS.frames, error / ARGS.frames))
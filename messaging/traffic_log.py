@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import os
+import struct
+import threading
+
+#
+# Recorded MessageBus traffic, for replaying it later (see traffic_replay.py).
+#
+# File layout (network byte order):
+#   magic 'AIOTTRF1'
+#   records: arrival time (float64, seconds since the first record),
+#            number of frames (u8), length of every frame (u32 each),
+#            then the frames as received (without the send stamp)
+#   index:   (record offset u64, arrival time float64) per record
+#   footer:  index offset (u64), record count (u32), magic 'TIDX'
+#
+# The index is written by close(); a file that was not closed properly
+# (e.g. the recording process was killed) is still readable, its records
+# are then indexed by scanning the file once.
+#
+FILE_MAGIC = b'AIOTTRF1'
+RECORD_STRUCT = struct.Struct('!dB')
+LENGTH_STRUCT = struct.Struct('!I')
+INDEX_STRUCT = struct.Struct('!Qd')
+FOOTER_MAGIC = b'TIDX'
+FOOTER_STRUCT = struct.Struct('!QI4s')
+
+
+class TrafficWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'wb')
+        self.f.write(FILE_MAGIC)
+        self.index = []
+        self.start = None
+
+    #
+    # 'frames' are bytes-like objects (or zmq.Frame); 'arrival' is a
+    # monotonic time in seconds.
+    #
+    def record(self, frames, arrival):
+        bufs = [f.buffer if hasattr(f, 'buffer') else f for f in frames]
+        with self.lock:
+            if self.f is None:
+                return
+            if self.start is None:
+                self.start = arrival
+            t = arrival - self.start
+            self.index.append((self.f.tell(), t))
+            self.f.write(RECORD_STRUCT.pack(t, len(bufs)))
+            for buf in bufs:
+                self.f.write(LENGTH_STRUCT.pack(len(buf)))
+            for buf in bufs:
+                self.f.write(buf)
+
+    def close(self):
+        with self.lock:
+            if self.f is None:
+                return
+            index_offset = self.f.tell()
+            for offset, t in self.index:
+                self.f.write(INDEX_STRUCT.pack(offset, t))
+            self.f.write(FOOTER_STRUCT.pack(index_offset, len(self.index), FOOTER_MAGIC))
+            self.f.close()
+            self.f = None
+            print('[MESSAGING] recorded {} messages to {}'.format(len(self.index), self.path))
+
+
+class TrafficReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        if self.f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError('{} is not a traffic recording'.format(path))
+        self.offsets = []
+        self.times = []
+        if not self.load_index():
+            self.scan()
+
+    def load_index(self):
+        size = os.fstat(self.f.fileno()).st_size
+        if size < len(FILE_MAGIC) + FOOTER_STRUCT.size:
+            return False
+        self.f.seek(size - FOOTER_STRUCT.size)
+        index_offset, count, magic = FOOTER_STRUCT.unpack(self.f.read(FOOTER_STRUCT.size))
+        if magic != FOOTER_MAGIC or index_offset + count * INDEX_STRUCT.size != size - FOOTER_STRUCT.size:
+            return False
+        self.f.seek(index_offset)
+        data = self.f.read(count * INDEX_STRUCT.size)
+        for offset, t in INDEX_STRUCT.iter_unpack(data):
+            self.offsets.append(offset)
+            self.times.append(t)
+        return True
+
+    #
+    # Rebuilds the index of an unclosed file; a truncated last record is ignored.
+    #
+    def scan(self):
+        size = os.fstat(self.f.fileno()).st_size
+        offset = len(FILE_MAGIC)
+        while offset + RECORD_STRUCT.size <= size:
+            self.f.seek(offset)
+            t, n = RECORD_STRUCT.unpack(self.f.read(RECORD_STRUCT.size))
+            lengths = self.f.read(n * LENGTH_STRUCT.size)
+            if len(lengths) < n * LENGTH_STRUCT.size:
+                break
+            end = offset + RECORD_STRUCT.size + len(lengths) + sum(l for l, in LENGTH_STRUCT.iter_unpack(lengths))
+            if end > size:
+                break
+            self.offsets.append(offset)
+            self.times.append(t)
+            offset = end
+        print('[MESSAGING] {} has no index, scanned {} messages'.format(self.path, len(self.offsets)))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def duration(self):
+        return self.times[-1] if self.times else 0.0
+
+    #
+    # Returns (arrival time, [frame bytes]) of record i.
+    #
+    def read(self, i):
+        self.f.seek(self.offsets[i])
+        t, n = RECORD_STRUCT.unpack(self.f.read(RECORD_STRUCT.size))
+        lengths = [l for l, in LENGTH_STRUCT.iter_unpack(self.f.read(n * LENGTH_STRUCT.size))]
+        return t, [self.f.read(l) for l in lengths]
+
+    #
+    # Index of the first record at or after 't' seconds.
+    #
+    def find(self, t):
+        return bisect.bisect_left(self.times, t)
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self.read(i)
+
+    def close(self):
+        self.f.close()
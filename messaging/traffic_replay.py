@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import threading
+import time
+from datetime import datetime
+import frame_codec
+from message_bus import MessageBus, BROADCAST_PORT_OFFSET
+from traffic_log import TrafficReader
+from broadcast import control_topic
+
+#
+# Feeds a recorded traffic file (MessageBus.start_recording) into a
+# controller, so that the controller modes (e1-1, e1-2, e2, p) can be
+# benchmarked without cameras or NCS sticks.
+#
+# - speed: 1 replays in real time, N is N times faster, 0 is as fast as
+#   the controller acks.
+# - copies: every recorded camera is replayed as 'copies' cameras
+#   (camera01, camera01_1, ...), each 'stagger' seconds after the last,
+#   to simulate more cameras with the same frames.
+# - follow_control: each replayed camera obeys the controller's
+#   control_op on/off like a real one (needed for e1-2), and send credits
+#   are respected like in the hypervisor (frames without credit are
+#   dropped), per replayed camera.
+#
+# Recorded join/heartbeat/device_list messages are not replayed; the
+# replayer joins every camera itself, with its own address, and keeps
+# them alive with heartbeats. Frame timestamps are rewritten to the
+# replay time so latencies stay meaningful.
+#
+SKIP_TYPES = ('join', 'heartbeat', 'device_list')
+
+
+class TrafficReplayer(object):
+    def __init__(self, path, target_ip, target_port, listen_port, my_ip='127.0.0.1',
+                 speed=1.0, copies=1, stagger=0.0, follow_control=True):
+        self.reader = TrafficReader(path)
+        self.target_ip = target_ip
+        self.target_port = int(target_port)
+        self.my_ip = my_ip
+        self.listen_port = int(listen_port)
+        self.speed = speed
+        self.copies = copies
+        self.stagger = stagger
+        self.follow_control = follow_control
+        self.msg_bus = MessageBus('replayer', self.listen_port, 'camera')
+        self.msg_bus.register_callback('control_op', self.handle_control_op)
+        self.msg_bus.start_clock_sync(target_ip, target_port)
+        self.lock = threading.Lock()
+        self.enabled = {} # replayed device -> sending on/off
+        self.counts = {} # replayed device -> {'sent', 'dropped', 'gated', 'bytes'}
+        self.devices = self.recorded_devices()
+
+    #
+    # Device name of a recorded message, and its JSON (None for frame messages).
+    #
+    @staticmethod
+    def parse(frames):
+        if len(frames) == 2 and frames[0][:2] == frame_codec.HEADER_MAGIC:
+            return frame_codec.peek_device_name(frames[0]), None
+        try:
+            msg_dict = json.loads(frames[0].decode())
+        except ValueError:
+            return None, None
+        return msg_dict.get('device_name'), msg_dict
+
+    def recorded_devices(self):
+        devices = []
+        for _, frames in self.reader:
+            name, msg_dict = self.parse(frames)
+            if name is not None and name not in devices and (msg_dict is None or msg_dict.get('type') not in SKIP_TYPES):
+                devices.append(name)
+        return devices
+
+    @staticmethod
+    def copy_name(name, k):
+        return name if k == 0 else '{}_{}'.format(name, k)
+
+    #
+    # Rewrites a recorded message for replayed camera 'name' at 'now'.
+    #
+    @staticmethod
+    def rewrite(frames, msg_dict, name, now):
+        if msg_dict is None:
+            h = frame_codec.unpack_header(frames[0])
+            header = frame_codec.pack_header(h['type'], h['framecnt'], name, now, h['coordinates'],
+                                             h['encode_time'], h['quality'], h['scale'], h['original'])
+            return [header, frames[1]], h['type']
+        msg_dict = dict(msg_dict, device_name=name)
+        if 'time' in msg_dict:
+            msg_dict['time'] = datetime.utcfromtimestamp(now).strftime('%H:%M:%S.%f')
+        return [json.dumps(msg_dict).encode()], msg_dict['type']
+
+    def join(self):
+        for name in self.devices:
+            for k in range(self.copies):
+                device = self.copy_name(name, k)
+                self.enabled[device] = True
+                self.counts[device] = {'sent': 0, 'dropped': 0, 'gated': 0, 'bytes': 0}
+                join_msg = dict(type='join', device_name=device, ip=self.my_ip, port=self.listen_port,
+                                location='replay', capability='no')
+                self.msg_bus.send_message_json(self.target_ip, self.target_port, join_msg)
+        if self.follow_control:
+            topics = [control_topic('all')] + [control_topic(d) for d in self.enabled]
+            self.msg_bus.subscribe(self.target_ip, self.target_port + BROADCAST_PORT_OFFSET, topics)
+
+    def handle_control_op(self, msg_dict):
+        if 'onoff' not in msg_dict:
+            return
+        on = str(msg_dict['onoff']) == 'True'
+        target = msg_dict.get('target', 'all')
+        with self.lock:
+            for device in self.enabled:
+                if target in ('all', device):
+                    self.enabled[device] = on
+
+    def run_heartbeat(self, interval=2.0):
+        while True:
+            for device in list(self.enabled):
+                msg = json.dumps({'type': 'heartbeat', 'device_name': device}).encode()
+                self.msg_bus.send_stamped(self.target_ip, self.target_port, [msg], 'heartbeat', False)
+            time.sleep(interval)
+
+    #
+    # (replay time, record index, copy) of every message, in send order.
+    #
+    def schedule(self):
+        events = []
+        for i, t in enumerate(self.reader.times):
+            for k in range(self.copies):
+                events.append((t + k * self.stagger, i, k))
+        events.sort()
+        return events
+
+    def send(self, frames, msg_type, device):
+        counts = self.counts[device]
+        if self.follow_control:
+            if not self.enabled.get(device, True):
+                counts['gated'] += 1
+                return
+            if msg_type.startswith('img') and not self.msg_bus.acquire_send_credit(self.target_ip, self.target_port, device):
+                counts['dropped'] += 1
+                return
+        self.msg_bus.send_stamped(self.target_ip, self.target_port, frames, msg_type, True)
+        counts['sent'] += 1
+        counts['bytes'] += sum(len(f) for f in frames)
+
+    def run(self, loops=1):
+        self.join()
+        th = threading.Thread(target=self.run_heartbeat)
+        th.daemon = True
+        th.start()
+        events = self.schedule()
+        span = (events[-1][0] if events else 0.0) + 1e-3
+        start = time.time()
+        for loop in range(loops):
+            for t, i, k in events:
+                if self.speed > 0:
+                    delay = start + (loop * span + t) / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                _, frames = self.reader.read(i)
+                name, msg_dict = self.parse(frames)
+                if name is None or (msg_dict is not None and msg_dict.get('type') in SKIP_TYPES):
+                    continue
+                device = self.copy_name(name, k)
+                frames, msg_type = self.rewrite(frames, msg_dict, device, time.time() + self.msg_bus.clock_offset)
+                self.send(frames, msg_type, device)
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        total = {'sent': 0, 'dropped': 0, 'gated': 0, 'bytes': 0}
+        for counts in self.counts.values():
+            for key in total:
+                total[key] += counts[key]
+        result = {'elapsed': elapsed, 'speed': self.speed, 'copies': self.copies,
+                  'msg_rate': total['sent'] / max(elapsed, 1e-6),
+                  'byte_rate': total['bytes'] / max(elapsed, 1e-6),
+                  'total': total, 'devices': self.counts}
+        print('[Replay] {} messages in {:.1f}s ({:.1f} msg/s, {:.1f} KB/s), {} dropped (no credit), {} gated (control_op)'.format(
+            total['sent'], elapsed, result['msg_rate'], result['byte_rate'] / 1000.0, total['dropped'], total['gated']))
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="replay recorded MessageBus traffic into a controller")
+    parser.add_argument('-f', '--file', type=str, required=True, help="recording (gpu_controller.py -rec)")
+    parser.add_argument('-t', '--target', type=str, default='127.0.0.1:5555', help="controller ip:port")
+    parser.add_argument('-p', '--port', type=int, default=5600, help="listen port of the replayer")
+    parser.add_argument('-ip', '--ip', type=str, default='127.0.0.1', help="address the controller can reach the replayer at")
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help="1: real time, N: N times faster, 0: max speed")
+    parser.add_argument('-m', '--multiplex', type=int, default=1, help="replay every camera as N cameras")
+    parser.add_argument('-st', '--stagger', type=float, default=0.0, help="seconds between the copies of a camera")
+    parser.add_argument('-lp', '--loops', type=int, default=1, help="replay the file N times")
+    parser.add_argument('-fc', '--followcontrol', type=str, default='on', help="obey control_op and send credits (on, off)")
+    parser.add_argument('-o', '--output', type=str, default=None, help="write the results as JSON")
+    ARGS = parser.parse_args()
+
+    target_ip, target_port = ARGS.target.rsplit(':', 1)
+    replayer = TrafficReplayer(ARGS.file, target_ip, target_port, ARGS.port, ARGS.ip, ARGS.speed,
+                               ARGS.multiplex, ARGS.stagger, ARGS.followcontrol == 'on')
+    print('[Replay] {} messages, {:.1f}s, cameras: {}'.format(len(replayer.reader), replayer.reader.duration(), replayer.devices))
+    result = replayer.run(ARGS.loops)
+    if ARGS.output is not None:
+        with open(ARGS.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    replayer.msg_bus.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import queue
+import threading
+import time
+
+
+#
+# A fixed set of worker threads, each with its own bounded queue.
+# Work is sharded by key (e.g. the sending device), so messages of one key
+# are always handled by the same worker and keep their arrival order,
+# while a slow key only delays the keys that share its worker.
+# Keys not submitted to for key_timeout seconds are forgotten (peers come
+# and go with every reconnect).
+#
+class WorkerPool(object):
+    def __init__(self, num_workers=4, queue_size=256, put_timeout=0.5, key_timeout=60.0):
+        self.queues = [queue.Queue(queue_size) for _ in range(num_workers)]
+        self.put_timeout = put_timeout
+        self.key_timeout = key_timeout
+        self.lock = threading.Lock()
+        self.assignment = {} # key -> worker index
+        self.last_used = {} # key -> time of its last submit
+        self.last_prune = time.time()
+        self.submitted = collections.Counter() # key -> count
+        self.dropped = collections.Counter()
+        self.handled = [0] * num_workers
+        self.max_depth = [0] * num_workers
+        self.busy_time = [0.0] * num_workers
+        self.starttime = time.time()
+        for i in range(num_workers):
+            th = threading.Thread(target=self.run_worker, args=(i,))
+            th.daemon = True
+            th.start()
+
+    #
+    # A new key is pinned to the worker with the fewest keys, so a handful
+    # of cameras spread evenly instead of colliding on one hash bucket.
+    #
+    def worker_index(self, key):
+        with self.lock:
+            now = time.time()
+            self.last_used[key] = now
+            i = self.assignment.get(key)
+            if i is None:
+                if now - self.last_prune > self.key_timeout:
+                    self.prune(now)
+                load = [0] * len(self.queues)
+                for j in self.assignment.values():
+                    load[j] += 1
+                i = load.index(min(load))
+                self.assignment[key] = i
+            return i
+
+    #
+    # Drops the keys idle for key_timeout whose worker has nothing queued,
+    # so a key that comes back cannot overtake its own earlier work.
+    # Caller must hold self.lock.
+    #
+    def prune(self, now):
+        self.last_prune = now
+        for key in [k for k, t in self.last_used.items() if now - t > self.key_timeout]:
+            i = self.assignment.get(key)
+            if i is not None and not self.queues[i].empty():
+                continue
+            self.assignment.pop(key, None)
+            self.last_used.pop(key, None)
+            self.submitted.pop(key, None)
+            self.dropped.pop(key, None)
+
+    #
+    # Queues fn(*args) on the worker of 'key'. Droppable work (frames) is
+    # discarded when that worker is full; other work (control messages)
+    # waits up to put_timeout for room, so a stuck worker cannot stall the
+    # listener. Returns False if the work was dropped.
+    #
+    def submit(self, key, fn, args, droppable=False):
+        i = self.worker_index(key)
+        q = self.queues[i]
+        try:
+            if droppable:
+                q.put_nowait((fn, args))
+            else:
+                q.put((fn, args), timeout=self.put_timeout)
+        except queue.Full:
+            with self.lock:
+                self.dropped[key] += 1
+            if not droppable:
+                print('[MESSAGING] worker {} full, dropping a message of {}'.format(i, key))
+            return False
+        with self.lock:
+            self.submitted[key] += 1
+            self.max_depth[i] = max(self.max_depth[i], q.qsize())
+        return True
+
+    #
+    # Work waiting on the worker of 'key' (shared with its other keys).
+    #
+    def pending(self, key):
+        with self.lock:
+            i = self.assignment.get(key)
+        return 0 if i is None else self.queues[i].qsize()
+
+    def run_worker(self, i):
+        q = self.queues[i]
+        while True:
+            fn, args = q.get()
+            s = time.time()
+            try:
+                fn(*args)
+            except Exception as e:
+                print('[MESSAGING] worker {} error: {}'.format(i, e))
+            with self.lock:
+                self.handled[i] += 1
+                self.busy_time[i] += time.time() - s
+
+    #
+    # Snapshot of queue depths and counters, e.g. for periodic logging.
+    #
+    def stats(self):
+        elapsed = max(time.time() - self.starttime, 1e-6)
+        with self.lock:
+            return {'depth': [q.qsize() for q in self.queues],
+                    'max_depth': list(self.max_depth),
+                    'handled': list(self.handled),
+                    'utilization': [b / elapsed for b in self.busy_time],
+                    'submitted': dict(self.submitted),
+                    'dropped': dict(self.dropped)}